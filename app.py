@@ -3,4 +3,8 @@ from tagger.index import app
 server = app.server
 
 if __name__ == "__main__":
-    app.run_server(debug=True)
\ No newline at end of file
+    # run the background jobs from this process too
+    from tagger.jobs import JobRunner, job_queue
+
+    JobRunner(job_queue).start()
+    app.run_server(debug=True)
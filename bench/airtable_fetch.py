@@ -0,0 +1,58 @@
+# Time fetching the three Airtable tables from a local fake Airtable with
+# some latency on each request:
+#
+#   python -m bench.airtable_fetch --records 5000 --latency 0.1
+#
+# Compares the airtable-python-wrapper fetching one table after another
+# with the pooled, concurrent fetch used by `flask data initialise`.
+import argparse
+import time
+
+from airtable import Airtable
+
+from bench.fake_airtable import FakeAirtable, example_tables
+from tagger import airtable_fetch, settings
+
+
+def fetch_with_wrapper(url, tables):
+    Airtable.API_URL = url
+    return {
+        name: Airtable(settings.AIRTABLE_BASE_ID, name, settings.AIRTABLE_API_KEY).get_all()
+        for name in tables
+    }
+
+
+def fetch_concurrently(url, tables):
+    settings.AIRTABLE_API_URL = url
+    return airtable_fetch.fetch_tables({name: (name, {}) for name in tables})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    tables = example_tables(args.records)
+    fake = FakeAirtable(tables, base_id="appFAKE", latency=args.latency)
+    url = fake.start()
+    settings.AIRTABLE_BASE_ID = "appFAKE"
+    settings.AIRTABLE_API_KEY = "keyFAKE"
+    # the fake has no rate limit to respect
+    airtable_fetch.rate_limiter = airtable_fetch.RateLimiter(None)
+    try:
+        for name, fetch in (("wrapper", fetch_with_wrapper), ("concurrent", fetch_concurrently)):
+            times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                fetched = fetch(url, tables)
+                times.append(time.perf_counter() - start)
+            assert {k: len(v) for k, v in fetched.items()} == {k: len(v) for k, v in tables.items()}
+            print("{:<12} best {:.2f}s of {}".format(name, min(times), args.repeat))
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
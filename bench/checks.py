@@ -0,0 +1,207 @@
+# Checks of behaviour that the timings in bench/suite.py don't cover, run
+# against a small set of synthetic data:
+#
+#   python -m bench.checks
+#
+# Exits with status 1 if any of them fail.
+import argparse
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import traceback
+
+CHECKS = []
+
+
+def check(func):
+    CHECKS.append(func)
+    return func
+
+
+@check
+def slices_of_a_cached_corpus():
+    # subsets of a cached corpus aren't matched from the cache of the whole
+    # corpus, as update_rule_counts does with the changed records
+    from tagger.data import build_corpus, get_completed_data, get_selected_items, match_rules
+
+    df, corpus, version = get_completed_data()
+    regex = r"\w{12}"
+    selected = get_selected_items(corpus, regex, version=version)
+    assert selected.equals(corpus.to_series().str.contains(regex)), "whole corpus"
+    assert get_selected_items(corpus, regex, version=version).equals(selected), "cached"
+    first, second = selected[selected].index[:2], selected[~selected].index[:2]
+    for rows in (df.loc[first], df.loc[second]):
+        rows_corpus = build_corpus(rows["name"], rows["activities"].fillna(rows["objects"]))
+        expected = rows_corpus.str.contains(regex).tolist()
+        assert get_selected_items(rows_corpus, regex).tolist() == expected, "slice"
+        assert match_rules(rows_corpus, {"rule": (regex, None)})[0]["rule"].tolist() == expected, (
+            "match_rules on a slice"
+        )
+
+
+@check
+def retriggered_page_keeps_its_job():
+    # the tag page's callback runs again with the same regex and tab, as when
+    # the url or debounce fires twice, and the job it started is kept
+    from bench.suite import callback
+    from tagger import page_tag
+    from tagger.jobs import job_queue
+
+    tag_page = callback(page_tag.tag_regex_page)
+    args = (r"\bschool", "", "all-charity-match", "/tag/schools")
+    job_id = tag_page(*args, None)[3]
+    assert tag_page(*args, job_id)[3] == job_id, "same regex and tab"
+    assert not job_queue.is_cancelled(job_id), "kept"
+    assert tag_page(*args[:2], "all-charity-exact", args[3], job_id)[3] != job_id, "tab changed"
+    assert job_queue.is_cancelled(job_id), "cancelled when the tab changes"
+
+
+@check
+def tag_page_stores_the_rule_cost():
+    # the page saves the cost of a rule it matched, and keeps it when the
+    # same rule comes from the cache
+    from bench.suite import callback
+    from tagger import page_tag, settings
+    from tagger.airtable_writer import airtable_writer
+    from tagger.data import get_tags_used, selection_cache
+
+    def saved():
+        tags_used = get_tags_used()
+        return tags_used.loc[tags_used["tag_slug"] == "schools"].iloc[0]
+
+    tag_page = callback(page_tag.tag_regex_page)
+    args = (r"\bschools?\b", r"\bdriving\b", "sample-match", "/tag/schools", None)
+    selection_cache.clear()
+    with patched(settings, AIRTABLE_SAVE=True), patched(page_tag, AIRTABLE_SAVE=True):
+        tag_page(*args)
+        rule = saved()
+        assert rule["cost"] > 0, "cost of a new match"
+        assert rule["Exclude regular expression"] == args[1], "exclude saved"
+        tag_page(*args)
+        assert saved()["cost"] == rule["cost"], "cost kept for a cached match"
+    # sent now, while the fake Airtable is running
+    airtable_writer.flush()
+
+
+@check
+def server_side_tables():
+    # the tables are filtered, sorted and paged by the web workers when
+    # CLIENTSIDE_TABLES is false, and the rendered rows are reused
+    import flask
+
+    from bench.suite import callback
+    from tagger import page_icnptso_all, page_tags
+    from tagger.data import get_icnptso_used, get_tags_used
+    from tagger.index import server
+    from tagger.utils import row_values
+
+    tables = [
+        ("tags", page_tags.filter_main_page, get_tags_used, "tag", page_tags.tag_row, page_tags.TAG_COLUMNS),
+        (
+            "categories",
+            page_icnptso_all.filter_icnptso_main_page,
+            get_icnptso_used,
+            "Code",
+            page_icnptso_all.category_row,
+            page_icnptso_all.CATEGORY_COLUMNS,
+        ),
+    ]
+    page_size = 5
+    for label, func, get_rules, filter_column, render_row, columns in tables:
+        table = callback(func)
+        rules = get_rules().sort_values("frequency", ascending=False)
+
+        def show(filter_value="", page=None, clicked=None):
+            with server.test_request_context():
+                if clicked:
+                    flask.g.triggered_inputs = [{"prop_id": "{}-{}.n_clicks".format(label, clicked), "value": 1}]
+                return table(filter_value, "all", "frequency", "descending", page_size, None, None, page)
+
+        rows, _, page, page_info, first_page, last_page = show()
+        assert (page, first_page, last_page) == (0, True, False), "{} first page".format(label)
+        assert page_info == "Page 1 of {}".format(-(-len(rules) // page_size)), "{} page info".format(label)
+        rows, _, page, _, first_page, _ = show(page=page, clicked="next")
+        assert (page, first_page) == (1, False), "{} next page".format(label)
+        expected = [render_row(*values) for values in row_values(rules.iloc[page_size : 2 * page_size], columns)]
+        assert len(rows) == len(expected) and all(a is b for a, b in zip(rows, expected)), (
+            "{} rows of the second page, from the row cache".format(label)
+        )
+        assert show(page=page, clicked="previous")[2] == 0, "{} previous page".format(label)
+
+        filter_value = rules[filter_column].iloc[0][:3].upper()
+        rows, _, page, _, _, _ = show(filter_value, page=1)
+        matching = rules[rules[filter_column].str.lower().str.contains(filter_value.lower(), regex=False)]
+        assert page == 0, "{} filter goes back to the first page".format(label)
+        assert len(rows) == min(len(matching), page_size), "{} filtered".format(label)
+        # not a valid regex, so matched as plain text as assets/tables.js does
+        matching = rules[rules[filter_column].str.contains("(", regex=False, na=False)]
+        assert len(show("(")[0]) == min(len(matching), page_size), "{} filtered by an invalid regex".format(label)
+
+
+@contextlib.contextmanager
+def patched(module, **values):
+    previous = {name: getattr(module, name) for name in values}
+    for name, value in values.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(module, name, value)
+
+
+def run_checks():
+    failed = 0
+    for func in CHECKS:
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                func()
+        except Exception:
+            failed += 1
+            print("FAIL {}".format(func.__name__))
+            traceback.print_exc()
+        else:
+            print("ok   {}".format(func.__name__))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2000, help="Size of the synthetic data")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # runs with DATA_DIR already set, as tagger.settings reads it on import
+        from bench.suite import initialise, start_fake_airtable
+
+        fake = start_fake_airtable(args.rows, args.seed)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                initialise()
+            failed = run_checks()
+        finally:
+            fake.stop()
+        if failed:
+            print("{} of {} checks failed".format(failed, len(CHECKS)))
+            sys.exit(1)
+        return
+
+    with tempfile.TemporaryDirectory(prefix="tagger-checks-") as data_dir:
+        result = subprocess.run(
+            [
+                sys.executable, "-m", "bench.checks", "--child",
+                "--rows", str(args.rows),
+                "--seed", str(args.seed),
+            ],
+            env=dict(os.environ, DATA_DIR=data_dir + "/"),
+        )
+    sys.exit(result.returncode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+# A local stand-in for the Airtable REST API, so fetching and saving can be
+# run and timed without touching the real base.
+#
+#   python -m bench.fake_airtable --records 2000 --latency 0.1
+#
+# then run the app or `flask data initialise` with
+# AIRTABLE_API_URL=http://127.0.0.1:8001/v0 and AIRTABLE_BASE_ID=appFAKE.
+#
+# Supports paged listing with fields[] and pageSize, the modified since
+# formula used by `flask data initialise --incremental`, fetching a single
+# record and updating records one at a time or in batches of up to 10.
+import argparse
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlparse
+
+from tagger import settings
+
+PAGE_SIZE = 100
+BATCH_SIZE = 10
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+
+
+class FakeAirtable:
+    def __init__(self, tables, base_id="appFAKE", latency=0, rate_limit=None):
+        # tables is a dict of table name: list of {"id": ..., "fields": {...}}
+        now = time.time()
+        self.tables = {
+            name: {
+                r["id"]: {"fields": dict(r["fields"]), "created": now, "modified": now}
+                for r in records
+            }
+            for name, records in tables.items()
+        }
+        self.base_id = base_id
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.requests = []
+        self._listings = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self, host="127.0.0.1", port=0):
+        # serve in a background thread, returning the API url
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return "http://{}:{}/v0".format(*self._server.server_address[:2])
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def update(self, table, record_id, fields):
+        # change a record as if it had been edited in Airtable
+        with self._lock:
+            record = self.tables[table].setdefault(
+                record_id, {"fields": {}, "created": time.time()}
+            )
+            record["fields"].update(fields)
+            record["modified"] = time.time()
+            self._listings = {}
+            return self._record(record_id, record)
+
+    def delete(self, table, record_id):
+        with self._lock:
+            self.tables[table].pop(record_id, None)
+            self._listings = {}
+
+    def list(self, table, query):
+        page_size = min(int(query.get("pageSize", [PAGE_SIZE])[0]), PAGE_SIZE)
+        offset = int(query.get("offset", [0])[0])
+        fields = query.get("fields[]")
+        since = None
+        if query.get("filterByFormula"):
+            since = self._formula_since(query["filterByFormula"][0])
+        with self._lock:
+            # the matching ids are kept between pages, so listing a big
+            # table isn't quadratic
+            key = (table, since)
+            if key not in self._listings:
+                self._listings[key] = [
+                    record_id
+                    for record_id, record in self.tables[table].items()
+                    if since is None or max(record["created"], record["modified"]) > since
+                ]
+            ids = self._listings[key]
+            records = [
+                self._record(record_id, self.tables[table][record_id], fields)
+                for record_id in ids[offset : offset + page_size]
+                if record_id in self.tables[table]
+            ]
+        page = {"records": records}
+        if offset + page_size < len(ids):
+            page["offset"] = str(offset + page_size)
+        return page
+
+    @staticmethod
+    def _record(record_id, record, fields=None):
+        return {
+            "id": record_id,
+            "fields": {
+                k: v for k, v in record["fields"].items() if not fields or k in fields
+            },
+            "createdTime": datetime.datetime.utcfromtimestamp(record["created"]).strftime(
+                TIME_FORMAT
+            ),
+        }
+
+    @staticmethod
+    def _formula_since(formula):
+        # only the formula from tagger.data.modified_since_formula is understood
+        times = re.findall(r"'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}Z)'", formula)
+        if "LAST_MODIFIED_TIME()" not in formula or not times:
+            raise ValueError("Unsupported formula")
+        return min(
+            datetime.datetime.strptime(t, TIME_FORMAT)
+            .replace(tzinfo=datetime.timezone.utc)
+            .timestamp()
+            for t in times
+        )
+
+    def _rate_limited(self):
+        if not self.rate_limit:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            recent = [t for t in self.requests if now - t < 1]
+            self.requests = recent + [now]
+            return len(recent) >= self.rate_limit
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, body):
+                data = json.dumps(body).encode("utf8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def route(self):
+                url = urlparse(self.path)
+                parts = [unquote(p) for p in url.path.strip("/").split("/")]
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake._rate_limited():
+                    return self.send(429, {"errors": [{"error": "RATE_LIMIT_REACHED"}]})
+                if len(parts) not in (3, 4) or parts[0] != "v0" or parts[1] != fake.base_id:
+                    return self.send(404, {"error": "NOT_FOUND"})
+                if parts[2] not in fake.tables:
+                    return self.send(404, {"error": "TABLE_NOT_FOUND"})
+                return parts[2], parts[3] if len(parts) == 4 else None, parse_qs(url.query)
+
+            def do_GET(self):
+                route = self.route()
+                if not route:
+                    return
+                table, record_id, query = route
+                if record_id:
+                    record = fake.tables[table].get(record_id)
+                    if record is None:
+                        return self.send(404, {"error": "NOT_FOUND"})
+                    return self.send(200, fake._record(record_id, record))
+                try:
+                    return self.send(200, fake.list(table, query))
+                except ValueError as err:
+                    return self.send(422, {"error": {"type": "INVALID_FILTER_BY_FORMULA", "message": str(err)}})
+
+            def do_PATCH(self):
+                route = self.route()
+                if not route:
+                    return
+                table, record_id, query = route
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                if record_id:
+                    return self.send(200, fake.update(table, record_id, body["fields"]))
+                if len(body.get("records", [])) > BATCH_SIZE:
+                    return self.send(422, {"error": {"type": "INVALID_RECORDS"}})
+                return self.send(200, {
+                    "records": [
+                        fake.update(table, r["id"], r["fields"]) for r in body["records"]
+                    ]
+                })
+
+        return Handler
+
+
+EXAMPLE_WORDS = (
+    "hospice palliative care children school education animal welfare church "
+    "music arts sport youth elderly housing health research cancer mental "
+    "poverty relief village hall community"
+).split()
+
+
+def example_tables(records=1000, seed=0):
+    # small made up versions of the tables used by `flask data initialise`
+    rng = random.Random(seed)
+
+    def text(n):
+        return " ".join(rng.choice(EXAMPLE_WORDS) for _ in range(n))
+
+    tags = [
+        {"id": "tag{}".format(i), "fields": {
+            "Name": word.title(),
+            "Category": word.title(),
+            "Regular expression": r"\b{}\b".format(word),
+        }}
+        for i, word in enumerate(EXAMPLE_WORDS)
+    ]
+    icnptso = [
+        {"id": "icn{}".format(i), "fields": {
+            "Code": "{}{}".format("ABCDEFGH"[i % 8], i // 8),
+            "Title": word.title(),
+            "Regular expression": word,
+        }}
+        for i, word in enumerate(EXAMPLE_WORDS)
+    ]
+    sample = [
+        {"id": "rec{}".format(i), "fields": {
+            "reg_number": str(200000 + i),
+            "name": text(3).title(),
+            "activities": text(20),
+            "objects": text(8),
+            settings.TAGS_FIELD_NAME: [t["id"] for t in rng.sample(tags, rng.randint(1, 3))],
+            settings.ICNPTSO_FIELD_NAME: [rng.choice(icnptso)["id"]],
+        }}
+        for i in range(records)
+    ]
+    return {
+        settings.AIRTABLE_TAGS_TABLE_NAME: tags,
+        settings.AIRTABLE_ICNPTSO_TABLE_NAME: icnptso,
+        settings.AIRTABLE_SAMPLE_TABLE_NAME: sample,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--tables", help="JSON file of table name: records")
+    parser.add_argument("--records", type=int, default=1000, help="Sample records to make up")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds added to each request")
+    parser.add_argument("--rate-limit", type=int, default=None, help="Requests a second before 429s")
+    args = parser.parse_args()
+    if args.tables:
+        with open(args.tables, encoding="utf8") as f:
+            tables = json.load(f)
+    else:
+        tables = example_tables(args.records)
+    fake = FakeAirtable(tables, latency=args.latency, rate_limit=args.rate_limit)
+    print("Serving fake Airtable at {}".format(fake.start(port=args.port)))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+# Time the hot paths against synthetic data (see bench/synthetic.py) at
+# several sizes and save the timings as JSON:
+#
+#   python -m bench.suite --rows 10000 100000 1000000
+#   python -m bench.suite --rows 10000 --compare bench/results/previous.json
+#
+# Each size is run in a new process with its own DATA_DIR, so nothing is
+# cached from the size before. The data is fetched from a local fake
+# Airtable by `flask data initialise`, then each stage is timed --repeat
+# times. Stages marked cold have the dataset or selection caches cleared
+# before each run. Page callbacks include serialising their output to JSON,
+# as Dash does before sending it.
+#
+# --compare prints each stage's median time against an earlier results
+# file and exits with status 1 if any stage is more than --threshold times
+# slower.
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+SIZES = [10000, 100000, 1000000]
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+# differences smaller than this are noise, however big the ratio
+NOISE_SECONDS = 0.005
+
+
+def summarise(times):
+    ordered = sorted(times)
+    middle = len(ordered) // 2
+    median = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+    return {
+        "times": times,
+        "min": ordered[0],
+        "median": median,
+        "mean": sum(times) / len(times),
+    }
+
+
+class Timer:
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.stages = {}
+
+    def time(self, stage, func, setup=None, repeat=None):
+        times = []
+        for _ in range(repeat or self.repeat):
+            if setup:
+                setup()
+            # initialise and the callbacks print progress
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                value = func()
+                times.append(time.perf_counter() - start)
+        self.stages[stage] = summarise(times)
+        print("  {:<40} {:>10.4f}s".format(stage, self.stages[stage]["median"]), flush=True)
+        return value
+
+
+def start_fake_airtable(rows, seed):
+    # writes the register and serves the Airtable tables for DATA_DIR, which
+    # must be set before tagger is imported
+    from bench.fake_airtable import FakeAirtable
+    from bench.synthetic import synthetic_tables, write_register
+    from tagger import airtable_fetch, settings
+
+    write_register(settings.ALL_CHARITIES_CSV, rows, seed)
+    fake = FakeAirtable(synthetic_tables(rows, seed), base_id="appFAKE")
+    # made a day ago, so the incremental run finds nothing has changed
+    for records in fake.tables.values():
+        for record in records.values():
+            record["created"] = record["modified"] = record["created"] - 24 * 60 * 60
+    settings.AIRTABLE_API_URL = fake.start()
+    settings.AIRTABLE_BASE_ID = "appFAKE"
+    settings.AIRTABLE_API_KEY = "keyFAKE"
+    airtable_fetch.rate_limiter = airtable_fetch.RateLimiter(None)
+    return fake
+
+
+def initialise(*options, jobs=1):
+    from flask.cli import ScriptInfo
+
+    from tagger.data import initialise_data
+    from tagger.index import server
+
+    initialise_data.main(
+        ["--jobs", str(jobs), *options],
+        standalone_mode=False,
+        obj=ScriptInfo(create_app=lambda *args: server),
+    )
+
+
+def render(value):
+    import plotly
+
+    return json.dumps(value, cls=plotly.utils.PlotlyJSONEncoder)
+
+
+def callback(func):
+    # the function behind dash's callback wrapper
+    return getattr(func, "__wrapped__", func)
+
+
+def run_size(rows, repeat, seed, jobs):
+    # runs in the child process, with DATA_DIR already set
+    from bench.synthetic import BENCH_REGEXES
+    from tagger import settings
+    from tagger.data import (
+        dataset_cache,
+        get_all_charities,
+        get_completed_data,
+        get_keyword_result,
+        get_result_summary,
+        selection_cache,
+    )
+    from tagger.jobs import job_queue, run_job
+    from tagger import page_icnptso, page_icnptso_all, page_tag, page_tags
+    from tagger.index import server
+
+    # time the matching itself, not the guard against slow patterns
+    settings.REGEX_TIME_LIMIT = 0
+    settings.REGEX_REGISTER_TIME_LIMIT = 0
+    settings.JOB_RESULT_TTL = 0
+
+    start = time.perf_counter()
+    fake = start_fake_airtable(rows, seed)
+    generate_seconds = time.perf_counter() - start
+
+    timer = Timer(repeat)
+    try:
+        timer.time("initialise", lambda: initialise(jobs=jobs), repeat=1)
+        timer.time(
+            "initialise_incremental", lambda: initialise("--incremental", jobs=jobs), repeat=1
+        )
+    finally:
+        fake.stop()
+
+    timer.time("get_completed_data_cold", get_completed_data, setup=dataset_cache.invalidate)
+    df, corpus, version = timer.time("get_completed_data", get_completed_data)
+
+    for name, (keyword_regex, exclude_regex) in BENCH_REGEXES.items():
+        result = timer.time(
+            "get_keyword_result_cold[{}]".format(name),
+            lambda: get_keyword_result(
+                keyword_regex, exclude_regex, df, corpus, tag="Hospices", version=version
+            ),
+            setup=selection_cache.clear,
+        )
+    keyword_regex, exclude_regex = BENCH_REGEXES["alternation"]
+    result = timer.time(
+        "get_keyword_result",
+        lambda: get_keyword_result(
+            keyword_regex, exclude_regex, df, corpus, tag="Schools", version=version
+        ),
+    )
+    timer.time("get_result_summary", lambda: get_result_summary(result))
+
+    for exact in (False, True):
+        timer.time(
+            "get_all_charities_cold[{}]".format("exact" if exact else "sample"),
+            lambda: get_all_charities(keyword_regex, exclude_regex, exact=exact),
+            setup=selection_cache.clear,
+        )
+
+    tag_page = callback(page_tag.tag_regex_page)
+    tag_poll = callback(page_tag.tag_job_poll)
+
+    def tag_page_all_charities():
+        output = tag_page(keyword_regex, exclude_regex, "all-charity-match", "/tag/schools", None)
+        # run the job here rather than waiting for a job runner
+        job = job_queue.claim()
+        run_job(job_queue, job)
+        return render(output) + render(tag_poll(output[3], None))
+
+    timer.time(
+        "page_tag_cold[sample-match]",
+        lambda: render(tag_page(keyword_regex, exclude_regex, "sample-match", "/tag/schools", None)),
+        setup=selection_cache.clear,
+    )
+    timer.time("page_tag_cold[all-charity-match]", tag_page_all_charities, setup=selection_cache.clear)
+    icnptso_page = callback(page_icnptso.category_regex_page)
+    timer.time(
+        "page_icnptso_cold[sample-match]",
+        lambda: render(icnptso_page(
+            None, None, "sample-match", keyword_regex, exclude_regex, "/icnptso/B21", None
+        )),
+        setup=selection_cache.clear,
+    )
+    def table_page(func):
+        # the table callbacks read dash's callback context
+        with server.test_request_context():
+            return render(callback(func)(
+                "", "all", "frequency", "descending", settings.TABLE_PAGE_SIZE, None, None, 0
+            ))
+
+    timer.time("page_tags", lambda: table_page(page_tags.filter_main_page))
+    timer.time("page_icnptso_all", lambda: table_page(page_icnptso_all.filter_icnptso_main_page))
+    # the tables sent to the browser when CLIENTSIDE_TABLES is set
+    timer.time("page_tags_table", lambda: render(callback(page_tags.tags_table)(None)))
+    timer.time("page_icnptso_all_table", lambda: render(callback(page_icnptso_all.categories_table)(None)))
+
+    return {
+        "rows": rows,
+        "generate_seconds": generate_seconds,
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "stages": timer.stages,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current, threshold):
+    # print each stage against the previous run, returning the regressions
+    regressions = []
+    print("{:>9} {:<40} {:>10} {:>10} {:>7}".format("rows", "stage", "before", "after", "ratio"))
+    for size, result in current["sizes"].items():
+        before = previous["sizes"].get(size, {}).get("stages", {})
+        for stage, timing in result["stages"].items():
+            if stage not in before:
+                continue
+            old, new = before[stage]["median"], timing["median"]
+            ratio = new / old if old else float("inf")
+            slower = ratio > threshold and new - old > NOISE_SECONDS
+            if slower:
+                regressions.append((size, stage, ratio))
+            print("{:>9} {:<40} {:>9.4f}s {:>9.4f}s {:>6.2f}x{}".format(
+                size, stage, old, new, ratio, "  SLOWER" if slower else ""
+            ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=SIZES, help="Sizes to run")
+    parser.add_argument("--repeat", type=int, default=3, help="Times to run each stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=1, help="Processes for initialise")
+    parser.add_argument("--output", help="Results file, defaults to bench/results/<time>.json")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Slowdown counted as a regression")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--child-output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        with open(args.child_output, "w", encoding="utf8") as f:
+            json.dump(run_size(args.child, args.repeat, args.seed, args.jobs), f)
+        return
+
+    import numpy as np
+    import pandas as pd
+
+    started = datetime.datetime.now()
+    results = {
+        "meta": {
+            "started": started.isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "jobs": args.jobs,
+        },
+        "sizes": {},
+    }
+    for rows in args.rows:
+        print("{:,.0f} rows".format(rows), flush=True)
+        with tempfile.TemporaryDirectory(prefix="tagger-bench-") as data_dir:
+            output = os.path.join(data_dir, "results.json")
+            subprocess.run(
+                [
+                    sys.executable, "-m", "bench.suite",
+                    "--child", str(rows),
+                    "--child-output", output,
+                    "--repeat", str(args.repeat),
+                    "--seed", str(args.seed),
+                    "--jobs", str(args.jobs),
+                ],
+                env=dict(os.environ, DATA_DIR=data_dir + "/"),
+                check=True,
+            )
+            with open(output, encoding="utf8") as f:
+                results["sizes"][str(rows)] = json.load(f)
+
+    path = args.output or os.path.join(
+        RESULTS_DIR, "{}.json".format(started.strftime("%Y%m%d-%H%M%S"))
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf8") as f:
+        json.dump(results, f, indent=2)
+    print("Saved results to {}".format(path))
+
+    if args.compare:
+        with open(args.compare, encoding="utf8") as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        if regressions:
+            print("{} stages are slower".format(len(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
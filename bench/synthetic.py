@@ -0,0 +1,183 @@
+# Made up charities for benchmarking, at any size:
+#
+#   python -m bench.synthetic /tmp/bench-data --rows 100000
+#
+# writes charities_active.csv (the register) and airtable.json (the tags,
+# ICNPTSO and labelled sample tables, for `python -m bench.fake_airtable
+# --tables`) into the directory.
+#
+# Each charity is about one or two causes. Its name and activities use that
+# cause's words mixed with common filler words, so the tags' regular
+# expressions select a realistic share of the records. The labels are right
+# most of the time, so precision and recall aren't all 0 or 100%.
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from tagger import settings
+
+# tag name: (category, ICNPTSO code, ICNPTSO title, cause words, regex, exclude regex)
+CAUSES = {
+    "Hospices": ("Health", "D11", "Hospices and palliative care", "hospice palliative end-of-life bereavement terminally ill nursing", r"\b(hospices?|palliative|end-of-life)\b", None),
+    "Cancer": ("Health", "D12", "Cancer", "cancer tumour oncology leukaemia chemotherapy screening", r"\b(cancers?|tumou?rs?|oncology|leukaemia)\b", None),
+    "Mental health": ("Health", "D13", "Mental health", "mental health wellbeing depression anxiety counselling suicide", r"\bmental health|\b(depression|anxiety|counselling)\b", None),
+    "Schools": ("Education", "B21", "Primary and secondary schools", "school pupils teachers classroom parents playground curriculum", r"\b(schools?|pupils?|classrooms?)\b", r"\bmusic"),
+    "Universities": ("Education", "B22", "Higher education", "university students research scholarships college academic", r"\b(universit(y|ies)|students?|scholarships?)\b", None),
+    "Animal welfare": ("Animals", "H31", "Animal welfare", "animal animals rescue rehoming veterinary dogs cats horses", r"\b(animals?|veterinary|rehoming)\b", None),
+    "Wildlife": ("Environment", "H32", "Wildlife conservation", "wildlife conservation habitat birds nature reserve species", r"\b(wildlife|habitats?|nature reserves?)\b", None),
+    "Churches": ("Religion", "J41", "Christian", "church parish worship christian ministry congregation chapel", r"\b(church(es)?|parish|christian|chapel)\b", None),
+    "Music": ("Arts", "A51", "Music", "music choir orchestra concerts singing musicians band", r"\b(music(al|ians?)?|choirs?|orchestras?|concerts?)\b", None),
+    "Sport": ("Sport", "A52", "Amateur sport", "sport football cricket rugby club athletics swimming", r"\b(sports?|football|cricket|rugby|athletics)\b", None),
+    "Housing": ("Housing", "F61", "Housing and homelessness", "housing homeless accommodation shelter tenants hostel", r"\b(housing|homeless(ness)?|hostels?)\b", None),
+    "Village halls": ("Community", "G71", "Community centres", "village hall community centre meeting rooms hire events", r"\bvillage halls?\b|\bcommunity cent(re|er)s?\b", None),
+}
+FILLER = (
+    "the and to of for in a local people community support provide services "
+    "help area activities promote benefit public charitable purposes including "
+    "grants individuals organisations advice information through education "
+    "relief needs within other such as by with families children young older"
+).split()
+PLACES = (
+    "Ashford Barnsley Bristol Cambridge Dorset Exeter Fife Gloucester Harrow "
+    "Ipswich Kendal Leeds Lincoln Luton Margate Norwich Oxford Preston Reading "
+    "Salford Stockport Truro Wakefield Worcester York"
+).split()
+SUFFIXES = "Trust Foundation Society Association Fund Appeal Club Group Centre Charity".split()
+
+# regexes for the benchmarks that aren't tied to one tag
+BENCH_REGEXES = {
+    "word": (r"\bhospice\b", None),
+    "alternation": (r"\b(school|pupils?|teachers?|classroom)\b", None),
+    "prefix": (r"\banimal", None),
+    "exclude": (r"\b(music|choir)\b", r"\bchurch"),
+    "common": (r"\b(the|and)\b", None),
+    "no_literals": (r"\b\w{12,}\b", None),
+}
+
+
+def _zipf(n, rng):
+    weights = 1 / np.arange(1, n + 1)
+    return weights[rng.permutation(n)] / weights.sum()
+
+
+def _texts(rng, causes, cause_words, length, cause_share):
+    # text for each row: filler words, with about cause_share of them (and
+    # at least one) swapped for words about the row's cause
+    lengths = rng.integers(length[0], length[1], size=len(causes))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    row_of = np.repeat(np.arange(len(causes)), lengths)
+    words = rng.choice(np.array(FILLER, dtype=object), size=len(row_of), p=_zipf(len(FILLER), rng))
+    is_cause = rng.random(len(row_of)) < cause_share
+    is_cause[starts + (rng.random(len(causes)) * lengths).astype(int)] = True
+    row_causes = causes[row_of[is_cause]]
+    counts = np.array([len(w) for w in cause_words])
+    table = np.array([w + [""] * (counts.max() - len(w)) for w in cause_words], dtype=object)
+    words[is_cause] = table[row_causes, (rng.random(len(row_causes)) * counts[row_causes]).astype(int)]
+    words = words.tolist()
+    return [" ".join(words[start:end]) for start, end in zip(starts, ends)]
+
+
+def synthetic_charities(rows, seed=0, first_reg_number=10000000):
+    # a frame with the columns of charities_active.csv
+    rng = np.random.default_rng(seed)
+    names = list(CAUSES)
+    cause_words = [CAUSES[name][3].split() for name in names]
+    causes = rng.choice(len(names), size=rows, p=_zipf(len(names), rng))
+    cause_titles = [words[0].title() for words in cause_words]
+    df = pd.DataFrame({
+        "reg_number": np.arange(first_reg_number, first_reg_number + rows).astype(str),
+        "name": [
+            " ".join(parts)
+            for parts in zip(
+                rng.choice(PLACES, size=rows),
+                [cause_titles[c] for c in causes],
+                rng.choice(SUFFIXES, size=rows),
+            )
+        ],
+        "activities": _texts(rng, causes, cause_words, (10, 40), 0.15),
+        "objects": _texts(rng, causes, cause_words, (5, 15), 0.2),
+        "source": rng.choice(["ccew", "oscr", "ccni"], size=rows, p=[0.85, 0.1, 0.05]),
+        "income": np.round(rng.lognormal(10.5, 2.2, size=rows), 2),
+    })
+    # some charities haven't filed, or only have their objects
+    df.loc[rng.random(rows) < 0.05, "income"] = np.nan
+    df.loc[rng.random(rows) < 0.05, "activities"] = np.nan
+    df.attrs["causes"] = causes
+    return df
+
+
+def synthetic_tables(rows, seed=0):
+    # the Airtable tables read by `flask data initialise`, with `rows`
+    # labelled sample records
+    rng = np.random.default_rng(seed + 1)
+    tags = []
+    icnptso = []
+    for i, (name, (category, code, title, _, regex, exclude)) in enumerate(CAUSES.items()):
+        tag = {"Name": name, "Category": category, "Subcategory": title, "Regular expression": regex}
+        if exclude:
+            tag["Exclude regular expression"] = exclude
+        tags.append({"id": "rectag{:04d}".format(i), "fields": tag})
+        icnptso.append({"id": "recicn{:04d}".format(i), "fields": {
+            "Code": code, "Title": title, "Regular expression": regex,
+        }})
+    tags.append({"id": "rectagunused", "fields": {
+        "Name": "Old tag", "Category": "Other", "Subcategory": "Other", "Not used (describe why)": "Merged",
+    }})
+
+    charities = synthetic_charities(rows, seed, first_reg_number=100000)
+    causes = charities.attrs["causes"]
+    second = rng.choice(len(CAUSES), size=rows)
+    has_second = rng.random(rows) < 0.3
+    # one label in ten is wrong
+    wrong = rng.random(rows) < 0.1
+    primary = np.where(wrong, rng.choice(len(CAUSES), size=rows), causes)
+    sample = []
+    for i, row in enumerate(charities.itertuples(index=False)):
+        labels = [tags[primary[i]]["id"]]
+        if has_second[i] and second[i] != primary[i]:
+            labels.append(tags[second[i]]["id"])
+        fields = {
+            "reg_number": row.reg_number,
+            "name": row.name,
+            # the labelled records always have activities, which the pages expect
+            "activities": row.activities if isinstance(row.activities, str) else row.objects,
+            "objects": row.objects,
+            settings.TAGS_FIELD_NAME: labels,
+            settings.ICNPTSO_FIELD_NAME: [icnptso[primary[i]]["id"]],
+        }
+        sample.append({"id": "recsample{:07d}".format(i), "fields": fields})
+    return {
+        settings.AIRTABLE_TAGS_TABLE_NAME: tags,
+        settings.AIRTABLE_ICNPTSO_TABLE_NAME: icnptso,
+        settings.AIRTABLE_SAMPLE_TABLE_NAME: sample,
+    }
+
+
+def write_register(path, rows, seed=0):
+    synthetic_charities(rows, seed).to_csv(path, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_dir")
+    parser.add_argument("--rows", type=int, default=10000, help="Charities on the register")
+    parser.add_argument("--sample", type=int, default=None, help="Labelled records, defaults to --rows")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    write_register(os.path.join(args.data_dir, "charities_active.csv"), args.rows, args.seed)
+    tables = synthetic_tables(args.sample or args.rows, args.seed)
+    with open(os.path.join(args.data_dir, "airtable.json"), "w", encoding="utf8") as f:
+        json.dump(tables, f)
+    print("Wrote {:,.0f} charities and {:,.0f} labelled records to {}".format(
+        args.rows, len(tables[settings.AIRTABLE_SAMPLE_TABLE_NAME]), args.data_dir
+    ))
+
+
+if __name__ == "__main__":
+    main()
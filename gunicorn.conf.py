@@ -0,0 +1,36 @@
+# gunicorn reads this file from the working directory on startup
+import gc
+
+from tagger import settings
+from tagger.utils import memory_report
+
+preload_app = settings.PRELOAD_DATA
+
+
+def when_ready(server):
+    if not settings.PRELOAD_DATA:
+        return
+    from tagger.data import preload_datasets
+
+    server.log.info(memory_report("master before preload"))
+    loaded = preload_datasets()
+    # Move everything loaded so far out of the garbage collector's view.
+    # Otherwise a collection in a worker writes to every object's header and
+    # the pages shared with the master get copied.
+    gc.collect()
+    gc.freeze()
+    server.log.info("preloaded {} datasets".format(len(loaded)))
+    server.log.info(memory_report("master after preload"))
+
+
+def post_fork(server, worker):
+    server.log.info(memory_report("worker {} after fork".format(worker.pid)))
+
+
+def post_worker_init(worker):
+    worker.log.info(memory_report("worker {} ready".format(worker.pid)))
+    if settings.AIRTABLE_SAVE:
+        # send any edits left from before a restart
+        from tagger.airtable_writer import airtable_writer
+
+        airtable_writer.start()
@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from tagger import settings
+
+AIRTABLE_PAGE_SIZE = 100
+
+# rate limits and server errors are retried with exponential backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+# Spaces out requests across threads so the base's rate limit isn't hit -
+# Airtable allows 5 requests a second and makes you wait 30 seconds after
+# going over.
+class RateLimiter:
+    def __init__(self, per_second):
+        self.interval = 1 / per_second if per_second else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+rate_limiter = RateLimiter(settings.AIRTABLE_REQUESTS_PER_SECOND)
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    # one session per process, so connections are pooled across fetches
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=settings.AIRTABLE_RETRIES,
+                backoff_factor=settings.AIRTABLE_BACKOFF,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset(["GET", "PATCH"]),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=settings.AIRTABLE_MAX_CONNECTIONS,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Authorization"] = "Bearer {}".format(settings.AIRTABLE_API_KEY)
+            _session = session
+    return _session
+
+
+def table_url(table_name, record_id=None):
+    url = "{}/{}/{}".format(
+        settings.AIRTABLE_API_URL.rstrip("/"),
+        settings.AIRTABLE_BASE_ID,
+        quote(table_name, safe=""),
+    )
+    if record_id:
+        url += "/" + record_id
+    return url
+
+
+def request(method, url, **kwargs):
+    rate_limiter.wait()
+    response = get_session().request(
+        method, url, timeout=settings.AIRTABLE_TIMEOUT, **kwargs
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def iter_pages(table_name, fields=None, formula=None):
+    # each page of records as it arrives
+    params = {"pageSize": AIRTABLE_PAGE_SIZE}
+    if fields:
+        params["fields[]"] = fields
+    if formula:
+        params["filterByFormula"] = formula
+    url = table_url(table_name)
+    while True:
+        data = request("GET", url, params=params)
+        yield data.get("records", [])
+        if not data.get("offset"):
+            break
+        params["offset"] = data["offset"]
+
+
+def fetch_table(table_name, fields=None, formula=None):
+    records = []
+    for page in iter_pages(table_name, fields=fields, formula=formula):
+        records.extend(page)
+    return records
+
+
+def fetch_record(table_name, record_id):
+    return request("GET", table_url(table_name, record_id))
+
+
+def fetch_tables(queries):
+    # Fetch several tables at once over the shared session. Takes a dict of
+    # name: (table name, fetch_table keyword arguments) and returns a dict
+    # of name: records.
+    if not queries:
+        return {}
+    with ThreadPoolExecutor(
+        max_workers=min(len(queries), settings.AIRTABLE_MAX_CONNECTIONS)
+    ) as executor:
+        futures = {
+            name: executor.submit(fetch_table, table_name, **options)
+            for name, (table_name, options) in queries.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def update_records(table_name, records):
+    # records is a list of {"id": ..., "fields": {...}}, at most 10 at a time
+    return request("PATCH", table_url(table_name), json={"records": records})
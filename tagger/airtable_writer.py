@@ -0,0 +1,212 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+import requests
+
+from tagger import settings
+from tagger.airtable_fetch import update_records
+from tagger.localdb import LocalDatabase
+
+AIRTABLE_BATCH_SIZE = 10
+
+
+# Edits waiting to be sent to Airtable. Kept in SQLite so they survive a
+# restart and are shared by every worker. There is one row per record, so
+# later edits to a record are merged into the pending one.
+#
+# A sender claims rows for a while before sending them, so two workers
+# can't send different versions of a record out of order. A row is only
+# removed once the version that was sent is still the latest one.
+#
+# Airtable refusing a record (a 4xx other than 429) won't change by trying
+# again, so the row is dropped and logged. Other errors from Airtable are
+# counted, and the row is given up on after AIRTABLE_WRITE_ATTEMPTS.
+class WriteQueue:
+    def __init__(self, path):
+        self.db = LocalDatabase(
+            path,
+            """CREATE TABLE IF NOT EXISTS pending_writes (
+                table_name TEXT NOT NULL,
+                record_id TEXT NOT NULL,
+                fields TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                claimed_until REAL NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (table_name, record_id)
+            );""",
+        )
+
+    def put(self, table_name, record_id, fields):
+        with self.db.transaction() as conn:
+            row = conn.execute(
+                "SELECT fields FROM pending_writes WHERE table_name = ? AND record_id = ?",
+                (table_name, record_id),
+            ).fetchone()
+            if row:
+                conn.execute(
+                    """UPDATE pending_writes SET fields = ?, version = version + 1
+                    WHERE table_name = ? AND record_id = ?""",
+                    (json.dumps({**json.loads(row[0]), **fields}), table_name, record_id),
+                )
+            else:
+                conn.execute(
+                    """INSERT INTO pending_writes (table_name, record_id, fields, version)
+                    VALUES (?, ?, ?, 1)""",
+                    (table_name, record_id, json.dumps(fields)),
+                )
+
+    def claim(self, limit, lease):
+        # the oldest writes that nobody else is sending
+        now = time.time()
+        with self.db.transaction() as conn:
+            rows = conn.execute(
+                """SELECT table_name, record_id, fields, version FROM pending_writes
+                WHERE claimed_until < ? ORDER BY rowid LIMIT ?""",
+                (now, limit),
+            ).fetchall()
+            conn.executemany(
+                """UPDATE pending_writes SET claimed_until = ?
+                WHERE table_name = ? AND record_id = ?""",
+                [(now + lease, r[0], r[1]) for r in rows],
+            )
+        return [(r[0], r[1], json.loads(r[2]), r[3]) for r in rows]
+
+    def done(self, rows):
+        # remove what was sent, unless it has been edited again since
+        with self.db.transaction() as conn:
+            conn.executemany(
+                """DELETE FROM pending_writes
+                WHERE table_name = ? AND record_id = ? AND version = ?""",
+                [(r[0], r[1], r[3]) for r in rows],
+            )
+        self.release(rows)
+
+    def failed(self, rows):
+        # count an attempt, leaving the rows claimed so they are tried again
+        # once the lease runs out rather than straight away
+        with self.db.transaction() as conn:
+            conn.executemany(
+                """UPDATE pending_writes SET attempts = attempts + 1
+                WHERE table_name = ? AND record_id = ?""",
+                [(r[0], r[1]) for r in rows],
+            )
+            given_up = [
+                r
+                for r in rows
+                if conn.execute(
+                    """SELECT attempts FROM pending_writes
+                    WHERE table_name = ? AND record_id = ?""",
+                    (r[0], r[1]),
+                ).fetchone()[0]
+                >= settings.AIRTABLE_WRITE_ATTEMPTS
+            ]
+        if given_up:
+            self.drop(given_up, "no more attempts")
+
+    def drop(self, rows, reason):
+        for r in rows:
+            print(
+                "Dropping edit to {} record {} ({}): {}".format(
+                    r[0], r[1], reason, json.dumps(r[2])
+                )
+            )
+        self.done(rows)
+
+    def release(self, rows):
+        self.db.connect().executemany(
+            """UPDATE pending_writes SET claimed_until = 0
+            WHERE table_name = ? AND record_id = ?""",
+            [(r[0], r[1]) for r in rows],
+        )
+
+    def __len__(self):
+        return self.db.connect().execute("SELECT COUNT(*) FROM pending_writes").fetchone()[0]
+
+
+# Sends the queued edits from a background thread every few seconds, so the
+# callbacks don't wait on Airtable. Edits made within the interval are
+# coalesced and sent in batches.
+class AirtableWriter:
+    def __init__(self, queue, interval=settings.AIRTABLE_WRITE_INTERVAL):
+        self.queue = queue
+        self.interval = interval
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+
+    def start(self):
+        # threads don't survive a fork, so each worker starts its own
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="airtable-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        # send everything that's pending, returning the number of records
+        sent = 0
+        while True:
+            rows = self.queue.claim(
+                AIRTABLE_BATCH_SIZE * settings.AIRTABLE_MAX_CONNECTIONS,
+                settings.AIRTABLE_WRITE_LEASE,
+            )
+            if not rows:
+                return sent
+            for table_name in {r[0] for r in rows}:
+                table_rows = [r for r in rows if r[0] == table_name]
+                for i in range(0, len(table_rows), AIRTABLE_BATCH_SIZE):
+                    batch = table_rows[i : i + AIRTABLE_BATCH_SIZE]
+                    try:
+                        sent += self.send(table_name, batch)
+                    except requests.RequestException as err:
+                        # Airtable can't be reached, so the rest would fail
+                        # too - left in the queue to try again next time
+                        print("Error saving to Airtable: {}".format(err))
+                        self.queue.release(rows)
+                        return sent
+                    rows = [r for r in rows if r not in batch]
+
+    def send(self, table_name, batch):
+        # returns the number of records saved
+        try:
+            update_records(table_name, [{"id": r[1], "fields": r[2]} for r in batch])
+        except requests.HTTPError as err:
+            status = err.response.status_code if err.response is not None else None
+            if status is None or status == 429 or status >= 500:
+                print("Error saving to Airtable: {}".format(err))
+                self.queue.failed(batch)
+                return 0
+            if len(batch) > 1:
+                # one bad record fails the whole batch, so find which
+                return sum(self.send(table_name, [r]) for r in batch)
+            self.queue.drop(batch, "rejected by Airtable: {}".format(err))
+            return 0
+        self.queue.done(batch)
+        return len(batch)
+
+
+write_queue = WriteQueue(settings.AIRTABLE_WRITE_QUEUE)
+airtable_writer = AirtableWriter(write_queue)
+
+
+def queue_airtable_update(table_name, record_id, fields):
+    write_queue.put(table_name, record_id, fields)
+    airtable_writer.start()
+
+
+@atexit.register
+def _flush_on_exit():
+    if airtable_writer._thread is not None and airtable_writer._pid == os.getpid():
+        airtable_writer.stop()
+        airtable_writer.flush()
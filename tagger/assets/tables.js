@@ -0,0 +1,219 @@
+// Filtering, sorting and paging for the tags and ICNPTSO tables, so they
+// don't go back to the server. The table is sent once by table_data in
+// tagger/utils.py, and this builds the same rows and stats as
+// filter_main_page and filter_icnptso_main_page.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    tables: {
+        filter_table: function (filter_value, show_rows, order_by, direction, page_size, _, __, table, page) {
+            if (!table) {
+                return [[], [], 0, "", true, true];
+            }
+            var column = {};
+            table.columns.forEach(function (name, i) {
+                column[name] = i;
+            });
+            var regex = column["Regular expression"];
+
+            var rows = table.rows.map(function (row, i) {
+                return {values: row, position: i};
+            });
+            if (show_rows === "with") {
+                rows = rows.filter(function (row) { return row.values[regex] !== null; });
+            } else if (show_rows === "without") {
+                rows = rows.filter(function (row) { return row.values[regex] === null; });
+            }
+            if (filter_value) {
+                rows = rows.filter(matcher(filter_value, column.filter));
+            }
+
+            // the rows are already in the default order
+            var sort_by = ["frequency", "f1score", "precision", "recall", "cost"].indexOf(order_by) === -1
+                ? null : column[order_by];
+            var sign = direction === "ascending" ? 1 : -1;
+            rows.sort(function (a, b) {
+                if (sort_by !== null) {
+                    var x = a.values[sort_by], y = b.values[sort_by];
+                    // missing values go last in the default order, whichever the
+                    // direction, like pandas
+                    if (x === null && y === null) { return a.position - b.position; }
+                    if (x === null) { return 1; }
+                    if (y === null) { return -1; }
+                    if (x !== y) { return x < y ? -sign : sign; }
+                }
+                return sign * (a.position - b.position);
+            });
+
+            var pages = page_size ? Math.max(Math.ceil(rows.length / page_size), 1) : 1;
+            page = nextPage(page);
+            page = Math.min(Math.max(page, 0), pages - 1);
+            var page_rows = page_size ? rows.slice(page * page_size, (page + 1) * page_size) : rows;
+
+            return [
+                page_rows.map(function (row) { return tableRow(row.values, column); }),
+                tableStats(table, column, rows.length),
+                page,
+                "Page " + formatNumber(page + 1) + " of " + formatNumber(pages),
+                page === 0,
+                page === pages - 1,
+            ];
+        },
+    },
+});
+
+
+function component(type, props, namespace) {
+    return {type: type, namespace: namespace || "dash_html_components", props: props};
+}
+
+
+function matcher(filter_value, i) {
+    // a regular expression like pandas' str.contains, or plain text if it
+    // isn't one
+    var pattern;
+    try {
+        pattern = new RegExp(filter_value, "i");
+    } catch (e) {
+        var text = filter_value.toLowerCase();
+        return function (row) {
+            return row.values[i] !== null && String(row.values[i]).toLowerCase().indexOf(text) !== -1;
+        };
+    }
+    return function (row) {
+        return row.values[i] !== null && pattern.test(row.values[i]);
+    };
+}
+
+
+function nextPage(page) {
+    // see get_table_page in tagger/utils.py
+    var triggered = (dash_clientside.callback_context.triggered || []).map(function (t) { return t.prop_id; });
+    var clicked = function (suffix) {
+        return triggered.some(function (t) { return t.slice(-suffix.length) === suffix; });
+    };
+    if (clicked("-previous.n_clicks")) {
+        return (page || 0) - 1;
+    } else if (clicked("-next.n_clicks")) {
+        return (page || 0) + 1;
+    }
+    return 0;
+}
+
+
+function formatNumber(value, digits) {
+    return value.toLocaleString("en-GB", {minimumFractionDigits: digits || 0, maximumFractionDigits: digits || 0});
+}
+
+
+function formatPercent(value) {
+    return value === null ? "nan%" : Math.round(value * 100) + "%";
+}
+
+
+function statColour(stat) {
+    if (!stat) {
+        return "";
+    }
+    if (stat > 0.75) {
+        return "bg-washed-green dark-green";
+    } else if (stat > 0.5) {
+        return "bg-washed-yellow orange";
+    }
+    return "bg-washed-red dark-red";
+}
+
+
+function statCell(value) {
+    var className = "pv2 ph3 tr ";
+    if (value === null) {
+        return component("Td", {children: "-", className: className});
+    }
+    return component("Td", {children: formatPercent(value), className: className + statColour(value)});
+}
+
+
+function costColour(cost) {
+    if (cost === null) {
+        return "";
+    }
+    if (cost > 1) {
+        return "bg-washed-red dark-red";
+    } else if (cost > 0.1) {
+        return "bg-washed-yellow orange";
+    }
+    return "";
+}
+
+
+function formatCost(cost) {
+    if (cost === null) {
+        return "-";
+    }
+    if (cost < 0.01) {
+        return formatNumber(cost * 1000, 1) + "ms";
+    }
+    if (cost < 1) {
+        return formatNumber(cost * 1000) + "ms";
+    }
+    return formatNumber(cost, 1) + "s";
+}
+
+
+function tableRow(values, column) {
+    var exclude = values[column["Exclude regular expression"]];
+    var regex = [component("Code", {children: values[column["Regular expression"]]})];
+    if (exclude !== null) {
+        regex.push(component("Br", {}));
+        regex.push(component("Code", {children: exclude, className: "red strike"}));
+    }
+    var cost = values[column.cost];
+    return component("Tr", {
+        children: [
+            component("Td", {
+                children: component("Link", {
+                    children: values[column.name],
+                    href: values[column.href],
+                }, "dash_core_components"),
+                className: "pv2 ph3",
+            }),
+            component("Td", {children: regex, className: "pv2 ph3 mw6", style: {"word-break": "break-word"}}),
+            statCell(values[column.f1score]),
+            statCell(values[column.precision]),
+            statCell(values[column.recall]),
+            component("Td", {children: values[column.frequency], className: "pv2 ph3 tr"}),
+            component("Td", {children: formatCost(cost), className: "pv2 ph3 tr " + costColour(cost)}),
+        ],
+        className: "striped--near-white",
+    });
+}
+
+
+function median(values) {
+    values = values.filter(function (v) { return v !== null; }).sort(function (a, b) { return a - b; });
+    if (!values.length) {
+        return null;
+    }
+    var middle = Math.floor(values.length / 2);
+    return values.length % 2 ? values[middle] : (values[middle - 1] + values[middle]) / 2;
+}
+
+
+function tableStats(table, column, showing) {
+    var values = function (name) {
+        return table.rows.map(function (row) { return row[column[name]]; });
+    };
+    var with_regex = values("Regular expression").filter(function (v) { return v !== null; }).length;
+    var item = function (text) { return component("Li", {children: [text]}); };
+    return [
+        component("Ul", {
+            children: [
+                item("Showing " + formatNumber(showing) + " of " + formatNumber(table.rows.length) + " " + table.label),
+                item(formatNumber(with_regex) + " have regular expressions"),
+                item(formatNumber(table.rows.length - with_regex) + " need regular expressions"),
+                item("Median F1 score: " + formatPercent(median(values("f1score")))),
+                item("Median precision: " + formatPercent(median(values("precision")))),
+                item("Median recall: " + formatPercent(median(values("recall")))),
+            ],
+            className: "list ma0 pa0",
+        }),
+    ];
+}
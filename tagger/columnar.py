@@ -0,0 +1,473 @@
+import glob
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+# Columnar on-disk format for the prepared datasets.
+#
+# Each dataset is a directory of .npy arrays plus a meta.json manifest. The
+# arrays are memory-mapped copy-on-write when read, so numeric data is shared
+# between processes through the page cache until something writes to it
+# (pandas 1.2 can't work with read-only buffers). Strings are stored as one
+# UTF-8 buffer with byte offsets rather than as pickled python objects.
+# Frames' string columns are decoded into python strings when they're read,
+# which each process then has its own copy of once it touches them, but a
+# series of strings (the match corpora) is read as a StringColumn that
+# leaves the text in the shared buffer.
+#
+# A dataset is written to a directory named after its content hash and the
+# dataset path is a symlink that is swapped atomically once it is complete.
+# The version before is kept for processes that are still reading it, eg
+# the running web app while a new release prepares the data.
+
+FORMAT_VERSION = 1
+MANIFEST = "meta.json"
+STRING_ENCODING = "utf-8"
+STRING_ERRORS = "surrogatepass"
+
+
+def manifest_path(path):
+    return os.path.join(path, MANIFEST)
+
+
+def write_bundle(path, arrays, meta):
+    digest = hashlib.sha1(json.dumps(meta, sort_keys=True).encode("utf8"))
+    for name in sorted(arrays):
+        digest.update(name.encode("utf8"))
+        digest.update(_array_bytes(arrays[name]))
+    meta = dict(meta, format=FORMAT_VERSION, digest=digest.hexdigest())
+
+    target = "{}.{}".format(path, meta["digest"][:16])
+    if not os.path.isdir(target):
+        tmp = "{}.tmp-{}".format(target, os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, values in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), values, allow_pickle=False)
+        finish_version(tmp, target, meta)
+    link_version(path, target)
+
+
+def finish_version(tmp, target, meta):
+    # add the manifest to a directory of arrays and move it into place
+    with open(manifest_path(tmp), "w", encoding="utf8") as f:
+        json.dump(meta, f)
+    if os.path.isdir(target):
+        shutil.rmtree(tmp)
+    else:
+        os.rename(tmp, target)
+
+
+def link_version(path, target):
+    # point the dataset at a version
+    previous = os.readlink(path) if os.path.islink(path) else None
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    link = "{}.link-{}".format(path, os.getpid())
+    os.symlink(os.path.basename(target), link)
+    os.replace(link, path)
+
+    # remove the versions before the previous one
+    keep = {os.path.basename(target), os.path.basename(previous or "")}
+    for old in bundle_versions(path):
+        if os.path.basename(old) not in keep:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def bundle_versions(path):
+    return [
+        version
+        for version in glob.glob(glob.escape(path) + ".*")
+        if re.fullmatch(r"[0-9a-f]{16}", version[len(path) + 1:])
+    ]
+
+
+def read_manifest(path):
+    with open(manifest_path(path), encoding="utf8") as f:
+        meta = json.load(f)
+    if meta.get("format") != FORMAT_VERSION:
+        raise ValueError("Unsupported dataset format in {}".format(path))
+    return meta
+
+
+def read_bundle(path):
+    # everything is read from the version the link points to now, in case
+    # it's swapped part way through
+    path = os.path.realpath(path)
+    meta = read_manifest(path)
+    arrays = {
+        name[:-4]: np.load(os.path.join(path, name), mmap_mode="c", allow_pickle=False)
+        for name in os.listdir(path)
+        if name.endswith(".npy")
+    }
+    return arrays, meta
+
+
+# Saves a frame or series in the same format as save_columns a chunk at a
+# time, for data too big to hold in memory at once. Each chunk's values are
+# added to the end of a file for each array, and close() turns the files
+# into the dataset. It takes string, numpy and category columns, and the
+# chunks' indexes must carry on a range index from 0.
+class ColumnsWriter:
+    def __init__(self, path):
+        self.path = path
+        self.tmp = "{}.chunks-{}".format(path, os.getpid())
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        os.makedirs(self.tmp)
+        self.meta = None
+        self.rows = 0
+        # array name: [dtype, length]
+        self.arrays = {}
+        # bytes of text written so far, by string column
+        self.text_bytes = {}
+        # {category: code}, by category column
+        self.categories = {}
+
+    def append(self, data):
+        is_series = isinstance(data, pd.Series)
+        frame = data.to_frame() if is_series else data
+        if not frame.index.equals(pd.RangeIndex(self.rows, self.rows + len(frame))):
+            raise ValueError("Chunks must carry on a range index")
+        if self.meta is None:
+            self.meta = {
+                "type": "series" if is_series else "frame",
+                "name": _json_scalar(data.name) if is_series else None,
+                "columns": [str(c) if not isinstance(c, (int, float)) else c for c in frame.columns],
+                "values": [
+                    {"name": None, "kind": _chunk_kind(frame.iloc[:, i]), "prefix": "c{}".format(i)}
+                    for i in range(frame.shape[1])
+                ],
+            }
+        for i, meta in enumerate(self.meta["values"]):
+            self._append_values(frame.iloc[:, i], meta)
+        self.rows += len(frame)
+
+    def _append_values(self, values, meta):
+        prefix = meta["prefix"]
+        if meta["kind"] == "category":
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                raise ValueError("Column {} isn't a category in every chunk".format(prefix))
+            meta.setdefault("ordered", bool(values.dtype.ordered))
+            codes = self.categories.setdefault(prefix, {})
+            # this chunk's codes for the categories seen so far
+            mapping = np.array(
+                [codes.setdefault(c, len(codes)) for c in values.cat.categories] + [-1],
+                dtype=np.int32,
+            )
+            self._write(prefix, mapping[np.asarray(values.cat.codes)])
+        elif meta["kind"] == "numpy":
+            self._write(prefix, np.asarray(values))
+        else:
+            if not _is_string_values(values):
+                raise ValueError("Column {} isn't strings in every chunk".format(prefix))
+            text, offsets, nulls = encode_strings(values)
+            self._write(prefix, text)
+            self._write(prefix + "_offsets", offsets[:-1] + self.text_bytes.get(prefix, 0))
+            self._write(prefix + "_nulls", nulls)
+            self.text_bytes[prefix] = self.text_bytes.get(prefix, 0) + int(offsets[-1])
+            if nulls.any():
+                if meta.setdefault("null", _null_kind(values)) != _null_kind(values):
+                    raise ValueError("Column {} has different missing values in each chunk".format(prefix))
+
+    def _write(self, name, values):
+        dtype, length = self.arrays.setdefault(name, [values.dtype, 0])
+        if values.dtype != dtype:
+            raise ValueError("Array {} changes from {} to {}".format(name, dtype, values.dtype))
+        with open(os.path.join(self.tmp, name + ".raw"), "ab") as f:
+            np.ascontiguousarray(values).tofile(f)
+        self.arrays[name][1] += len(values)
+
+    def close(self):
+        if self.meta is None:
+            raise ValueError("Nothing was added to {}".format(self.path))
+        # the end of each string column's last value
+        for prefix, text_bytes in self.text_bytes.items():
+            self._write(prefix + "_offsets", np.array([text_bytes], dtype=np.int64))
+        arrays = {}
+        for meta in self.meta["values"]:
+            if meta["kind"] == "string":
+                meta.setdefault("null", "nan")
+            elif meta["kind"] == "category":
+                categories = list(self.categories.get(meta["prefix"], {}))
+                meta.update(
+                    categories=_save_values(
+                        pd.Series(categories, dtype=object), meta["prefix"] + "_categories", arrays
+                    ),
+                )
+        meta = dict(
+            self.meta,
+            index={"name": None, "kind": "range", "range": [0, self.rows, 1], "prefix": "index"},
+        )
+
+        # the same digest write_bundle would give the arrays
+        digest = hashlib.sha1(json.dumps(meta, sort_keys=True).encode("utf8"))
+        tmp = os.path.join(self.tmp, "bundle")
+        os.makedirs(tmp)
+        for name in sorted(set(arrays) | set(self.arrays)):
+            digest.update(name.encode("utf8"))
+            if name in arrays:
+                digest.update(_array_bytes(arrays[name]))
+                np.save(os.path.join(tmp, name + ".npy"), arrays[name], allow_pickle=False)
+                continue
+            dtype, length = self.arrays[name]
+            with open(os.path.join(tmp, name + ".npy"), "wb") as f:
+                np.lib.format.write_array_header_1_0(f, {
+                    "descr": np.lib.format.dtype_to_descr(dtype),
+                    "fortran_order": False,
+                    "shape": (length,),
+                })
+                with open(os.path.join(self.tmp, name + ".raw"), "rb") as raw:
+                    for block in iter(lambda: raw.read(1024 * 1024), b""):
+                        digest.update(block)
+                        f.write(block)
+        meta = dict(meta, format=FORMAT_VERSION, digest=digest.hexdigest())
+        target = "{}.{}".format(self.path, meta["digest"][:16])
+        finish_version(tmp, target, meta)
+        link_version(self.path, target)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def _chunk_kind(values):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return "category"
+    if isinstance(values.dtype, np.dtype) and values.dtype.kind in "biufc":
+        return "numpy"
+    if _is_string_values(values):
+        return "string"
+    raise ValueError("Can't save {} values a chunk at a time".format(values.dtype))
+
+
+def encode_strings(values):
+    values = list(values)
+    nulls = [not isinstance(v, str) for v in values]
+    encoded = [
+        b"" if null else v.encode(STRING_ENCODING, STRING_ERRORS) for v, null in zip(values, nulls)
+    ]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets, np.array(nulls, dtype=bool)
+
+
+def decode_strings(text, offsets, nulls, null_value=None):
+    decoded = str(memoryview(text), STRING_ENCODING, STRING_ERRORS) if len(text) else ""
+    offsets = offsets.tolist()
+    values = np.empty(len(offsets) - 1, dtype=object)
+    if len(decoded) == len(text):
+        # all ASCII, so the byte offsets are character offsets too
+        values[:] = [decoded[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    else:
+        values[:] = _decode_slices(text, offsets[:-1], offsets[1:])
+    values[np.asarray(nulls)] = null_value
+    return values
+
+
+def _decode_slices(text, starts, ends):
+    text = memoryview(text)
+    return [str(text[start:end], STRING_ENCODING, STRING_ERRORS) for start, end in zip(starts, ends)]
+
+
+# A series of strings read from a dataset without decoding it. The text
+# stays in the memory-mapped buffer shared with the other processes, and
+# the values are decoded each time they're asked for, so only the records
+# being searched become python strings, and only for as long as they're
+# needed.
+class StringColumn:
+    def __init__(self, text, offsets, nulls, index, name=None, null_value=None):
+        self.text = text
+        self.offsets = offsets
+        self.nulls = nulls
+        self.index = index
+        self.name = name
+        self.null_value = null_value
+
+    @classmethod
+    def load(cls, path):
+        arrays, meta = read_bundle(path)
+        values = meta["values"][0]
+        prefix = values["prefix"]
+        return cls(
+            arrays[prefix],
+            arrays[prefix + "_offsets"],
+            arrays[prefix + "_nulls"],
+            _load_index(meta, arrays),
+            name=meta["name"],
+            null_value=np.nan if values["null"] == "nan" else None,
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def values(self, positions=None):
+        # the strings at positions, or all of them, as an object array
+        if positions is None:
+            return decode_strings(self.text, self.offsets, self.nulls, self.null_value)
+        positions = np.asarray(positions, dtype=np.int64)
+        values = np.empty(len(positions), dtype=object)
+        values[:] = _decode_slices(
+            self.text, self.offsets[positions].tolist(), self.offsets[positions + 1].tolist()
+        )
+        values[np.asarray(self.nulls)[positions]] = self.null_value
+        return values
+
+    def to_series(self):
+        return pd.Series(self.values(), index=self.index, name=self.name)
+
+
+def is_string_series(meta):
+    return meta["type"] == "series" and meta["values"][0]["kind"] == "string"
+
+
+def save_columns(data, path):
+    is_series = isinstance(data, pd.Series)
+    frame = data.to_frame() if is_series else data
+    arrays = {}
+    meta = {
+        "type": "series" if is_series else "frame",
+        "name": _json_scalar(data.name) if is_series else None,
+        "columns": [str(c) if not isinstance(c, (int, float)) else c for c in frame.columns],
+        "index": _save_values(frame.index, "index", arrays),
+        "values": [
+            _save_values(frame.iloc[:, i], "c{}".format(i), arrays)
+            for i in range(frame.shape[1])
+        ],
+    }
+    write_bundle(path, arrays, meta)
+
+
+def load_columns(path):
+    arrays, meta = read_bundle(path)
+    index = _load_index(meta, arrays)
+    values = [_load_values(m, arrays) for m in meta["values"]]
+    if meta["type"] == "series":
+        return pd.Series(values[0], index=index, name=meta["name"], copy=False)
+    # built with integer column keys, as the names may not be unique
+    frame = pd.DataFrame(dict(enumerate(values)), index=index, copy=False)
+    frame.columns = meta["columns"]
+    return frame
+
+
+def _load_index(meta, arrays):
+    if meta["index"]["kind"] == "range":
+        index = pd.RangeIndex(*meta["index"]["range"])
+    else:
+        index = pd.Index(_load_values(meta["index"], arrays))
+    index.name = meta["index"]["name"]
+    return index
+
+
+def _save_values(values, prefix, arrays):
+    meta = {"name": _json_scalar(values.name) if isinstance(values, pd.Index) else None}
+    dtype = values.dtype
+    if isinstance(values, pd.RangeIndex):
+        meta.update(kind="range", range=[values.start, values.stop, values.step])
+    elif isinstance(dtype, pd.CategoricalDtype):
+        codes = np.asarray(values.cat.codes if isinstance(values, pd.Series) else values.codes)
+        arrays[prefix] = codes
+        meta.update(
+            kind="category",
+            ordered=bool(dtype.ordered),
+            categories=_save_values(pd.Series(dtype.categories), prefix + "_categories", arrays),
+        )
+    elif isinstance(dtype, pd.SparseDtype):
+        arrays[prefix] = np.asarray(values.sparse.to_dense())
+        meta.update(kind="sparse", fill_value=_json_scalar(dtype.fill_value))
+    elif _is_masked(dtype):
+        # nullable integers, floats and booleans
+        arrays[prefix] = values.to_numpy(dtype=dtype.numpy_dtype, na_value=0)
+        arrays[prefix + "_mask"] = np.asarray(values.isna())
+        meta.update(kind="masked", dtype=str(dtype))
+    elif isinstance(dtype, np.dtype) and dtype.kind in "biufcmM":
+        arrays[prefix] = np.asarray(values)
+        meta.update(kind="numpy")
+    elif _is_string_values(values):
+        text, offsets, nulls = encode_strings(values)
+        arrays[prefix] = text
+        arrays[prefix + "_offsets"] = offsets
+        arrays[prefix + "_nulls"] = nulls
+        meta.update(kind="string", null=_null_kind(values))
+    else:
+        # lists, dicts and mixed values from airtable
+        arrays[prefix] = np.frombuffer(
+            pickle.dumps(list(values), protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8
+        )
+        meta.update(kind="pickle")
+    meta["prefix"] = prefix
+    return meta
+
+
+def _load_values(meta, arrays):
+    kind = meta["kind"]
+    prefix = meta.get("prefix")
+    if kind == "category":
+        categories = _load_values(meta["categories"], arrays)
+        return pd.Categorical.from_codes(
+            np.asarray(arrays[prefix]), categories=categories, ordered=meta["ordered"]
+        )
+    if kind == "sparse":
+        return pd.arrays.SparseArray(np.asarray(arrays[prefix]), fill_value=meta["fill_value"])
+    if kind == "masked":
+        values = pd.array(np.asarray(arrays[prefix]), dtype=meta["dtype"])
+        values[np.asarray(arrays[prefix + "_mask"])] = pd.NA
+        return values
+    if kind == "numpy":
+        return arrays[prefix]
+    if kind == "string":
+        return decode_strings(
+            arrays[prefix],
+            arrays[prefix + "_offsets"],
+            arrays[prefix + "_nulls"],
+            null_value=np.nan if meta["null"] == "nan" else None,
+        )
+    items = pickle.loads(memoryview(arrays[prefix]))
+    values = np.empty(len(items), dtype=object)
+    values[:] = items
+    return values
+
+
+def _is_masked(dtype):
+    return (
+        isinstance(dtype, pd.api.extensions.ExtensionDtype)
+        and not isinstance(dtype, (pd.CategoricalDtype, pd.SparseDtype))
+        and dtype.kind in "biuf"
+        and hasattr(dtype, "numpy_dtype")
+    )
+
+
+def _array_bytes(values):
+    # dates and times can't be used as a buffer, but their integers can
+    values = np.ascontiguousarray(values)
+    if values.dtype.kind in "mM":
+        values = values.view("i8")
+    return values.data
+
+
+def _is_string_values(values):
+    if values.dtype != object:
+        return False
+    if not all(isinstance(v, str) for v in values if not _is_null(v)):
+        return False
+    return _null_kind(values) is not False
+
+
+def _null_kind(values):
+    # the type of missing value, so it can be restored as it was
+    nulls = {type(v) for v in values if _is_null(v)}
+    if not nulls or nulls == {float}:
+        return "nan"
+    if nulls == {type(None)}:
+        return "none"
+    return False
+
+
+def _is_null(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+def _json_scalar(value):
+    return value.item() if isinstance(value, np.generic) else value
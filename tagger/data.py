@@ -1,13 +1,49 @@
+from collections import OrderedDict
+import datetime
+import gc
+import hashlib
+import json
+import multiprocessing
+import os
 import re
+import time
 import warnings
-from airtable import Airtable
+import click
+import numpy as np
 import pandas as pd
 from slugify import slugify
 
 from flask.cli import AppGroup
 
 from tagger import settings
-warnings.filterwarnings("ignore", 'This pattern has match groups')
+from tagger.airtable_fetch import fetch_record, fetch_table, fetch_tables
+from tagger.airtable_writer import airtable_writer, queue_airtable_update, write_queue
+from tagger.columnar import (
+    ColumnsWriter,
+    StringColumn,
+    is_string_series,
+    load_columns,
+    manifest_path,
+    read_manifest,
+    save_columns,
+)
+from tagger.jobs import JobRunner, job_function, job_queue
+from tagger.metrics import lap, metrics, timed
+from tagger.ngram import TrigramIndex
+from tagger.rule_store import RuleStore
+from tagger.patterns import (
+    REGEX_FLAGS,
+    best_literals,
+    compile_regex,
+    compile_rule,
+    fold_case,
+    literal_trie_regex,
+    regex_cache_info,
+    regex_time_limit,
+    required_literals,
+)
+from tagger.utils import memory_usage
+warnings.filterwarnings("ignore", 'This pattern (is interpreted as a regular expression, and )?has match groups')
 
 data_cli = AppGroup("data")
 
@@ -18,54 +54,594 @@ RESULT_TYPES = {
     "true-negative": "Records that were correctly not selected",
 }
 
-def prepare_completed_data(tags, icnptso):
-    airtable = Airtable(
-        settings.AIRTABLE_BASE_ID,
-        settings.AIRTABLE_SAMPLE_TABLE_NAME,
-        settings.AIRTABLE_API_KEY,
+RESULT_METRICS = ["precision", "recall", "f1score", "accuracy"]
+
+# each record's result is coded as (selected << 1) | relevant
+RESULT_CODES = {
+    "true-negative": 0,
+    "false-negative": 1,
+    "false-positive": 2,
+    "true-positive": 3,
+}
+
+# Per-worker cache of the datasets stored in DATA_DIR. An entry is reloaded
+# when the dataset's manifest changes and its content hash no longer matches.
+# Callers get shallow views that share the cached data (see shared_view),
+# so take a `.copy()` before modifying a frame's values in place.
+class DatasetCache:
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, loader=None):
+        return self.get_versioned(path, loader)[0]
+
+    def get_versioned(self, path, loader=None):
+        # the dataset and the digest of the version loaded, which keys
+        # anything derived from it. The digest isn't kept in the frame's
+        # attrs, as pandas copies those onto every subset of it.
+        source = dataset_source(path)
+        stat = os.stat(source)
+        signature = (source, stat.st_mtime_ns, stat.st_size)
+        entry = self._entries.get(path)
+        if entry and entry["signature"] != signature:
+            # the file has been touched - only reload if the content differs
+            if entry["digest"] == file_digest(source):
+                entry["signature"] = signature
+            else:
+                entry = None
+        if entry:
+            self.hits += 1
+        else:
+            self.misses += 1
+            start = time.perf_counter()
+            entry = {
+                "signature": signature,
+                "digest": file_digest(source),
+                "value": (loader or load_dataset)(path),
+            }
+            metrics.observe(
+                "tagger_dataset_load_seconds",
+                time.perf_counter() - start,
+                dataset=os.path.basename(path),
+            )
+            self._entries[path] = entry
+        return shared_view(entry["value"]), entry["digest"]
+
+    def invalidate(self, path=None):
+        if path is None:
+            self._entries = {}
+        else:
+            self._entries.pop(path, None)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+        }
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Datasets are stored in the columnar format in a directory at their path.
+# Pickles at the same path plus ".pkl" are still read if there's no
+# directory, eg a completed.pkl copied to the server by hand.
+def dataset_source(path):
+    # the file that changes whenever the dataset does
+    if os.path.exists(manifest_path(path)):
+        return manifest_path(path)
+    return path + ".pkl"
+
+
+def dataset_exists(path):
+    return os.path.exists(dataset_source(path))
+
+
+def dataset_version(path):
+    return file_digest(dataset_source(path))
+
+
+def load_dataset(path):
+    if not os.path.exists(manifest_path(path)):
+        return pd.read_pickle(path + ".pkl")
+    meta = read_manifest(path)
+    if meta["type"] == "trigram_index":
+        return TrigramIndex.load(path)
+    if is_string_series(meta):
+        # the corpora - see corpus_texts
+        return StringColumn.load(path)
+    return load_columns(path)
+
+
+def save_dataset(value, path):
+    if isinstance(value, TrigramIndex):
+        value.save(path)
+    else:
+        save_columns(value, path)
+
+
+# the datasets the web app reads, for loading before the workers fork
+PRELOAD_DATASETS = [
+    settings.COMPLETED_DF,
+    settings.COMPLETED_CORPUS,
+    settings.COMPLETED_INDEX,
+    settings.COMPLETED_TAGS_MATRIX,
+    settings.COMPLETED_ICNPTSO_MATRIX,
+    settings.ALL_CHARITIES_DF,
+    settings.ALL_CHARITIES_CORPUS,
+    settings.ALL_CHARITIES_INDEX,
+    settings.ALL_CHARITIES_BY_INCOME_DF,
+]
+# the whole register, only matched by background jobs, so only loaded by
+# the job runner
+REGISTER_DATASETS = [
+    settings.ALL_CHARITIES_REGISTER_DF,
+    settings.ALL_CHARITIES_REGISTER_CORPUS,
+]
+
+
+def preload_datasets(paths=PRELOAD_DATASETS):
+    # Load the datasets into the dataset cache. Called in the gunicorn master
+    # so the workers inherit the data rather than each loading a copy.
+    loaded = []
+    for path in paths:
+        if dataset_exists(path):
+            dataset_cache.get(path)
+            loaded.append(path)
+    for get_rules in (get_tags_used, get_icnptso_used):
+        try:
+            get_rules()
+        except FileNotFoundError:
+            continue
+        loaded.append(get_rules.__name__)
+    # the workers open their own connections
+    rule_store.close()
+    metrics.flush()
+    metrics.db.close()
+    return loaded
+
+
+def shared_view(value):
+    # A new frame over the same data, so callers can add columns or change
+    # attrs without touching the cached one. Writing to its values in place
+    # (`.loc[...] = `, `inplace=True`) still changes the data every callback
+    # shares. The arrays aren't made read-only as pandas 1.2 can't work
+    # with read-only buffers.
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy(deep=False)
+    return value
+
+
+dataset_cache = DatasetCache()
+
+
+# LRU cache of the boolean selection vectors produced by a rule, keyed by
+# the include and exclude patterns and the version of the corpus they were
+# matched against. Entries are evicted once their total size is over budget.
+class SelectionCache:
+    def __init__(self, max_bytes):
+        self._entries = OrderedDict()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if key in self._entries:
+            self.size -= self._entry_size(key, self._entries.pop(key))
+        value.flags.writeable = False
+        self._entries[key] = value
+        self.size += self._entry_size(key, value)
+        while self.size > self.max_bytes and self._entries:
+            old_key, old_value = self._entries.popitem(last=False)
+            self.size -= self._entry_size(old_key, old_value)
+
+    def clear(self):
+        self._entries = OrderedDict()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self.size,
+        }
+
+    @staticmethod
+    def _entry_size(key, value):
+        return value.nbytes + sum(len(k) for k in key if isinstance(k, str))
+
+
+selection_cache = SelectionCache(settings.SELECTION_CACHE_BYTES)
+
+
+@metrics.process_collector
+def cache_metrics():
+    caches = {
+        "dataset": dataset_cache.stats(),
+        "selection": selection_cache.stats(),
+        "regex": regex_cache_info()._asdict(),
+    }
+    for cache, stats in caches.items():
+        labels = {"cache": cache}
+        yield ("tagger_cache_hits_total", "counter", "Cache hits in this process", labels, stats["hits"])
+        yield ("tagger_cache_misses_total", "counter", "Cache misses in this process", labels, stats["misses"])
+        yield (
+            "tagger_cache_entries", "gauge", "Entries held in each cache in this process",
+            labels, stats.get("entries", stats.get("currsize")),
+        )
+    yield (
+        "tagger_cache_bytes", "gauge", "Size of the selection cache in this process",
+        {"cache": "selection"}, caches["selection"]["bytes"],
     )
-    data = airtable.get_all()
+    for kind, value in memory_usage().items():
+        yield ("tagger_memory_bytes", "gauge", "Memory used by this process", {"kind": kind}, value)
+
+
+@metrics.collector
+def data_metrics():
+    for path in PRELOAD_DATASETS + REGISTER_DATASETS:
+        if not dataset_exists(path):
+            continue
+        source = dataset_source(path)
+        dataset = os.path.basename(path)
+        version = read_manifest(path)["digest"][:16] if source == manifest_path(path) else "pickle"
+        yield (
+            "tagger_dataset_info", "gauge", "The version of each dataset in DATA_DIR",
+            {"dataset": dataset, "version": version}, 1,
+        )
+        yield (
+            "tagger_dataset_modified_timestamp_seconds", "gauge", "When each dataset was last saved",
+            {"dataset": dataset}, os.stat(source).st_mtime,
+        )
+    for kind in ("tags", "icnptso"):
+        yield (
+            "tagger_rules_version", "gauge", "The rule store's version of each rule table",
+            {"kind": kind}, rule_store.version(kind) or 0,
+        )
+    for status, count in job_queue.counts().items():
+        yield ("tagger_jobs", "gauge", "Background jobs by status", {"status": status}, count)
+    yield ("tagger_airtable_writes_pending", "gauge", "Edits waiting to be saved to Airtable", {}, len(write_queue))
+
+
+def prepare_completed_data(tags, icnptso, records=None):
+    if records is None:
+        records = fetch_table(settings.AIRTABLE_SAMPLE_TABLE_NAME)
+    data = completed_frame(records, tags, icnptso)
+    save_completed_data(data)
+    return data, {i["id"]: record_digest(i["fields"]) for i in records}
+
+
+# Airtable records modified since a time. The time of the previous run is
+# pushed back by a margin to allow for clock differences - records fetched
+# again are compared against their digests so it does no harm.
+MODIFIED_SINCE_FORMULA = (
+    "OR(IS_AFTER(LAST_MODIFIED_TIME(), '{since}'), IS_AFTER(CREATED_TIME(), '{since}'))"
+)
+MODIFIED_SINCE_MARGIN = datetime.timedelta(minutes=10)
+AIRTABLE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+
+
+def modified_since_formula(since):
+    since = (
+        datetime.datetime.strptime(since, AIRTABLE_TIME_FORMAT) - MODIFIED_SINCE_MARGIN
+    ).strftime(AIRTABLE_TIME_FORMAT)
+    return MODIFIED_SINCE_FORMULA.format(since=since)
+
+
+def update_completed_data(tags, icnptso, previous, digests, ids, records):
+    # Merge the sample records added or changed since the last run into the
+    # previous data, given the ids of every record and the records returned
+    # by modified_since_formula. Returns the data, the digest of every
+    # record, and the ids of the records that were changed and removed.
+    fetched = {i["id"] for i in records}
+    records = records + [
+        fetch_record(settings.AIRTABLE_SAMPLE_TABLE_NAME, i)
+        for i in ids
+        if i not in fetched and i not in digests
+    ]
+
+    new_digests = {i: digests[i] for i in ids if i in digests}
+    changed = set()
+    for record in records:
+        digest = record_digest(record["fields"])
+        if new_digests.get(record["id"]) != digest:
+            changed.add(record["id"])
+        new_digests[record["id"]] = digest
+    removed = set(previous.index) - set(ids)
+    if not changed and not removed:
+        return previous, new_digests, changed, removed
+
+    data = pd.concat([
+        previous.drop(index=list(changed | removed), errors="ignore"),
+        completed_frame([i for i in records if i["id"] in changed], tags, icnptso),
+    ]).reindex(ids)
+    save_completed_data(data)
+    return data, new_digests, changed, removed
+
+
+def completed_frame(records, tags, icnptso):
     data = pd.DataFrame(
-        index=[i["id"] for i in data],
-        data=[i["fields"] for i in data],
+        index=[i["id"] for i in records],
+        data=[i["fields"] for i in records],
     )
+    if not len(data):
+        return data
     data.loc[:, settings.TAGS_FIELD_NAME] = data[settings.TAGS_FIELD_NAME].apply(lambda taglist: [tags.get(x, x) for x in taglist])
     data.loc[:, settings.ICNPTSO_FIELD_NAME] = data[settings.ICNPTSO_FIELD_NAME].apply(lambda v: icnptso.get(v[0], v[0]) if v else None)
-    data.to_pickle(settings.COMPLETED_DF)
     return data
 
 
+def record_digest(fields):
+    return hashlib.sha1(
+        json.dumps(fields, sort_keys=True, default=str).encode("utf8")
+    ).hexdigest()
+
+
+def save_completed_data(data):
+    save_dataset(data, settings.COMPLETED_DF)
+    save_corpus(
+        build_corpus(data["name"], data["activities"].fillna(data["objects"])),
+        settings.COMPLETED_CORPUS,
+        settings.COMPLETED_INDEX,
+    )
+    save_dataset(
+        build_membership_matrix(data[settings.TAGS_FIELD_NAME]),
+        settings.COMPLETED_TAGS_MATRIX,
+    )
+    save_dataset(
+        build_membership_matrix(data[settings.ICNPTSO_FIELD_NAME]),
+        settings.COMPLETED_ICNPTSO_MATRIX,
+    )
+
+
+def build_membership_matrix(values):
+    # sparse record x label matrix from a column of labels or lists of labels
+    exploded = values.explode().dropna()
+    matrix = (
+        pd.crosstab(exploded.index, exploded.values)
+        .reindex(values.index, fill_value=0)
+        .astype(bool)
+    )
+    matrix.index.name = None
+    matrix.columns.name = None
+    return matrix.astype(pd.SparseDtype(bool, False))
+
+
+def build_corpus(name, activities):
+    # the text that regular expressions are matched against
+    return name.fillna("") + " " + activities.fillna("")
+
+
+def corpus_texts(corpus, positions=None):
+    # The text of the records at positions, or of every record. A corpus
+    # read from DATA_DIR is a StringColumn, which decodes the text as it's
+    # asked for, rather than a series.
+    if isinstance(corpus, StringColumn):
+        return corpus.values(positions)
+    texts = corpus.to_numpy(dtype=object)
+    return texts if positions is None else texts[positions]
+
+
+def save_corpus(corpus, corpus_path, index_path):
+    save_dataset(corpus, corpus_path)
+    index = TrigramIndex.build(corpus, corpus_version=dataset_version(corpus_path))
+    save_dataset(index, index_path)
+
+
+def get_corpus_index(version):
+    # the trigram index built for this version of a corpus, if there is one
+    if not version:
+        return None
+    for index_path in (settings.COMPLETED_INDEX, settings.ALL_CHARITIES_INDEX):
+        if dataset_exists(index_path):
+            index = dataset_cache.get(index_path)
+            if index.corpus_version == version:
+                return index
+    return None
+
+
 def get_completed_data():
-    data = pd.read_pickle(settings.COMPLETED_DF)
-    corpus = pd.DataFrame([data["name"], data["activities"].fillna(data["objects"])]).T.apply(
-        lambda x: " ".join(x), axis=1
+    # the data, its corpus and the version of the corpus, for
+    # get_selected_items
+    data = dataset_cache.get(settings.COMPLETED_DF)
+    if dataset_exists(settings.COMPLETED_CORPUS):
+        corpus, version = dataset_cache.get_versioned(settings.COMPLETED_CORPUS)
+    else:
+        # data prepared before the corpus was stored alongside it
+        corpus = build_corpus(data["name"], data["activities"].fillna(data["objects"]))
+        version = None
+    return (data, corpus, version)
+
+
+def get_selected_items(corpus, keyword_regex, exclude_regex=None, time_limit=None, version=None):
+    # time_limit is in seconds - longer than that raises RegexTimeout. A
+    # match that isn't from the cache has its cost (see match_corpus) in the
+    # series' attrs.
+    # version is the version of a whole corpus from dataset_cache - the
+    # matches are cached by it, so it mustn't be given for a subset.
+    include, exclude = compile_rule(keyword_regex, exclude_regex)
+    if version:
+        key = (
+            version,
+            include.pattern,
+            exclude.pattern if exclude is not None else None,
+        )
+        selected_items = selection_cache.get(key)
+        if selected_items is not None:
+            return pd.Series(selected_items, index=corpus.index)
+    index = get_corpus_index(version)
+    with regex_time_limit(time_limit):
+        selected_items = match_corpus(corpus, index, include, exclude)
+    if version:
+        selection_cache.put(key, selected_items.to_numpy(dtype=bool, copy=True))
+    return selected_items
+
+
+MATCH_CHUNK_SIZE = 10000
+
+
+def match_corpus(corpus, index, include, exclude=None):
+    # The rule's cost - the seconds spent running its regexes, as match_rules
+    # counts it - is returned in the series' attrs as "cost". Only records
+    # containing the pattern's literals can match.
+    candidates = index.candidates(include.pattern, include.flags) if index else None
+    if candidates is None:
+        candidates = np.arange(len(corpus))
+    selected = np.zeros(len(corpus), dtype=bool)
+    cost = 0.0
+    # a chunk at a time, so only a chunk of the text is decoded at once
+    for start in range(0, len(candidates), MATCH_CHUNK_SIZE):
+        chunk = candidates[start : start + MATCH_CHUNK_SIZE]
+        texts = corpus_texts(corpus, chunk)
+        chunk_start = time.perf_counter()
+        selected[chunk] = [
+            isinstance(text, str)
+            and include.search(text) is not None
+            and (exclude is None or exclude.search(text) is None)
+            for text in texts
+        ]
+        cost += time.perf_counter() - chunk_start
+    selected_items = pd.Series(selected, index=corpus.index)
+    selected_items.attrs["cost"] = cost
+    return selected_items
+
+
+def get_match_spans(corpus, index, keyword_regex, time_limit=None):
+    # Where the regex matches the corpus text of the records in index, for
+    # highlighting the records that are shown - only those are searched.
+    # Returns a series of (text, [(start, end), ...]) by record.
+    include = compile_regex(keyword_regex)
+    index = pd.Index(index)
+    positions = corpus.index.get_indexer(index)
+    if (positions < 0).any():
+        raise KeyError("Records not in the corpus: {}".format(list(index[positions < 0])))
+    texts = [text if isinstance(text, str) else "" for text in corpus_texts(corpus, positions)]
+    with regex_time_limit(time_limit):
+        return pd.Series(
+            [(text, [m.span() for m in include.finditer(text) if m.end() > m.start()]) for text in texts],
+            index=index,
+            dtype=object,
+        )
+
+
+def match_rules(corpus, rules, costs=None):
+    # Evaluate many (include regex, exclude regex) rules in one pass over the
+    # corpus. A single scan finds the literals that each rule's include
+    # pattern requires, and the full rules are only run against records that
+    # contain them. Rules with no usable literals are matched one at a time.
+    # Returns a record x rule boolean frame and a dict of any regex errors.
+    # If costs is given it is filled with the seconds spent running each
+    # rule - the shared scan isn't counted against any of them.
+    errors = {}
+    rule_keys = {}
+    for key, (keyword_regex, exclude_regex) in rules.items():
+        try:
+            rule_keys.setdefault(compile_rule(keyword_regex, exclude_regex), []).append(key)
+        except re.error as err:
+            errors[key] = err
+
+    literal_ids = {}
+    rules_by_literal = {}
+    selected = {}
+    rule_costs = {rule: 0.0 for rule in rule_keys}
+    for rule in rule_keys:
+        literals = best_literals(required_literals(rule[0].pattern, rule[0].flags))
+        if not literals:
+            selected_items = get_selected_items(
+                corpus, rule[0].pattern, rule[1].pattern if rule[1] is not None else None
+            )
+            selected[rule] = selected_items.to_numpy(dtype=bool)
+            rule_costs[rule] = selected_items.attrs["cost"]
+            continue
+        selected[rule] = np.zeros(len(corpus), dtype=bool)
+        for literal in literals:
+            literal_id = literal_ids.setdefault(literal, len(literal_ids))
+            rules_by_literal.setdefault(literal_id, []).append(rule)
+
+    if literal_ids:
+        # at each position the lookahead finds the longest literal starting
+        # there, which implies any other literal that is a prefix of it
+        scanner = re.compile("(?=({}))".format(literal_trie_regex(literal_ids)), REGEX_FLAGS)
+        implied = {
+            literal: {literal_ids[other] for other in literal_ids if literal.startswith(other)}
+            for literal in literal_ids
+        }
+        for i, text in enumerate(corpus_texts(corpus)):
+            if not isinstance(text, str):
+                continue
+            found = {m.group(1) for m in scanner.finditer(text)}
+            if not found:
+                continue
+            candidates = {
+                rule
+                for literal in found
+                for literal_id in implied[fold_case(literal)]
+                for rule in rules_by_literal[literal_id]
+            }
+            for include, exclude in candidates:
+                start = time.perf_counter()
+                if include.search(text) and (exclude is None or not exclude.search(text)):
+                    selected[(include, exclude)][i] = True
+                rule_costs[(include, exclude)] += time.perf_counter() - start
+
+    if costs is not None:
+        costs.update({key: rule_costs[rule] for rule, keys in rule_keys.items() for key in keys})
+    result = pd.DataFrame(
+        {key: selected[rule] for rule, keys in rule_keys.items() for key in keys},
+        index=corpus.index,
+        columns=[key for key in rules if key not in errors],
     )
-    return (data, corpus)
+    return result, errors
 
 
 def group_by_with_total(df, column="income_band"):
-    gb = df[column].value_counts()
+    return with_total(df[column].value_counts())
+
+
+def with_total(gb):
     if gb.index.is_categorical():
         gb.index = gb.index.add_categories("Total")
     gb["Total"] = gb.sum()
     return gb
 
 
-def get_all_charities(keyword_regex, exclude_regex, sample_size=20):
-    df = pd.read_pickle(settings.ALL_CHARITIES_DF)
-    stats = pd.read_pickle(settings.ALL_CHARITIES_BY_INCOME_DF)
+def get_all_charities(keyword_regex, exclude_regex, sample_size=20, exact=False, progress=None):
+    if progress:
+        progress(0, "Matching against a sample of charities")
+    df = dataset_cache.get(settings.ALL_CHARITIES_DF)
+    stats = dataset_cache.get(settings.ALL_CHARITIES_BY_INCOME_DF)
 
     # Get stats for all charities
     all_charities_by_income = group_by_with_total(df, "income_band")
     all_charities_count = len(df)
 
     # Reduce to just the matched charities
-    corpus = pd.DataFrame([df["name"], df["activities"]]).fillna("").T.apply(
-        lambda x: " ".join(x), axis=1
+    if dataset_exists(settings.ALL_CHARITIES_CORPUS):
+        corpus, version = dataset_cache.get_versioned(settings.ALL_CHARITIES_CORPUS)
+    else:
+        corpus, version = build_corpus(df["name"], df["activities"]), None
+    selected_items = get_selected_items(
+        corpus, keyword_regex, exclude_regex, time_limit=settings.REGEX_TIME_LIMIT, version=version
     )
-    selected_items = corpus.str.contains(keyword_regex, regex=True, case=False)
-    if exclude_regex and not pd.isna(exclude_regex):
-        selected_items = selected_items & ~corpus.str.contains(exclude_regex, regex=True, case=False)
     df = df[selected_items]
 
     # get stats about the found charities
@@ -77,56 +653,278 @@ def get_all_charities(keyword_regex, exclude_regex, sample_size=20):
         "estimated_total": found_charities_by_income * stats,
     })
 
-    if found_charities <= sample_size:
-        return df, found_charities_by_income
-    else:
-        return df.sample(sample_size), found_charities_by_income
+    if exact:
+        # match against every charity on the register rather than the sample
+        if progress:
+            progress(0.1, "Matching against every charity on the register")
+        df = get_register_matches(keyword_regex, exclude_regex)
+        corpus = dataset_cache.get(settings.ALL_CHARITIES_REGISTER_CORPUS)
+        found_charities = len(df)
+        exact_by_income = group_by_with_total(df, "income_band")
+        found_charities_by_income["exact_total"] = exact_by_income
+        found_charities_by_income["exact_percentage"] = exact_by_income / stats
 
+    if found_charities > sample_size:
+        df = df.sample(sample_size)
+    # for highlighting the matches - see utils.highlight_match
+    df = df.assign(match=get_match_spans(
+        corpus,
+        df.index,
+        keyword_regex,
+        time_limit=settings.REGEX_REGISTER_TIME_LIMIT if exact else settings.REGEX_TIME_LIMIT,
+    ))
+    return df, found_charities_by_income
 
-def prepare_all_charities(completed=None):
-    df = pd.read_csv(settings.ALL_CHARITIES_CSV)
-    df.loc[:, "income_band"] = pd.cut(
-        df["income"],
-        [0,10000,100000,1000000,10000000,float("inf")],
-        labels=["Under £10k", "£10k-£100k", "£100k-£1m", "£1m-£10m", "Over £10m"],
+
+@job_function
+def all_charities_job(keyword_regex, exclude_regex, exact, version=None, progress=None):
+    return get_all_charities(keyword_regex, exclude_regex, exact=exact, progress=progress)
+
+
+def all_charities_job_args(keyword_regex, exclude_regex, exact=False):
+    # the data version is included so results from before the data was
+    # updated aren't reused
+    paths = [settings.ALL_CHARITIES_DF]
+    if exact:
+        paths.append(settings.ALL_CHARITIES_REGISTER_DF)
+    # read from the manifests, so the web workers don't load the register
+    versions = [dataset_version(path) for path in paths if dataset_exists(path)]
+    return dict(
+        keyword_regex=keyword_regex,
+        exclude_regex=exclude_regex,
+        exact=exact,
+        version=versions,
     )
-    gb = group_by_with_total(df, "income_band")
-    gb.to_pickle(settings.ALL_CHARITIES_BY_INCOME_DF)
-    if isinstance(completed, pd.DataFrame):
-        df = df[~df["reg_number"].isin(completed["reg_number"].unique())]
-    df = df.sample(10000)
-    df.loc[:, "activities"] = df["activities"].fillna(df["objects"])
+
+
+def submit_all_charities_job(keyword_regex, exclude_regex, exact=False, previous_job=None):
+    # previous_job, the job the page last showed, is kept if it's for the
+    # same match
+    args = all_charities_job_args(keyword_regex, exclude_regex, exact)
+    if previous_job and job_queue.is_same(previous_job, "all_charities_job", **args):
+        return previous_job
+    return job_queue.submit("all_charities_job", **args)
+
+
+def cancel_all_charities_job(job_id, keyword_regex, exclude_regex, exact=None):
+    # cancels job_id unless it's the job for this match - exact is None when
+    # no job is wanted. A callback that's triggered again with the same regex
+    # and tab keeps its job running.
+    if exact is not None and job_queue.is_same(
+        job_id, "all_charities_job", **all_charities_job_args(keyword_regex, exclude_regex, exact)
+    ):
+        return
+    job_queue.cancel(job_id)
+
+
+def get_register_matches(keyword_regex, exclude_regex):
+    register = dataset_cache.get(settings.ALL_CHARITIES_REGISTER_DF)
+    corpus, version = dataset_cache.get_versioned(settings.ALL_CHARITIES_REGISTER_CORPUS)
+    return register[get_selected_items(
+        corpus,
+        keyword_regex,
+        exclude_regex,
+        time_limit=settings.REGEX_REGISTER_TIME_LIMIT,
+        version=version,
+    )]
+
+
+ALL_CHARITIES_COLUMNS = {
     # reg_number,name,postcode,active,date_registered,date_removed,web,company_number,activities,objects,source,last_updated,income,spending,fye
-    df = df[["reg_number", "name", "activities", "source", "income_band"]]
-    df.to_pickle(settings.ALL_CHARITIES_DF)
+    "reg_number": str,
+    "name": str,
+    "activities": str,
+    "objects": str,
+    "source": "category",
+    "income": "float64",
+}
+
+
+INCOME_BANDS = [0, 10000, 100000, 1000000, 10000000, float("inf")]
+INCOME_BAND_LABELS = ["Under £10k", "£10k-£100k", "£100k-£1m", "£1m-£10m", "Over £10m"]
+ALL_CHARITIES_SAMPLE_SIZE = 10000
+
+
+def read_all_charities(chunksize=settings.ALL_CHARITIES_CSV_CHUNKSIZE):
+    # stream the register in chunks, keeping only the columns that are used
+    chunks = pd.read_csv(
+        settings.ALL_CHARITIES_CSV,
+        usecols=list(ALL_CHARITIES_COLUMNS.keys()),
+        dtype=ALL_CHARITIES_COLUMNS,
+        chunksize=chunksize,
+    )
+    for chunk in chunks:
+        chunk.loc[:, "income_band"] = pd.cut(chunk["income"], INCOME_BANDS, labels=INCOME_BAND_LABELS)
+        chunk.loc[:, "activities"] = chunk["activities"].fillna(chunk["objects"])
+        yield chunk[["reg_number", "name", "activities", "source", "income_band"]]
+
+
+def prepare_all_charities(completed=None):
+    # The register is worked through a chunk at a time so it's never all in
+    # memory. The whole register and its corpus are written out as they're
+    # read, for exact matching, while the charities are counted by income
+    # band and a random sample of those not in the completed data is kept.
+    completed_ids = set()
+    if isinstance(completed, pd.DataFrame):
+        completed_ids = set(completed["reg_number"].astype(str).unique())
+    register = ColumnsWriter(settings.ALL_CHARITIES_REGISTER_DF)
+    register_corpus = ColumnsWriter(settings.ALL_CHARITIES_REGISTER_CORPUS)
+    band_counts = np.zeros(len(INCOME_BAND_LABELS), dtype=np.int64)
+    sample = None
+    for chunk in read_all_charities():
+        register.append(chunk)
+        register_corpus.append(build_corpus(chunk["name"], chunk["activities"]))
+        codes = chunk["income_band"].cat.codes.to_numpy()
+        band_counts += np.bincount(codes[codes >= 0], minlength=len(INCOME_BAND_LABELS))
+        sample = sample_rows(
+            sample, chunk[~chunk["reg_number"].isin(completed_ids)], ALL_CHARITIES_SAMPLE_SIZE
+        )
+    register.close()
+    register_corpus.close()
+    # The register isn't indexed - it's only matched by background jobs, and
+    # building and loading an index of every charity costs far more than
+    # scanning it.
+
+    gb = pd.Series(
+        band_counts,
+        index=pd.CategoricalIndex(INCOME_BAND_LABELS, categories=INCOME_BAND_LABELS, ordered=True),
+        name="income_band",
+    )
+    save_dataset(with_total(gb.sort_values(ascending=False)), settings.ALL_CHARITIES_BY_INCOME_DF)
+
+    df = sample.drop(columns="sample_key")
+    save_dataset(df, settings.ALL_CHARITIES_DF)
+    save_corpus(
+        build_corpus(df["name"], df["activities"]),
+        settings.ALL_CHARITIES_CORPUS,
+        settings.ALL_CHARITIES_INDEX,
+    )
+
+
+def sample_rows(sample, rows, size):
+    # A random sample of size rows from all the chunks passed in turn. Each
+    # row is given a random key and the ones with the lowest keys are kept.
+    rows = rows.assign(sample_key=np.random.random(len(rows)))
+    if sample is not None:
+        rows = pd.concat([sample, rows])
+    return rows.nsmallest(size, "sample_key")
+
+
+@data_cli.command("match")
+@click.argument("keyword_regex")
+@click.option("--exclude", "exclude_regex", default=None, help="Exclude regular expression")
+def match_all_charities(keyword_regex, exclude_regex):
+    _, by_income = get_all_charities(keyword_regex, exclude_regex, exact=True)
+    print(by_income.to_string(
+        formatters={
+            "percentage": "{:,.2%}".format,
+            "estimated_total": "{:,.0f}".format,
+            "exact_total": "{:,.0f}".format,
+            "exact_percentage": "{:,.2%}".format,
+        },
+    ))
+
+
+@data_cli.command("jobs")
+@click.option(
+    "--workers",
+    default=settings.JOB_WORKERS,
+    show_default=True,
+    help="Number of jobs to run at once",
+)
+def run_jobs(workers):
+    # load the data once so every job process inherits it
+    loaded = preload_datasets(PRELOAD_DATASETS + REGISTER_DATASETS)
+    gc.collect()
+    gc.freeze()
+    print("Loaded {} datasets".format(len(loaded)))
+    print("Running jobs, {} at a time".format(workers))
+    JobRunner(job_queue, workers=workers).run()
+
+
+rule_store = RuleStore(settings.RULE_STORE)
+
+
+def get_rules(kind, legacy_path):
+    if not rule_store.exists(kind):
+        # tables saved before there was a rule store
+        rule_store.replace(kind, load_dataset(legacy_path))
+    return shared_view(rule_store.frame(kind))
 
 
 def save_tags_used(df):
-    df.to_pickle(settings.TAGS_USED_DF)
+    rule_store.replace("tags", df)
 
 
 def get_tags_used():
-    return pd.read_pickle(settings.TAGS_USED_DF)
+    return get_rules("tags", settings.TAGS_USED_DF)
+
+
+def update_tag_used(record_id, values):
+    rule_store.upsert("tags", record_id, values)
 
 
 def save_icnptso_used(df):
-    df.to_pickle(settings.ICNPTSO_USED_DF)
+    rule_store.replace("icnptso", df)
 
 
 def get_icnptso_used():
-    return pd.read_pickle(settings.ICNPTSO_USED_DF)
+    return get_rules("icnptso", settings.ICNPTSO_USED_DF)
+
+
+def update_icnptso_used(record_id, values):
+    rule_store.upsert("icnptso", record_id, values)
+
+
+def rule_changed(rule, keyword_regex, exclude_regex):
+    # whether a rule's regular expressions differ from the stored ones, which
+    # leaves its stored cost out of date
+    def value(regex):
+        return None if regex is None or pd.isna(regex) or regex == "" else regex
+
+    return (
+        value(rule.get("Regular expression")), value(rule.get("Exclude regular expression"))
+    ) != (value(keyword_regex), value(exclude_regex))
 
 
 @data_cli.command("initialise")
-def initialise_data():
+@click.option(
+    "--jobs",
+    default=1,
+    type=int,
+    help="Number of processes used to evaluate the regular expressions",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only fetch and recalculate what has changed since the last run",
+)
+@timed
+def initialise_data(jobs, incremental):
     print("initialising data")
-    print("Fetching Tags")
-    airtable = Airtable(
-        settings.AIRTABLE_BASE_ID,
-        settings.AIRTABLE_TAGS_TABLE_NAME,
-        settings.AIRTABLE_API_KEY,
-    )
-    tags = airtable.get_all()
+    started = datetime.datetime.utcnow().strftime(AIRTABLE_TIME_FORMAT)
+    manifest = load_initialise_manifest() if incremental else None
+    if incremental and not manifest:
+        print("No record of a previous run, fetching everything")
+
+    # the tables are fetched at the same time
+    queries = {
+        "tags": (settings.AIRTABLE_TAGS_TABLE_NAME, {}),
+        "icnptso": (settings.AIRTABLE_ICNPTSO_TABLE_NAME, {}),
+    }
+    if manifest:
+        queries["sample_ids"] = (settings.AIRTABLE_SAMPLE_TABLE_NAME, {"fields": ["reg_number"]})
+        queries["sample_changes"] = (
+            settings.AIRTABLE_SAMPLE_TABLE_NAME,
+            {"formula": modified_since_formula(manifest["fetched_at"])},
+        )
+    else:
+        queries["sample"] = (settings.AIRTABLE_SAMPLE_TABLE_NAME, {})
+    print("Fetching Tags, ICNPTSO and completed data")
+    fetched = fetch_tables(queries)
+    lap("fetch")
+
+    tags = fetched["tags"]
     tags = pd.DataFrame(
         index=[i["id"] for i in tags],
         data=[i["fields"] for i in tags],
@@ -138,13 +936,7 @@ def initialise_data():
     tags.loc[:, "f1score"] = pd.NA
     tags.loc[:, "accuracy"] = pd.NA
 
-    print("Fetching ICNPTSO")
-    airtable = Airtable(
-        settings.AIRTABLE_BASE_ID,
-        settings.AIRTABLE_ICNPTSO_TABLE_NAME,
-        settings.AIRTABLE_API_KEY,
-    )
-    icnptso = airtable.get_all()
+    icnptso = fetched["icnptso"]
     icnptso = pd.DataFrame(
         index=[i["id"] for i in icnptso],
         data=[i["fields"] for i in icnptso],
@@ -154,14 +946,47 @@ def initialise_data():
     icnptso.loc[:, "f1score"] = pd.NA
     icnptso.loc[:, "accuracy"] = pd.NA
 
-    print("Fetching completed data")
-    prepare_completed_data(
-        tags["tag"].to_dict(),
-        icnptso["Code"].to_dict(),
-    )
-    df, corpus = get_completed_data()
-    print("Preparing all charities")
-    prepare_all_charities(df)
+    # the names the sample's labels are stored under - if any have changed
+    # every record needs fetching again
+    labels_digest = record_digest([tags["tag"].to_dict(), icnptso["Code"].to_dict()])
+    changed = None
+    if manifest and manifest["labels"] == labels_digest and dataset_exists(settings.COMPLETED_DF):
+        previous = get_completed_data()[0]
+        if set(previous.index) == set(manifest["sample"]):
+            df, sample_digests, changed, removed = update_completed_data(
+                tags["tag"].to_dict(),
+                icnptso["Code"].to_dict(),
+                previous,
+                manifest["sample"],
+                [i["id"] for i in fetched["sample_ids"]],
+                fetched["sample_changes"],
+            )
+            print("{:,.0f} records changed, {:,.0f} removed".format(len(changed), len(removed)))
+            # the records whose contribution to each rule's results has changed
+            old_rows = previous[previous.index.isin(changed | removed)]
+            new_rows = df[df.index.isin(changed)]
+    if changed is None:
+        if "sample" not in fetched:
+            print("Fetching all completed data")
+        df, sample_digests = prepare_completed_data(
+            tags["tag"].to_dict(),
+            icnptso["Code"].to_dict(),
+            fetched.get("sample"),
+        )
+    df, corpus, _ = get_completed_data()
+    lap("completed_data")
+
+    all_charities_digest = file_digest(settings.ALL_CHARITIES_CSV)
+    if (
+        manifest
+        and manifest["all_charities"] == all_charities_digest
+        and dataset_exists(settings.ALL_CHARITIES_DF)
+    ):
+        print("All charities unchanged")
+    else:
+        print("Preparing all charities")
+        prepare_all_charities(df)
+    lap("all_charities")
 
     print("Finding used tags")
     tags_used = (
@@ -183,88 +1008,287 @@ def initialise_data():
     )
     icnptso = icnptso.join(icnptso_used, on="Code")
 
+    tag_counts = {}
+    icnptso_counts = {}
+    if changed is not None:
+        tag_counts = update_rule_counts(manifest["tag"], tags, "tag", "tag", old_rows, new_rows)
+        icnptso_counts = update_rule_counts(
+            manifest["icnptso"], icnptso, "Code", "icnptso", old_rows, new_rows
+        )
+    lap("rules_used")
+
     print("Calculating regular expression results for tags")
-    for index, row in tags[tags["Regular expression"].notnull()].iterrows():
-        try:
-            result = get_keyword_result(
-                row["Regular expression"],
-                row.get("Exclude regular expression"),
-                df,
-                corpus,
-                tag=row["tag"],
-            )
-            summary = get_result_summary(result)
-            tags.loc[index, "precision"] = summary["precision"]
-            tags.loc[index, "recall"] = summary["recall"]
-            tags.loc[index, "f1score"] = summary["f1score"]
-            tags.loc[index, "accuracy"] = summary["accuracy"]
-        except re.error:
-            print(f"Error with regex for tag [{row['tag']}]")
-            print(row["Regular expression"])
-            print(re.error)
-            continue
+    tags, tag_counts = apply_rule_results(
+        tags, df, corpus, "tag", "tag", jobs=jobs, counts=tag_counts,
+        costs=rule_costs(manifest["tag"], tag_counts) if changed is not None else None,
+    )
+    lap("tag_results")
 
     print("Calculating regular expression results for ICNPTSO")
-    for index, row in icnptso[icnptso["Regular expression"].notnull()].iterrows():
-        try:
-            result = get_keyword_result(
-                row["Regular expression"],
-                row.get("Exclude regular expression"),
-                df,
-                corpus,
-                icnptso=row["Code"],
-            )
-            summary = get_result_summary(result)
-            icnptso.loc[index, "precision"] = summary["precision"]
-            icnptso.loc[index, "recall"] = summary["recall"]
-            icnptso.loc[index, "f1score"] = summary["f1score"]
-            icnptso.loc[index, "accuracy"] = summary["accuracy"]
-        except re.error:
-            print(f"Error with regex for ICNPTSO [{row['Code']}]")
-            print(row["Regular expression"])
-            print(re.error)
-            continue
+    icnptso, icnptso_counts = apply_rule_results(
+        icnptso, df, corpus, "Code", "icnptso", jobs=jobs, counts=icnptso_counts,
+        costs=rule_costs(manifest["icnptso"], icnptso_counts) if changed is not None else None,
+    )
+    lap("icnptso_results")
 
     tags = tags.sort_values("frequency", ascending=False)
     save_tags_used(tags)
     icnptso = icnptso.sort_values("frequency", ascending=False)
     save_icnptso_used(icnptso)
 
+    save_initialise_manifest({
+        "fetched_at": started,
+        "labels": labels_digest,
+        "all_charities": all_charities_digest,
+        "sample": sample_digests,
+        "tag": rule_manifest(tags, "tag", tag_counts),
+        "icnptso": rule_manifest(icnptso, "Code", icnptso_counts),
+    })
+    lap("save")
+
 
-def get_keyword_result(keyword_regex, exclude_regex, df, corpus, tag=None, icnptso=None):
-    selected_items = corpus.str.contains(keyword_regex, regex=True, case=False)
-    if exclude_regex and not pd.isna(exclude_regex):
-        selected_items = selected_items & ~corpus.str.contains(exclude_regex, regex=True, case=False)
+# Record of the last run of `flask data initialise`, used by --incremental.
+# Holds the digest of every sample record and, for each rule, the digest of
+# its regular expressions and its confusion matrix counts.
+def load_initialise_manifest():
+    if not os.path.exists(settings.INITIALISE_MANIFEST):
+        return None
+    with open(settings.INITIALISE_MANIFEST, encoding="utf8") as f:
+        return json.load(f)
+
+
+def save_initialise_manifest(manifest):
+    tmp = settings.INITIALISE_MANIFEST + ".tmp"
+    with open(tmp, "w", encoding="utf8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, settings.INITIALISE_MANIFEST)
+
+
+def rule_digest(rule, label_field):
+    return record_digest([
+        rule[label_field],
+        rule.get("Regular expression"),
+        rule.get("Exclude regular expression"),
+    ])
+
+
+def rule_manifest(rules, label_field, counts):
+    return {
+        index: {
+            "digest": rule_digest(row, label_field),
+            "counts": counts[index].tolist() if index in counts else None,
+            "cost": row["cost"] if index in counts and not pd.isna(row["cost"]) else None,
+        }
+        for index, row in rules.iterrows()
+    }
+
+
+def rule_costs(previous, counts):
+    # the cost recorded last time for the rules that weren't matched again
+    return {
+        index: previous[index]["cost"]
+        for index in counts
+        if previous[index].get("cost") is not None
+    }
+
+
+def update_rule_counts(previous, rules, label_field, label_type, old_rows, new_rows):
+    # Counts for the rules that are unchanged since the last run, updated by
+    # taking away the results for the old versions of the changed records and
+    # adding the results for the new versions
+    unchanged = [
+        index
+        for index, row in rules.iterrows()
+        if index in previous
+        and previous[index]["counts"]
+        and previous[index]["digest"] == rule_digest(row, label_field)
+    ]
+    counts = {index: np.array(previous[index]["counts"]) for index in unchanged}
+    for rows, sign in ((old_rows, -1), (new_rows, 1)):
+        if not len(rows) or not unchanged:
+            continue
+        row_counts, _, _ = evaluate_rules(
+            rules.loc[unchanged],
+            rows,
+            build_corpus(rows["name"], rows["activities"].fillna(rows["objects"])),
+            label_field,
+            label_type,
+        )
+        for index, c in row_counts.items():
+            counts[index] = counts[index] + sign * c
+    return counts
+
+
+# data shared with the rule evaluation processes, set once per process
+_rule_data = {}
+
+
+def _init_rule_worker(df, corpus):
+    _rule_data["df"] = df
+    _rule_data["corpus"] = corpus
+
+
+def _evaluate_rules(tasks):
+    df, corpus = _rule_data["df"], _rule_data["corpus"]
+    costs = {}
+    selected, errors = match_rules(
+        corpus, {index: (include, exclude) for index, include, exclude, label in tasks}, costs
+    )
+    results = []
+    for index, include, exclude, label in tasks:
+        if index in errors:
+            results.append((index, str(errors[index]), None))
+            continue
+        result = get_rule_result(selected[index], get_relevant_items(df, **label))
+        results.append((index, get_result_counts(result), costs[index]))
+    return results
+
+
+def evaluate_rules(rules, df, corpus, label_field, label_type, jobs=1):
+    # the confusion matrix counts and seconds spent matching for each rule,
+    # and any regex errors
+    tasks = [
+        (
+            index,
+            row["Regular expression"],
+            row.get("Exclude regular expression"),
+            {label_type: row[label_field]},
+        )
+        for index, row in rules[rules["Regular expression"].notnull()].iterrows()
+    ]
+    if jobs > 1 and len(tasks) > 1:
+        # the data is handed to each process once rather than with every task
+        chunks = [tasks[i::jobs * 4] for i in range(min(len(tasks), jobs * 4))]
+        with multiprocessing.Pool(
+            jobs, initializer=_init_rule_worker, initargs=(df, corpus)
+        ) as pool:
+            results = [r for chunk in pool.map(_evaluate_rules, chunks) for r in chunk]
+    else:
+        _init_rule_worker(df, corpus)
+        results = _evaluate_rules(tasks)
+
+    counts = {index: r for index, r, _ in results if not isinstance(r, str)}
+    errors = {index: r for index, r, _ in results if isinstance(r, str)}
+    costs = {index: cost for index, r, cost in results if not isinstance(r, str)}
+    return counts, errors, costs
+
+
+def apply_rule_results(
+    rules, df, corpus, label_field, label_type, jobs=1, counts=None, costs=None
+):
+    # Set the metrics and cost for each rule. Rules already in counts are not
+    # matched again, and keep their cost from costs. Returns the rules and
+    # the counts for every rule.
+    counts = dict(counts or {})
+    costs = {index: cost for index, cost in (costs or {}).items() if index in counts}
+    new_counts, errors, new_costs = evaluate_rules(
+        rules[~rules.index.isin(list(counts))], df, corpus, label_field, label_type, jobs=jobs
+    )
+    counts.update(new_counts)
+    costs.update(new_costs)
+    for index, err in errors.items():
+        print(f"Error with regex for {label_type} [{rules.loc[index, label_field]}]")
+        print(rules.loc[index, "Regular expression"])
+        print(err)
+
+    # object dtype keeps metrics that couldn't be calculated as None
+    summaries = {index: summarise_counts(c) for index, c in counts.items() if index in rules.index}
+    metrics = pd.DataFrame(
+        [[summary[m] for m in RESULT_METRICS] for summary in summaries.values()],
+        index=list(summaries),
+        columns=RESULT_METRICS,
+        dtype=object,
+    )
+    rules = rules.copy()
+    positions = rules.index.get_indexer(metrics.index)
+    for m in RESULT_METRICS:
+        values = rules[m].to_numpy(dtype=object, copy=True)
+        values[positions] = metrics[m].to_numpy(dtype=object)
+        rules[m] = values
+    rules["cost"] = pd.Series(costs, index=rules.index, dtype=object).where(
+        rules.index.isin(list(costs)), pd.NA
+    )
+    return rules, counts
+
+
+def same_index(a, b):
+    # Index.equals on object indexes (the record ids) takes a reference to
+    # every value as it goes, which writes to each of them, so the pages a
+    # worker shares with the gunicorn master get copied. numpy compares them
+    # without.
+    if len(a) != len(b):
+        return False
+    return bool((a.to_numpy() == b.to_numpy()).all())
+
+
+def get_relevant_items(df, tag=None, icnptso=None):
     if tag:
-        relevant_items = df[settings.TAGS_FIELD_NAME].apply(lambda x: tag in x if x else False)
+        label, matrix_path = tag, settings.COMPLETED_TAGS_MATRIX
     elif icnptso:
-        relevant_items = df[settings.ICNPTSO_FIELD_NAME]==icnptso
+        label, matrix_path = icnptso, settings.COMPLETED_ICNPTSO_MATRIX
     else:
         raise Exception("Need to specify either tag or ICNPTSO")
+
+    if dataset_exists(matrix_path):
+        matrix = dataset_cache.get(matrix_path)
+        if same_index(matrix.index, df.index):
+            if label not in matrix.columns:
+                return pd.Series(False, index=df.index)
+            return pd.Series(matrix[label].to_numpy(dtype=bool), index=df.index)
+
+    # no membership matrix prepared for this data
+    if tag:
+        return df[settings.TAGS_FIELD_NAME].apply(lambda x: tag in x if x else False)
+    return df[settings.ICNPTSO_FIELD_NAME] == icnptso
+
+
+def get_keyword_result(
+    keyword_regex, exclude_regex, df, corpus, tag=None, icnptso=None, version=None
+):
+    selected_items = get_selected_items(
+        corpus, keyword_regex, exclude_regex, time_limit=settings.REGEX_TIME_LIMIT, version=version
+    )
+    relevant_items = get_relevant_items(df, tag=tag, icnptso=icnptso)
+    result = get_rule_result(selected_items, relevant_items)
+    # None if the match came from the cache
+    result.attrs["cost"] = selected_items.attrs.get("cost")
+    return result
+
+
+def get_rule_result(selected_items, relevant_items):
+    selected = selected_items.to_numpy(dtype=bool)
+    relevant = relevant_items.to_numpy(dtype=bool)
     result = pd.DataFrame(
         {
-            "selected": selected_items,
-            "relevant": relevant_items,
-        }
+            "selected": selected,
+            "relevant": relevant,
+            "code": (selected.astype(np.int8) << 1) | relevant,
+        },
+        index=selected_items.index,
     )
-    result.loc[result["selected"] & result["relevant"], "result"] = "true-positive"
-    result.loc[result["selected"] & ~result["relevant"], "result"] = "false-positive"
-    result.loc[~result["selected"] & ~result["relevant"], "result"] = "true-negative"
-    result.loc[~result["selected"] & result["relevant"], "result"] = "false-negative"
     return result
 
 
+def get_result_counts(result):
+    # number of records in each cell of the confusion matrix, by RESULT_CODES
+    return np.bincount(result["code"].to_numpy(), minlength=len(RESULT_CODES))
+
+
 def get_result_summary(result):
+    return summarise_counts(get_result_counts(result))
+
+
+def summarise_counts(counts):
     result_summary = {
-        "relevant": result["relevant"].sum(),
-        "selected": result["selected"].sum(),
+        "relevant": counts[RESULT_CODES["true-positive"]] + counts[RESULT_CODES["false-negative"]],
+        "selected": counts[RESULT_CODES["true-positive"]] + counts[RESULT_CODES["false-positive"]],
         "precision": None,
         "recall": None,
         "f1score": None,
         "accuracy": None,
     }
     for r in RESULT_TYPES.keys():
-        result_summary[r] = (result["result"] == r).sum()
+        result_summary[r] = counts[RESULT_CODES[r]]
     if result_summary["true-positive"] + result_summary["false-positive"]:
         result_summary["precision"] = result_summary["true-positive"] / (
             result_summary["true-positive"] + result_summary["false-positive"]
@@ -278,24 +1302,27 @@ def get_result_summary(result):
             (result_summary["precision"] * result_summary["recall"])
             / (result_summary["precision"] + result_summary["recall"])
         )
-    if len(result):
+    if counts.sum():
         result_summary["accuracy"] = (
             result_summary["true-positive"] + result_summary["true-negative"]
-        ) / len(result)
+        ) / counts.sum()
     return result_summary
 
 
+def get_result_sample(result, result_type, sample_size=10):
+    # index of the first records in one cell of the confusion matrix
+    is_type = result["code"].to_numpy() == RESULT_CODES[result_type]
+    return result.index[np.flatnonzero(is_type)[:sample_size]]
+
+
 def save_regex_to_airtable(row_id, new_regex, exclude_regex, table_name=settings.AIRTABLE_TAGS_TABLE_NAME):
     if not settings.AIRTABLE_SAVE:
         return
     if not new_regex or new_regex == settings.DEFAULT_REGEX:
         return False
-    airtable = Airtable(
-        settings.AIRTABLE_BASE_ID,
+    # sent in the background by the airtable writer
+    queue_airtable_update(
         table_name,
-        settings.AIRTABLE_API_KEY,
-    )
-    record = airtable.update(
         row_id,
         {
             "Regular expression": new_regex,
@@ -303,3 +1330,9 @@ def save_regex_to_airtable(row_id, new_regex, exclude_regex, table_name=settings
         }
     )
     return True
+
+
+@data_cli.command("flush-airtable")
+def flush_airtable():
+    print("{:,.0f} edits waiting to be saved to Airtable".format(len(write_queue)))
+    print("Saved {:,.0f} records".format(airtable_writer.flush()))
@@ -4,6 +4,7 @@ from dash.dependencies import Input, Output
 
 from tagger.app import app
 from tagger.data import data_cli
+from tagger.metrics import init_app
 from tagger import page_tags, page_tag, page_main, page_icnptso_all, page_icnptso
 
 
@@ -34,6 +35,7 @@ base_layout = html.Div(
 
 app.layout = base_layout
 app.server.cli.add_command(data_cli)
+init_app(app.server)
 
 app.validation_layout = html.Div(
     [
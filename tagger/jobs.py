@@ -0,0 +1,257 @@
+import json
+import multiprocessing
+import pickle
+import threading
+import time
+import traceback
+
+from tagger import settings
+from tagger.localdb import LocalDatabase
+from tagger.metrics import metrics
+
+# Slow work for the pages, like matching a regex against the whole charity
+# register, is run as a job outside the web workers. A callback submits the
+# job and the page polls for its progress and result.
+#
+# Jobs are kept in SQLite so that the web workers and the job runner
+# (`flask data jobs`) can share them. The runner starts each job in a forked
+# process, so it sees the data the runner has loaded and can be killed if
+# it is cancelled or runs for too long.
+
+JOB_FUNCTIONS = {}
+FINISHED = ("done", "error", "cancelled")
+
+
+def job_function(func):
+    # register a function that can be run as a job. It is called with the
+    # job's arguments plus `progress(fraction, message)` to report back.
+    JOB_FUNCTIONS[func.__name__] = func
+    return func
+
+
+class JobQueue:
+    def __init__(self, path):
+        self.db = LocalDatabase(
+            path,
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                function TEXT NOT NULL,
+                args TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                progress REAL NOT NULL DEFAULT 0,
+                message TEXT,
+                result BLOB,
+                cancelled INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+            """,
+        )
+
+    def submit(self, function, **args):
+        # returns the job id - a recent finished job with the same
+        # arguments is reused rather than run again
+        args = json.dumps(args, sort_keys=True)
+        now = time.time()
+        with self.db.transaction() as conn:
+            row = conn.execute(
+                """SELECT id FROM jobs
+                WHERE function = ? AND args = ? AND status = 'done' AND finished > ?
+                ORDER BY id DESC LIMIT 1""",
+                (function, args, now - settings.JOB_RESULT_TTL),
+            ).fetchone()
+            if row:
+                return row[0]
+            return conn.execute(
+                "INSERT INTO jobs (function, args, created) VALUES (?, ?, ?)",
+                (function, args, now),
+            ).lastrowid
+
+    def get(self, job_id):
+        row = self.db.connect().execute(
+            """SELECT id, function, args, status, progress, message, result, cancelled
+            FROM jobs WHERE id = ?""",
+            (job_id,),
+        ).fetchone()
+        if not row:
+            return None
+        return {
+            "id": row[0],
+            "function": row[1],
+            "args": json.loads(row[2]),
+            "status": row[3],
+            "progress": row[4],
+            "message": row[5],
+            "result": pickle.loads(row[6]) if row[6] is not None else None,
+            "cancelled": bool(row[7]),
+        }
+
+    def is_same(self, job_id, function, **args):
+        # whether job_id is an uncancelled job of function with these
+        # arguments, so a repeated request can keep it
+        row = self.db.connect().execute(
+            "SELECT 1 FROM jobs WHERE id = ? AND function = ? AND args = ? AND cancelled = 0",
+            (job_id, function, json.dumps(args, sort_keys=True)),
+        ).fetchone()
+        return row is not None
+
+    def cancel(self, job_id):
+        # a queued job is cancelled straight away, a running one when the
+        # runner next checks on it
+        with self.db.transaction() as conn:
+            conn.execute(
+                """UPDATE jobs SET cancelled = 1,
+                    status = CASE status WHEN 'queued' THEN 'cancelled' ELSE status END
+                WHERE id = ? AND status IN ('queued', 'running')""",
+                (job_id,),
+            )
+
+    def get_status(self, job_id):
+        row = self.db.connect().execute(
+            "SELECT status FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def is_cancelled(self, job_id):
+        row = self.db.connect().execute(
+            "SELECT cancelled FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        return bool(row and row[0])
+
+    def claim(self):
+        # the oldest queued job, marked as running
+        with self.db.transaction() as conn:
+            row = conn.execute(
+                """SELECT id, function, args FROM jobs
+                WHERE status = 'queued' ORDER BY id LIMIT 1"""
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started = ? WHERE id = ?",
+                (time.time(), row[0]),
+            )
+        return {"id": row[0], "function": row[1], "args": json.loads(row[2])}
+
+    def progress(self, job_id, fraction, message=None):
+        self.db.connect().execute(
+            "UPDATE jobs SET progress = ?, message = ? WHERE id = ? AND status = 'running'",
+            (fraction, message, job_id),
+        )
+
+    def finish(self, job_id, result):
+        self.db.connect().execute(
+            """UPDATE jobs SET status = 'done', progress = 1, message = NULL, result = ?, finished = ?
+            WHERE id = ? AND status = 'running'""",
+            (pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL), time.time(), job_id),
+        )
+
+    def fail(self, job_id, message, status="error"):
+        self.db.connect().execute(
+            """UPDATE jobs SET status = ?, message = ?, finished = ?
+            WHERE id = ? AND status IN ('queued', 'running')""",
+            (status, message, time.time(), job_id),
+        )
+
+    def counts(self):
+        return dict(self.db.connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def cleanup(self, timeout=settings.JOB_TIMEOUT):
+        now = time.time()
+        with self.db.transaction() as conn:
+            # left running by a runner that has stopped
+            conn.execute(
+                """UPDATE jobs SET status = 'error', message = 'The job runner stopped', finished = ?
+                WHERE status = 'running' AND started < ?""",
+                (now, now - timeout * 2),
+            )
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'error', 'cancelled') AND finished < ?",
+                (now - settings.JOB_RESULT_TTL,),
+            )
+
+
+def run_job(queue, job):
+    # runs in the forked process
+    def progress(fraction, message=None):
+        queue.progress(job["id"], fraction, message)
+
+    try:
+        result = JOB_FUNCTIONS[job["function"]](progress=progress, **job["args"])
+    except Exception as err:
+        traceback.print_exc()
+        queue.fail(job["id"], str(err))
+        return
+    queue.finish(job["id"], result)
+
+
+class JobRunner:
+    def __init__(self, queue, workers=settings.JOB_WORKERS, timeout=settings.JOB_TIMEOUT):
+        self.queue = queue
+        self.workers = workers
+        self.timeout = timeout
+        self.running = {}
+        self._context = multiprocessing.get_context("fork")
+        self._thread = None
+
+    def run(self):
+        while True:
+            self.step()
+            time.sleep(settings.JOB_POLL_INTERVAL)
+
+    def start(self):
+        # run in a thread of this process, eg for the development server
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self.run, name="job-runner", daemon=True)
+        self._thread.start()
+
+    def step(self):
+        now = time.time()
+        for job_id, (process, started, function) in list(self.running.items()):
+            if not process.is_alive():
+                process.join()
+                if process.exitcode != 0:
+                    self.queue.fail(job_id, "The job stopped unexpectedly")
+                status = self.queue.get_status(job_id)
+            elif self.queue.is_cancelled(job_id):
+                self.stop(process)
+                self.queue.fail(job_id, "Cancelled", status="cancelled")
+                status = "cancelled"
+            elif now - started > self.timeout:
+                self.stop(process)
+                self.queue.fail(job_id, "Took longer than {:,.0f} seconds".format(self.timeout))
+                status = "timeout"
+            else:
+                continue
+            del self.running[job_id]
+            metrics.observe("tagger_job_seconds", time.time() - started, function=function, status=status)
+
+        while len(self.running) < self.workers:
+            job = self.queue.claim()
+            if not job:
+                break
+            if job["function"] not in JOB_FUNCTIONS:
+                self.queue.fail(job["id"], "Unknown job {}".format(job["function"]))
+                continue
+            process = self._context.Process(
+                target=run_job, args=(self.queue, job), name="job-{}".format(job["id"])
+            )
+            process.start()
+            self.running[job["id"]] = (process, now, job["function"])
+
+        self.queue.cleanup(self.timeout)
+
+    @staticmethod
+    def stop(process):
+        process.terminate()
+        process.join(5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+
+job_queue = JobQueue(settings.JOB_QUEUE)
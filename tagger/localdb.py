@@ -0,0 +1,50 @@
+from contextlib import contextmanager
+import os
+import sqlite3
+import threading
+
+
+# A SQLite database in DATA_DIR shared by the web workers and the flask
+# commands. Connections can't be shared between threads or carried across a
+# fork, so one is opened for each thread of each process when first used.
+# WAL mode lets readers carry on while something is writing.
+class LocalDatabase:
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self._local = threading.local()
+        self._inherited = []
+
+    def connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            if conn is not None:
+                # opened before a fork - closing it here could disturb the
+                # parent's locks, so it is kept open and left alone
+                self._inherited.append(conn)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.schema)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+    @contextmanager
+    def transaction(self):
+        # takes the write lock straight away, so reads inside the
+        # transaction can't be made stale by another writer
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
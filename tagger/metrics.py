@@ -0,0 +1,268 @@
+import atexit
+import bisect
+import functools
+import json
+import math
+import os
+import re
+import threading
+import time
+
+from flask import Response, g, request
+
+from tagger import settings
+from tagger.localdb import LocalDatabase
+
+# Timings and gauges for the /metrics route, in the Prometheus text format.
+#
+# Each process counts its timings in memory and adds them to a SQLite table
+# in DATA_DIR every METRICS_FLUSH_INTERVAL seconds, so /metrics shows the
+# totals for all the gunicorn workers, the job runner and
+# `flask data initialise`, whichever worker serves it. Values that belong
+# to one process, like its cache hit counts, are stored with its pid.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, math.inf)
+STAGE_METRIC = "tagger_stage_seconds"
+DESCRIPTIONS = {
+    STAGE_METRIC: ("histogram", "Time spent in each stage of the page callbacks and data initialise"),
+    "tagger_request_seconds": ("histogram", "Time to answer a Dash callback request, including serialising the output"),
+    "tagger_dataset_load_seconds": ("histogram", "Time to load a dataset into the dataset cache"),
+    "tagger_job_seconds": ("histogram", "Time background jobs ran for"),
+}
+
+
+class Metrics:
+    def __init__(self, path, flush_interval=settings.METRICS_FLUSH_INTERVAL):
+        self.db = LocalDatabase(
+            path,
+            """
+            CREATE TABLE IF NOT EXISTS histogram_buckets (
+                name TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (name, labels, bucket)
+            );
+            CREATE TABLE IF NOT EXISTS histogram_sums (
+                name TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                sum REAL NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (name, labels)
+            );
+            CREATE TABLE IF NOT EXISTS process_values (
+                pid INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                value REAL NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (pid, name, labels)
+            );
+            """,
+        )
+        self.flush_interval = flush_interval
+        # functions yielding (name, type, help, labels, value) tuples
+        self.process_collectors = []
+        self.collectors = []
+        self._pending = {}
+        self._pid = os.getpid()
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+
+    def collector(self, func):
+        # a function giving values shared by every process, read when
+        # /metrics is requested
+        self.collectors.append(func)
+        return func
+
+    def process_collector(self, func):
+        # a function giving values for this process, stored with its pid
+        self.process_collectors.append(func)
+        return func
+
+    def observe(self, name, seconds, **labels):
+        key = (name, json.dumps(labels, sort_keys=True))
+        with self._lock:
+            if self._pid != os.getpid():
+                # counts inherited through a fork belong to the parent
+                self._pending = {}
+                self._pid = os.getpid()
+            counts = self._pending.setdefault(key, [0] * len(BUCKETS) + [0.0, 0])
+            counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+            counts[-2] += seconds
+            counts[-1] += 1
+            due = time.monotonic() - self._flushed > self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pending = {}
+                self._pid = os.getpid()
+            pending, self._pending = self._pending, {}
+            self._flushed = time.monotonic()
+        values = [
+            (os.getpid(), name, json.dumps(labels, sort_keys=True), value, time.time())
+            for collector in self.process_collectors
+            for name, _, _, labels, value in collector()
+        ]
+        with self.db.transaction() as conn:
+            for (name, labels), counts in pending.items():
+                conn.executemany(
+                    """INSERT INTO histogram_buckets (name, labels, bucket, count) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (name, labels, bucket) DO UPDATE SET count = count + excluded.count""",
+                    [(name, labels, i, count) for i, count in enumerate(counts[:-2]) if count],
+                )
+                conn.execute(
+                    """INSERT INTO histogram_sums (name, labels, sum, count) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (name, labels) DO UPDATE
+                    SET sum = sum + excluded.sum, count = count + excluded.count""",
+                    (name, labels, counts[-2], counts[-1]),
+                )
+            conn.executemany(
+                "INSERT OR REPLACE INTO process_values (pid, name, labels, value, updated) VALUES (?, ?, ?, ?, ?)",
+                values,
+            )
+            # processes that have stopped
+            conn.execute(
+                "DELETE FROM process_values WHERE updated < ?",
+                (time.time() - settings.METRICS_PROCESS_TTL,),
+            )
+
+    def collect(self):
+        self.flush()
+        conn = self.db.connect()
+        lines = []
+        histograms = {}
+        for name, labels, bucket, count in conn.execute(
+            "SELECT name, labels, bucket, count FROM histogram_buckets"
+        ):
+            histograms.setdefault((name, labels), [0] * len(BUCKETS))[bucket] = count
+        sums = {
+            (name, labels): (total, count)
+            for name, labels, total, count in conn.execute(
+                "SELECT name, labels, sum, count FROM histogram_sums"
+            )
+        }
+        for name in sorted({name for name, _ in histograms}):
+            kind, help_text = DESCRIPTIONS.get(name, ("histogram", name))
+            lines += ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, kind)]
+            for (metric, labels), counts in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                labels = json.loads(labels)
+                cumulative = 0
+                for le, count in zip(BUCKETS, counts):
+                    cumulative += count
+                    lines.append(sample(name + "_bucket", dict(labels, le=format_value(le)), cumulative))
+                total, count = sums.get((name, json.dumps(labels, sort_keys=True)), (0, 0))
+                lines.append(sample(name + "_sum", labels, total))
+                lines.append(sample(name + "_count", labels, count))
+
+        values = {}
+        for collector in self.collectors:
+            for name, kind, help_text, labels, value in collector():
+                values.setdefault((name, kind, help_text), []).append((labels, value))
+        process_help = {
+            name: (kind, help_text)
+            for collector in self.process_collectors
+            for name, kind, help_text, _, _ in collector()
+        }
+        for pid, name, labels, value in conn.execute(
+            "SELECT pid, name, labels, value FROM process_values ORDER BY name, pid, labels"
+        ):
+            kind, help_text = process_help.get(name, ("gauge", name))
+            values.setdefault((name, kind, help_text), []).append(
+                (dict(json.loads(labels), pid=str(pid)), value)
+            )
+        for (name, kind, help_text), samples in values.items():
+            lines += ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, kind)]
+            lines += [sample(name, labels, value) for labels, value in samples]
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def sample(name, labels, value):
+    if not labels:
+        return "{} {}".format(name, format_value(value))
+    return "{}{{{}}} {}".format(
+        name,
+        ",".join(
+            '{}="{}"'.format(
+                key, str(label).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+            )
+            for key, label in labels.items()
+        ),
+        format_value(value),
+    )
+
+
+metrics = Metrics(settings.METRICS_DB)
+_timers = threading.local()
+
+
+def timed(func):
+    # Time each call to func in tagger_stage_seconds with stage="total".
+    # Inside it, lap("name") records the time since the start or the last
+    # lap as that stage.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = _timers.__dict__.setdefault("stack", [])
+        start = time.perf_counter()
+        stack.append([func.__name__, start])
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack.pop()
+            metrics.observe(
+                STAGE_METRIC, time.perf_counter() - start, function=func.__name__, stage="total"
+            )
+
+    return wrapper
+
+
+def lap(stage):
+    stack = getattr(_timers, "stack", None)
+    if not stack:
+        return
+    now = time.perf_counter()
+    function, last = stack[-1]
+    stack[-1][1] = now
+    metrics.observe(STAGE_METRIC, now - last, function=function, stage=stage)
+
+
+def init_app(server):
+    # add /metrics and time the Dash callback requests
+    @server.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def stop_timer(response):
+        if request.path.endswith("/_dash-update-component") and "metrics_start" in g:
+            output = (request.get_json(silent=True) or {}).get("output", "")
+            # the first output's id, eg "tag-header" from "..tag-header.children...."
+            match = re.match(r"\.*([^.]+)\.", output)
+            metrics.observe(
+                "tagger_request_seconds",
+                time.perf_counter() - g.metrics_start,
+                callback=match.group(1) if match else output,
+            )
+        return response
+
+    @server.route("/metrics")
+    def metrics_route():
+        return Response(metrics.collect(), mimetype="text/plain; version=0.0.4")
+
+
+@atexit.register
+def _flush_on_exit():
+    if metrics._pid == os.getpid():
+        metrics.flush()
+        metrics.db.connect().execute("DELETE FROM process_values WHERE pid = ?", (os.getpid(),))
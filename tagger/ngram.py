@@ -0,0 +1,142 @@
+import numpy as np
+
+from tagger.columnar import read_bundle, write_bundle
+from tagger.patterns import REGEX_FLAGS, fold_case, required_literals
+
+NGRAM_SIZE = 3
+# records turned into trigrams at a time when building an index
+INDEX_CHUNK_SIZE = 10000
+# bits for each code point in a packed trigram
+CODE_POINT_BITS = 21
+
+
+# Inverted index from each trigram of the (case folded) corpus to the
+# positions of the records that contain it. Used to narrow down the records
+# a regular expression needs to be run against. The trigrams are kept as a
+# sorted array so the whole index can be memory-mapped from disk.
+class TrigramIndex:
+    def __init__(self, trigrams, offsets, postings, size, corpus_version=None):
+        self.trigrams = trigrams
+        self.offsets = offsets
+        self.postings = postings
+        self.size = size
+        self.corpus_version = corpus_version
+
+    @classmethod
+    def build(cls, corpus, corpus_version=None):
+        # Each trigram is packed into an integer from its code points, and
+        # the postings are sorted as (trigram, row) pairs packed into one
+        # integer, so numpy does the work.
+        texts = [fold_case(text) for text in corpus.fillna("").to_numpy(dtype=object)]
+        chunks = [
+            _trigram_postings(texts[start : start + INDEX_CHUNK_SIZE], start)
+            for start in range(0, len(texts), INDEX_CHUNK_SIZE)
+        ]
+        keys = np.concatenate([np.zeros(0, dtype=np.uint64)] + [keys for keys, _ in chunks])
+        rows = np.concatenate([np.zeros(0, dtype=np.int64)] + [rows for _, rows in chunks])
+        del chunks
+        trigrams, pairs = _sorted_pairs(keys, rows)
+        return cls(
+            trigrams=_unpack_trigrams(trigrams),
+            offsets=np.searchsorted(pairs >> 32, np.arange(len(trigrams) + 1)).astype(np.int64),
+            postings=(pairs & 0xFFFFFFFF).astype(np.int32),
+            size=len(corpus),
+            corpus_version=corpus_version,
+        )
+
+    def save(self, path):
+        write_bundle(
+            path,
+            {"trigrams": self.trigrams, "offsets": self.offsets, "postings": self.postings},
+            {"type": "trigram_index", "size": self.size, "corpus_version": self.corpus_version},
+        )
+
+    @classmethod
+    def load(cls, path):
+        arrays, meta = read_bundle(path)
+        return cls(
+            trigrams=arrays["trigrams"],
+            offsets=arrays["offsets"],
+            postings=arrays["postings"],
+            size=meta["size"],
+            corpus_version=meta["corpus_version"],
+        )
+
+    def rows(self, gram):
+        n = np.searchsorted(self.trigrams, gram)
+        if n == len(self.trigrams) or self.trigrams[n] != gram:
+            return np.zeros(0, dtype=np.int32)
+        return self.postings[self.offsets[n] : self.offsets[n + 1]]
+
+    def literal_rows(self, literal):
+        # records containing every trigram of the literal, or None if the
+        # literal is too short to look up
+        if len(literal) < NGRAM_SIZE:
+            return None
+        grams = sorted(
+            {literal[j : j + NGRAM_SIZE] for j in range(len(literal) - NGRAM_SIZE + 1)},
+            key=lambda gram: len(self.rows(gram)),
+        )
+        rows = self.rows(grams[0])
+        for gram in grams[1:]:
+            if not len(rows):
+                break
+            rows = np.intersect1d(rows, self.rows(gram), assume_unique=True)
+        return rows
+
+    def candidates(self, pattern, flags=REGEX_FLAGS):
+        # Positions of the records that could match the pattern, or None if
+        # no literals could be extracted and every record needs checking.
+        # Each set of required literals gives the union of the records that
+        # contain one of them, and those unions are intersected.
+        candidates = None
+        for literals in required_literals(pattern, flags):
+            rows = [self.literal_rows(literal) for literal in literals]
+            if any(r is None for r in rows):
+                continue
+            rows = np.unique(np.concatenate(rows))
+            if candidates is None:
+                candidates = rows
+            else:
+                candidates = np.intersect1d(candidates, rows, assume_unique=True)
+        return candidates
+
+
+def _trigram_postings(texts, first_row):
+    # the packed trigrams in each text, once per text, and the row of the
+    # text they're from
+    lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+    codes = np.frombuffer(
+        "".join(texts).encode("utf-32-le", "surrogatepass"), dtype="<u4"
+    ).astype(np.uint64)
+    positions = len(codes) - NGRAM_SIZE + 1
+    if positions <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    keys = np.zeros(positions, dtype=np.uint64)
+    for j in range(NGRAM_SIZE):
+        keys |= codes[j : j + positions] << np.uint64(CODE_POINT_BITS * (NGRAM_SIZE - 1 - j))
+    row_of = np.repeat(np.arange(first_row, first_row + len(texts), dtype=np.int64), lengths)
+    # leave out trigrams that run over the end of a text
+    within = row_of[:positions] == row_of[NGRAM_SIZE - 1 :]
+    trigrams, pairs = _sorted_pairs(keys[within], row_of[:positions][within])
+    return trigrams[pairs >> 32], pairs & 0xFFFFFFFF
+
+
+def _sorted_pairs(keys, rows):
+    # the distinct trigrams, and the distinct (trigram, row) pairs sorted by
+    # trigram then row, as the trigram's position << 32 | row
+    trigrams = np.unique(keys)
+    pairs = np.searchsorted(trigrams, keys).astype(np.int64) << 32 | rows
+    pairs.sort()
+    return trigrams, pairs[np.concatenate([[True], pairs[1:] != pairs[:-1]])]
+
+def _unpack_trigrams(keys):
+    mask = np.uint64((1 << CODE_POINT_BITS) - 1)
+    codes = np.stack(
+        [
+            (keys >> np.uint64(CODE_POINT_BITS * (NGRAM_SIZE - 1 - j))) & mask
+            for j in range(NGRAM_SIZE)
+        ],
+        axis=1,
+    ).astype("<u4")
+    return np.ascontiguousarray(codes).view("<U{}".format(NGRAM_SIZE)).ravel()
@@ -9,17 +9,24 @@ import pandas as pd
 
 from tagger.app import app
 from tagger.data import (
+    RESULT_METRICS,
     RESULT_TYPES,
     get_keyword_result,
+    get_match_spans,
     get_result_summary,
+    get_result_sample,
     save_regex_to_airtable,
     get_icnptso_used,
     get_completed_data,
-    save_icnptso_used,
-    get_all_charities,
+    update_icnptso_used,
+    rule_changed,
+    submit_all_charities_job,
+    cancel_all_charities_job,
 )
-from tagger.utils import stats_box, highlight_regex, get_icnptso_name
-from tagger.settings import AIRTABLE_ICNPTSO_TABLE_NAME, DEFAULT_REGEX, ICNPTSO_FIELD_NAME, AIRTABLE_SAVE
+from tagger.jobs import FINISHED, job_queue
+from tagger.metrics import lap, timed
+from tagger.utils import stats_box, highlight_match, all_charities_job_content, get_icnptso_name
+from tagger.settings import AIRTABLE_ICNPTSO_TABLE_NAME, DEFAULT_REGEX, ICNPTSO_FIELD_NAME, AIRTABLE_SAVE, JOB_PAGE_POLL_INTERVAL, REGEX_TIME_LIMIT
 
 
 layout = [
@@ -70,10 +77,14 @@ layout = [
         children=[
             dcc.Tab(label="Sample results", value="sample-match"),
             dcc.Tab(label="Match against all charities", value="all-charity-match"),
+            dcc.Tab(label="Exact count over the register", value="all-charity-exact"),
         ],
         className="mv3",
     ),
     html.Div(id="category-result-tab-content", className="flex flex-wrap"),
+    html.Div(id="category-job-content", className="flex flex-wrap"),
+    dcc.Store(id="category-job"),
+    dcc.Interval(id="category-job-poll", interval=JOB_PAGE_POLL_INTERVAL, disabled=True),
 ]
 
 
@@ -109,6 +120,7 @@ def category_regex_setup(pathname):
         Output("category-header", "children"),
         Output("category-result-summary", "children"),
         Output("category-result-tab-content", "children"),
+        Output("category-job", "data"),
     ],
     [
         Input("category-regex", "n_blur"),
@@ -119,11 +131,24 @@ def category_regex_setup(pathname):
         Input("category-regex", "value"),
         Input("category-regex-exclude", "value"),
         State("url", "pathname"),
+        State("category-job", "data"),
     ],
 )
-def category_regex_page(_, __, result_tab, keyword_regex, exclude_regex, pathname):
+@timed
+def category_regex_page(_, __, result_tab, keyword_regex, exclude_regex, pathname, previous_job):
+    job_tab = result_tab in ("all-charity-match", "all-charity-exact")
+    if previous_job:
+        # the last job is cancelled if the regex or tab has changed
+        cancel_all_charities_job(
+            previous_job,
+            keyword_regex,
+            exclude_regex,
+            exact=result_tab == "all-charity-exact" if job_tab else None,
+        )
     categories_used = get_icnptso_used()
-    df, corpus = get_completed_data()
+    lap("load_rules")
+    df, corpus, version = get_completed_data()
+    lap("load_data")
     category_slug = pathname[9:]
     try:
         category = categories_used.loc[categories_used["Code"] == category_slug, :].iloc[0]
@@ -131,7 +156,8 @@ def category_regex_page(_, __, result_tab, keyword_regex, exclude_regex, pathnam
         return (
             category_slug,
             [],
-            []
+            [],
+            None,
         )
     try:
         result = get_keyword_result(
@@ -140,66 +166,46 @@ def category_regex_page(_, __, result_tab, keyword_regex, exclude_regex, pathnam
             df,
             corpus,
             icnptso=category["Code"],
+            version=version,
+        )
+        samples = {r: get_result_sample(result, r) for r in RESULT_TYPES}
+        # only the records shown are searched for the matches to highlight
+        matches = get_match_spans(
+            corpus,
+            [index for sample in samples.values() for index in sample],
+            keyword_regex,
+            time_limit=REGEX_TIME_LIMIT,
         )
     except re.error as err:
-        return ([get_icnptso_name(category), html.Div(str(err), className="bg-red white pa3")], [])
+        return [get_icnptso_name(category), html.Div(str(err), className="bg-red white pa3"), [], None]
     result_summary = get_result_summary(result)
-    categories_used.loc[category.name, "Regular expression"] = keyword_regex
-    categories_used.loc[category.name, "precision"] = result_summary["precision"]
-    categories_used.loc[category.name, "recall"] = result_summary["recall"]
-    categories_used.loc[category.name, "f1score"] = result_summary["f1score"]
-    categories_used.loc[category.name, "accuracy"] = result_summary["accuracy"]
+    lap("match")
     save_regex_to_airtable(category.name, keyword_regex, exclude_regex, AIRTABLE_ICNPTSO_TABLE_NAME)
     if AIRTABLE_SAVE:
-        save_icnptso_used(categories_used)
+        # a match from the cache wasn't timed, so the stored cost is kept
+        # unless it was for different regexes
+        cost = result.attrs["cost"]
+        if cost is None and rule_changed(category, keyword_regex, exclude_regex):
+            cost = pd.NA
+        update_icnptso_used(category.name, {
+            "Regular expression": keyword_regex,
+            "Exclude regular expression": exclude_regex,
+            **{m: result_summary[m] for m in RESULT_METRICS},
+            **({"cost": cost} if cost is not None else {}),
+        })
+    lap("save")
 
     # get tab content
-    if result_tab == "all-charity-match":
-        all_charities, all_charities_group = get_all_charities(keyword_regex, exclude_regex)
-        result_tab_content = [
-            html.Div([
-                html.P("{:,.2%} of charities match this category ({:,.0f} estimated)".format(
-                    all_charities_group.loc["Total", "percentage"],
-                    all_charities_group.loc["Total", "estimated_total"],
-                ), className="w-100"),
-                html.Table([
-                    html.Tr([
-                        html.Th("Income band", className="pv2 ph3"),
-                        html.Th("Proportion matching", className="pv2 ph3"),
-                        html.Th("Estimated total", className="pv2 ph3"),
-                    ])
-                ] + [
-                    html.Tr([
-                        html.Th(index, className="pv2 ph3"),
-                        html.Td("{:,.2%}".format(row["percentage"]), className="pv2 ph3 tr"),
-                        html.Td("{:,.0f}".format(row["estimated_total"]), className="pv2 ph3 tr"),
-                    ], className="striped--light-gray ") for index, row in all_charities_group.iterrows()
-                ], className="collapse"),
-            ], className="w-100"),
-            html.Ul([
-                html.Li(
-                    children=[
-                        html.H4(
-                            DangerouslySetInnerHTML(
-                                highlight_regex(
-                                    row["name"], keyword_regex
-                                ),
-                            ),
-                        ),
-                        html.P(
-                            DangerouslySetInnerHTML(
-                                highlight_regex(
-                                    row["activities"], keyword_regex
-                                ),
-                            ),
-                            className="f6",
-                        ),
-                    ],
-                    className="mv2 mw6",
-                )
-                for index, row in all_charities.iterrows()
-            ], style={"columns": 4})
-        ]
+    job_id = None
+    if job_tab:
+        # matched by the job runner, the result is shown by category_job_poll
+        job_id = submit_all_charities_job(
+            keyword_regex,
+            exclude_regex,
+            exact=result_tab == "all-charity-exact",
+            previous_job=previous_job,
+        )
+        result_tab_content = []
     else:
         result_tab_content = [
             html.Div(
@@ -223,16 +229,12 @@ def category_regex_page(_, __, result_tab, keyword_regex, exclude_regex, pathnam
                                     children=[
                                         html.H4(
                                             DangerouslySetInnerHTML(
-                                                highlight_regex(
-                                                    row["name"], keyword_regex
-                                                ),
+                                                highlight_match(matches[index], row["name"], "name"),
                                             ),
                                         ),
                                         html.P(
                                             DangerouslySetInnerHTML(
-                                                highlight_regex(
-                                                    row["activities"], keyword_regex
-                                                ),
+                                                highlight_match(matches[index], row["name"], "activities"),
                                             ),
                                             className="f6",
                                         ),
@@ -252,9 +254,7 @@ def category_regex_page(_, __, result_tab, keyword_regex, exclude_regex, pathnam
                                     ],
                                     className="mv2",
                                 )
-                                for index, row in df.loc[result["result"] == r, :]
-                                .head(10)
-                                .iterrows()
+                                for index, row in df.loc[samples[r], :].iterrows()
                             ],
                             className="list pa0 ma0",
                         )
@@ -265,7 +265,7 @@ def category_regex_page(_, __, result_tab, keyword_regex, exclude_regex, pathnam
             for r, description in RESULT_TYPES.items()
         ]
 
-    return [
+    output = [
         get_icnptso_name(category),
         [
             html.P(
@@ -304,4 +304,26 @@ def category_regex_page(_, __, result_tab, keyword_regex, exclude_regex, pathnam
             ),
         ],
         result_tab_content,
+        job_id,
+    ]
+    lap("render")
+    return output
+
+
+@app.callback(
+    [
+        Output("category-job-content", "children"),
+        Output("category-job-poll", "disabled"),
+    ],
+    [
+        Input("category-job", "data"),
+        Input("category-job-poll", "n_intervals"),
+    ],
+)
+def category_job_poll(job_id, _):
+    job = job_queue.get(job_id) if job_id else None
+    # stop polling once there's nothing more to wait for
+    return [
+        all_charities_job_content(job, "category"),
+        job is None or job["status"] in FINISHED,
     ]
@@ -1,18 +1,31 @@
+import functools
+
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
-
-import pandas as pd
+from dash.dependencies import ClientsideFunction, Input, Output, State
 
 from tagger.app import app
 from tagger.data import get_icnptso_used
-from tagger.utils import stat_colour, get_icnptso_name
+from tagger.metrics import lap, timed
+from tagger.settings import CLIENTSIDE_TABLES, ROW_CACHE_SIZE
+from tagger.utils import (
+    cost_colour,
+    filter_rows,
+    format_cost,
+    get_icnptso_name,
+    get_table_page,
+    pagination_layout,
+    row_values,
+    stat_cell,
+    table_data,
+)
 
 layout = [
     html.Div([
         html.Div([
             dcc.Input(
                 id="filter-categories",
+                debounce=not CLIENTSIDE_TABLES,
                 placeholder="Filter categories",
                 type="text",
                 value="",
@@ -45,6 +58,7 @@ layout = [
                         {"value": "f1score", "label": "F1 score"},
                         {"value": "precision", "label": "Precision"},
                         {"value": "recall", "label": "Recall"},
+                        {"value": "cost", "label": "Cost"},
                     ],
                     value="frequency",
                     className="mw5 mb1",
@@ -78,6 +92,11 @@ layout = [
                             html.Th("Precision", className="pv2 ph3 tl f6 fw6 ttu tr"),
                             html.Th("Recall", className="pv2 ph3 tl f6 fw6 ttu tr"),
                             html.Th("Frequency", className="pv2 ph3 tl f6 fw6 ttu tr"),
+                            html.Th(
+                                "Cost",
+                                className="pv2 ph3 tl f6 fw6 ttu tr",
+                                title="Time taken to match the regular expression against the labelled sample",
+                            ),
                         ]
                     )
                 ]
@@ -89,72 +108,103 @@ layout = [
         ],
         className="collapse ba br2 b--black-10 pv2 ph3 mt4",
     ),
+    pagination_layout("categories"),
+    dcc.Store(id="categories-table"),
 ]
 
 
-@app.callback(
-    [
-        Output("categories-to-choose", "children"),
-        Output("category-stats", "children"),
-    ],
-    [
-        Input("filter-categories", "value"),
-        Input("show-rows", "value"),
-        Input("order-by", "value"),
-        Input("order-by-direction", "value"),
-    ],
-)
-def filter_icnptso_main_page(filter_value, show_rows_regex, order_by, order_by_direction):
-    def stat_cell(row, field):
-        className = "pv2 ph3 tr "
-        if not isinstance(row.get(field), float):
-            return html.Td("-", className=className)
-        value = row[field]
-        colour = stat_colour(value)
-        return html.Td("{:.0%}".format(value), className=className + colour)
+# the columns passed to category_row
+CATEGORY_COLUMNS = [
+    "Code",
+    "Title",
+    "Regular expression",
+    "Exclude regular expression",
+    "f1score",
+    "precision",
+    "recall",
+    "frequency",
+    "cost",
+]
+
+
+# Rows are rendered once for each set of values and reused until they change
+@functools.lru_cache(maxsize=ROW_CACHE_SIZE)
+def category_row(code, title, regex, exclude, f1score, precision, recall, frequency, cost):
+    return html.Tr(
+        children=[
+            html.Td(
+                dcc.Link(get_icnptso_name({"Code": code, "Title": title}), href="/icnptso/{}".format(code)),
+                className="pv2 ph3",
+            ),
+            html.Td(
+                [html.Code(regex)] + ([
+                    html.Br(),
+                    html.Code(exclude, className="red strike")
+                ] if exclude is not None else []),
+                className="pv2 ph3 mw6",
+                style={"word-break": "break-word"}
+            ),
+            stat_cell(f1score),
+            stat_cell(precision),
+            stat_cell(recall),
+            html.Td(frequency, className="pv2 ph3 tr"),
+            html.Td(format_cost(cost), className="pv2 ph3 tr " + cost_colour(cost)),
+        ],
+        className="striped--near-white",
+    )
+
+
+# the table callback, run by the function below or by filter_table in
+# assets/tables.js when CLIENTSIDE_TABLES is set
+CATEGORIES_OUTPUTS = [
+    Output("categories-to-choose", "children"),
+    Output("category-stats", "children"),
+    Output("categories-page", "data"),
+    Output("categories-page-info", "children"),
+    Output("categories-previous", "disabled"),
+    Output("categories-next", "disabled"),
+]
+CATEGORIES_INPUTS = [
+    Input("filter-categories", "value"),
+    Input("show-rows", "value"),
+    Input("order-by", "value"),
+    Input("order-by-direction", "value"),
+    Input("categories-page-size", "value"),
+    Input("categories-previous", "n_clicks"),
+    Input("categories-next", "n_clicks"),
+]
+CATEGORIES_STATE = [State("categories-page", "data")]
+
 
+@timed
+def filter_icnptso_main_page(
+    filter_value, show_rows_regex, order_by, order_by_direction, page_size, _, __, page
+):
     cats_used = get_icnptso_used()
-    rows_to_show = cats_used.copy()
+    lap("load_rules")
+    rows_to_show = cats_used
     if show_rows_regex == "with":
         rows_to_show = rows_to_show[rows_to_show["Regular expression"].notnull()]
     elif show_rows_regex == "without":
         rows_to_show = rows_to_show[rows_to_show["Regular expression"].isnull()]
     if filter_value:
-        rows_to_show = rows_to_show[rows_to_show["Code"].str.contains(filter_value, case=False)]
+        rows_to_show = filter_rows(rows_to_show, "Code", filter_value)
 
-    if order_by not in ["frequency", "f1score", "precision", "recall"]:
+    if order_by not in ["frequency", "f1score", "precision", "recall", "cost"] or (
+        order_by not in rows_to_show.columns
+    ):
         order_by = ["Code"]
 
     rows_to_show = rows_to_show.sort_values(
         order_by, ascending=(order_by_direction == "ascending")
     )
+    page_rows, page, page_info, first_page, last_page = get_table_page(
+        rows_to_show, page, page_size
+    )
+    lap("filter")
 
-    return [
-        [
-            html.Tr(
-                children=[
-                    html.Td(
-                        dcc.Link(get_icnptso_name(row), href="/icnptso/{}".format(row["Code"])),
-                        className="pv2 ph3",
-                    ),
-                    html.Td(
-                        [html.Code(row["Regular expression"])] + ([
-                            html.Br(),
-                            # html.Strong("Exclude:"), 
-                            html.Code(row.get("Exclude regular expression"), className="red strike")
-                        ] if not pd.isna(row.get("Exclude regular expression")) else []),
-                        className="pv2 ph3 mw6",
-                        style={"word-break": "break-word"}
-                    ),
-                    stat_cell(row, "f1score"),
-                    stat_cell(row, "precision"),
-                    stat_cell(row, "recall"),
-                    html.Td(row["frequency"], className="pv2 ph3 tr"),
-                ],
-                className="striped--near-white",
-            )
-            for index, row in rows_to_show.iterrows()
-        ],
+    output = [
+        [category_row(*values) for values in row_values(page_rows, CATEGORY_COLUMNS)],
         [
             html.Ul(
                 [
@@ -182,5 +232,36 @@ def filter_icnptso_main_page(filter_value, show_rows_regex, order_by, order_by_d
                 ],
                 className="list ma0 pa0"
             )
-        ]
+        ],
+        page,
+        page_info,
+        first_page,
+        last_page,
     ]
+    lap("render")
+    return output
+
+
+@timed
+def categories_table(_):
+    return table_data(
+        get_icnptso_used(),
+        "categories",
+        get_icnptso_name,
+        lambda row: "/icnptso/{}".format(row["Code"]),
+        "Code",
+        ["Code"],
+    )
+
+
+if CLIENTSIDE_TABLES:
+    # the browser filters, sorts and pages the table - see assets/tables.js
+    app.callback(Output("categories-table", "data"), [Input("url", "pathname")])(categories_table)
+    app.clientside_callback(
+        ClientsideFunction(namespace="tables", function_name="filter_table"),
+        CATEGORIES_OUTPUTS,
+        CATEGORIES_INPUTS + [Input("categories-table", "data")],
+        CATEGORIES_STATE,
+    )
+else:
+    app.callback(CATEGORIES_OUTPUTS, CATEGORIES_INPUTS, CATEGORIES_STATE)(filter_icnptso_main_page)
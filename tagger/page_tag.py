@@ -9,17 +9,24 @@ import pandas as pd
 
 from tagger.app import app
 from tagger.data import (
+    RESULT_METRICS,
     RESULT_TYPES,
     get_keyword_result,
+    get_match_spans,
     get_result_summary,
+    get_result_sample,
     save_regex_to_airtable,
     get_tags_used,
     get_completed_data,
-    save_tags_used,
-    get_all_charities,
+    update_tag_used,
+    rule_changed,
+    submit_all_charities_job,
+    cancel_all_charities_job,
 )
-from tagger.utils import stats_box, highlight_regex
-from tagger.settings import DEFAULT_REGEX, TAGS_FIELD_NAME, AIRTABLE_SAVE
+from tagger.jobs import FINISHED, job_queue
+from tagger.metrics import lap, timed
+from tagger.utils import stats_box, highlight_match, all_charities_job_content
+from tagger.settings import DEFAULT_REGEX, TAGS_FIELD_NAME, AIRTABLE_SAVE, JOB_PAGE_POLL_INTERVAL, REGEX_TIME_LIMIT
 
 
 layout = [
@@ -72,10 +79,14 @@ layout = [
         children=[
             dcc.Tab(label="Sample results", value="sample-match"),
             dcc.Tab(label="Match against all charities", value="all-charity-match"),
+            dcc.Tab(label="Exact count over the register", value="all-charity-exact"),
         ],
         className="mv3",
     ),
     html.Div(id="result-tab-content", className="flex flex-wrap"),
+    html.Div(id="tag-job-content", className="flex flex-wrap"),
+    dcc.Store(id="tag-job"),
+    dcc.Interval(id="tag-job-poll", interval=JOB_PAGE_POLL_INTERVAL, disabled=True),
 ]
 
 
@@ -111,6 +122,7 @@ def tag_regex_setup(pathname):
         Output("tag-header", "children"),
         Output("result-summary", "children"),
         Output("result-tab-content", "children"),
+        Output("tag-job", "data"),
     ],
     [
         Input("tag-regex", "value"),
@@ -119,22 +131,33 @@ def tag_regex_setup(pathname):
     ],
     [
         State("url", "pathname"),
+        State("tag-job", "data"),
     ],
 )
-def tag_regex_page(keyword_regex, exclude_regex, result_tab, pathname):
+@timed
+def tag_regex_page(keyword_regex, exclude_regex, result_tab, pathname, previous_job):
+    job_tab = result_tab in ("all-charity-match", "all-charity-exact")
+    if previous_job:
+        # the last job is cancelled if the regex or tab has changed
+        cancel_all_charities_job(
+            previous_job,
+            keyword_regex,
+            exclude_regex,
+            exact=result_tab == "all-charity-exact" if job_tab else None,
+        )
     tags_used = get_tags_used()
-    df, corpus = get_completed_data()
+    lap("load_rules")
+    df, corpus, version = get_completed_data()
+    lap("load_data")
     tag_slug = pathname[5:]
     try:
         tag = tags_used.loc[tags_used["tag_slug"] == tag_slug, :].iloc[0]
     except IndexError as e:
         return (
-            [
-                None,
-                None,
-            ]
-            + [None for r in RESULT_TYPES.keys()]
-            + [None for r in RESULT_TYPES.keys()]
+            tag_slug,
+            [],
+            [],
+            None,
         )
     try:
         result = get_keyword_result(
@@ -143,66 +166,46 @@ def tag_regex_page(keyword_regex, exclude_regex, result_tab, pathname):
             df,
             corpus,
             tag=tag["tag"],
+            version=version,
+        )
+        samples = {r: get_result_sample(result, r) for r in RESULT_TYPES}
+        # only the records shown are searched for the matches to highlight
+        matches = get_match_spans(
+            corpus,
+            [index for sample in samples.values() for index in sample],
+            keyword_regex,
+            time_limit=REGEX_TIME_LIMIT,
         )
     except re.error as err:
-        return ([tag["tag"], html.Div(str(err), className="bg-red white pa3")], [])
+        return [tag["tag"], html.Div(str(err), className="bg-red white pa3"), [], None]
     result_summary = get_result_summary(result)
-    tags_used.loc[tag.name, "Regular expression"] = keyword_regex
-    tags_used.loc[tag.name, "precision"] = result_summary["precision"]
-    tags_used.loc[tag.name, "recall"] = result_summary["recall"]
-    tags_used.loc[tag.name, "f1score"] = result_summary["f1score"]
-    tags_used.loc[tag.name, "accuracy"] = result_summary["accuracy"]
+    lap("match")
     save_regex_to_airtable(tag.name, keyword_regex, exclude_regex)
     if AIRTABLE_SAVE:
-        save_tags_used(tags_used)
+        # a match from the cache wasn't timed, so the stored cost is kept
+        # unless it was for different regexes
+        cost = result.attrs["cost"]
+        if cost is None and rule_changed(tag, keyword_regex, exclude_regex):
+            cost = pd.NA
+        update_tag_used(tag.name, {
+            "Regular expression": keyword_regex,
+            "Exclude regular expression": exclude_regex,
+            **{m: result_summary[m] for m in RESULT_METRICS},
+            **({"cost": cost} if cost is not None else {}),
+        })
+    lap("save")
 
     # get tab content
-    if result_tab == "all-charity-match":
-        all_charities, all_charities_group = get_all_charities(keyword_regex, exclude_regex)
-        result_tab_content = [
-            html.Div([
-                html.P("{:,.2%} of charities match this tag ({:,.0f} estimated)".format(
-                    all_charities_group.loc["Total", "percentage"],
-                    all_charities_group.loc["Total", "estimated_total"],
-                ), className="w-100"),
-                html.Table([
-                    html.Tr([
-                        html.Th("Income band", className="pv2 ph3"),
-                        html.Th("Proportion matching", className="pv2 ph3"),
-                        html.Th("Estimated total", className="pv2 ph3"),
-                    ])
-                ] + [
-                    html.Tr([
-                        html.Th(index, className="pv2 ph3"),
-                        html.Td("{:,.2%}".format(row["percentage"]), className="pv2 ph3 tr"),
-                        html.Td("{:,.0f}".format(row["estimated_total"]), className="pv2 ph3 tr"),
-                    ], className="striped--light-gray ") for index, row in all_charities_group.iterrows()
-                ], className="collapse"),
-            ], className="w-100"),
-            html.Ul([
-                html.Li(
-                    children=[
-                        html.H4(
-                            DangerouslySetInnerHTML(
-                                highlight_regex(
-                                    row["name"], keyword_regex
-                                ),
-                            ),
-                        ),
-                        html.P(
-                            DangerouslySetInnerHTML(
-                                highlight_regex(
-                                    row["activities"], keyword_regex
-                                ),
-                            ),
-                            className="f6",
-                        ),
-                    ],
-                    className="mv2 mw6",
-                )
-                for index, row in all_charities.iterrows()
-            ], style={"columns": 4})
-        ]
+    job_id = None
+    if job_tab:
+        # matched by the job runner, the result is shown by tag_job_poll
+        job_id = submit_all_charities_job(
+            keyword_regex,
+            exclude_regex,
+            exact=result_tab == "all-charity-exact",
+            previous_job=previous_job,
+        )
+        result_tab_content = []
     else:
         result_tab_content = [
             html.Div(
@@ -226,16 +229,12 @@ def tag_regex_page(keyword_regex, exclude_regex, result_tab, pathname):
                                     children=[
                                         html.H4(
                                             DangerouslySetInnerHTML(
-                                                highlight_regex(
-                                                    row["name"], keyword_regex
-                                                ),
+                                                highlight_match(matches[index], row["name"], "name"),
                                             ),
                                         ),
                                         html.P(
                                             DangerouslySetInnerHTML(
-                                                highlight_regex(
-                                                    row["activities"], keyword_regex
-                                                ),
+                                                highlight_match(matches[index], row["name"], "activities"),
                                             ),
                                             className="f6",
                                         ),
@@ -256,9 +255,7 @@ def tag_regex_page(keyword_regex, exclude_regex, result_tab, pathname):
                                     ],
                                     className="mv2",
                                 )
-                                for index, row in df.loc[result["result"] == r, :]
-                                .head(10)
-                                .iterrows()
+                                for index, row in df.loc[samples[r], :].iterrows()
                             ],
                             className="list pa0 ma0",
                         )
@@ -269,7 +266,7 @@ def tag_regex_page(keyword_regex, exclude_regex, result_tab, pathname):
             for r, description in RESULT_TYPES.items()
         ]
 
-    return [
+    output = [
         tag["tag"],
         [
             html.P(
@@ -308,4 +305,26 @@ def tag_regex_page(keyword_regex, exclude_regex, result_tab, pathname):
             ),
         ],
         result_tab_content,
+        job_id,
+    ]
+    lap("render")
+    return output
+
+
+@app.callback(
+    [
+        Output("tag-job-content", "children"),
+        Output("tag-job-poll", "disabled"),
+    ],
+    [
+        Input("tag-job", "data"),
+        Input("tag-job-poll", "n_intervals"),
+    ],
+)
+def tag_job_poll(job_id, _):
+    job = job_queue.get(job_id) if job_id else None
+    # stop polling once there's nothing more to wait for
+    return [
+        all_charities_job_content(job, "tag"),
+        job is None or job["status"] in FINISHED,
     ]
@@ -1,18 +1,31 @@
+import functools
+
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
-
-import pandas as pd
+from dash.dependencies import ClientsideFunction, Input, Output, State
 
 from tagger.app import app
 from tagger.data import get_tags_used
-from tagger.utils import stat_colour, get_tag_name
+from tagger.metrics import lap, timed
+from tagger.settings import CLIENTSIDE_TABLES, ROW_CACHE_SIZE
+from tagger.utils import (
+    cost_colour,
+    filter_rows,
+    format_cost,
+    get_tag_name,
+    get_table_page,
+    pagination_layout,
+    row_values,
+    stat_cell,
+    table_data,
+)
 
 layout = [
     html.Div([
         html.Div([
             dcc.Input(
                 id="filter-tags",
+                debounce=not CLIENTSIDE_TABLES,
                 placeholder="Filter tags",
                 type="text",
                 value="",
@@ -45,6 +58,7 @@ layout = [
                         {"value": "f1score", "label": "F1 score"},
                         {"value": "precision", "label": "Precision"},
                         {"value": "recall", "label": "Recall"},
+                        {"value": "cost", "label": "Cost"},
                     ],
                     value="frequency",
                     className="mw5 mb1",
@@ -78,6 +92,11 @@ layout = [
                             html.Th("Precision", className="pv2 ph3 tl f6 fw6 ttu tr"),
                             html.Th("Recall", className="pv2 ph3 tl f6 fw6 ttu tr"),
                             html.Th("Frequency", className="pv2 ph3 tl f6 fw6 ttu tr"),
+                            html.Th(
+                                "Cost",
+                                className="pv2 ph3 tl f6 fw6 ttu tr",
+                                title="Time taken to match the regular expression against the labelled sample",
+                            ),
                         ]
                     )
                 ]
@@ -89,72 +108,110 @@ layout = [
         ],
         className="collapse ba br2 b--black-10 pv2 ph3 mt4",
     ),
+    pagination_layout("tags"),
+    dcc.Store(id="tags-table"),
 ]
 
 
-@app.callback(
-    [
-        Output("tags-to-choose", "children"),
-        Output("tag-stats", "children"),
-    ],
-    [
-        Input("filter-tags", "value"),
-        Input("show-rows", "value"),
-        Input("order-by", "value"),
-        Input("order-by-direction", "value"),
-    ],
-)
-def filter_main_page(filter_value, show_rows_regex, order_by, order_by_direction):
-    def stat_cell(row, field):
-        className = "pv2 ph3 tr "
-        if not isinstance(row.get(field), float):
-            return html.Td("-", className=className)
-        value = row[field]
-        colour = stat_colour(value)
-        return html.Td("{:.0%}".format(value), className=className + colour)
+# the columns passed to tag_row
+TAG_COLUMNS = [
+    "tag",
+    "Category",
+    "Subcategory",
+    "tag_slug",
+    "Regular expression",
+    "Exclude regular expression",
+    "f1score",
+    "precision",
+    "recall",
+    "frequency",
+    "cost",
+]
+
+
+# Rows are rendered once for each set of values and reused until they change
+@functools.lru_cache(maxsize=ROW_CACHE_SIZE)
+def tag_row(
+    tag, category, subcategory, tag_slug, regex, exclude, f1score, precision, recall, frequency, cost
+):
+    return html.Tr(
+        children=[
+            html.Td(
+                dcc.Link(
+                    get_tag_name({"tag": tag, "Category": category, "Subcategory": subcategory}),
+                    href="/tag/{}".format(tag_slug),
+                ),
+                className="pv2 ph3",
+            ),
+            html.Td(
+                [html.Code(regex)] + ([
+                    html.Br(),
+                    html.Code(exclude, className="red strike")
+                ] if exclude is not None else []),
+                className="pv2 ph3 mw6",
+                style={"word-break": "break-word"}
+            ),
+            stat_cell(f1score),
+            stat_cell(precision),
+            stat_cell(recall),
+            html.Td(frequency, className="pv2 ph3 tr"),
+            html.Td(format_cost(cost), className="pv2 ph3 tr " + cost_colour(cost)),
+        ],
+        className="striped--near-white",
+    )
+
 
+# the table callback, run by the function below or by filter_table in
+# assets/tables.js when CLIENTSIDE_TABLES is set
+TAGS_OUTPUTS = [
+    Output("tags-to-choose", "children"),
+    Output("tag-stats", "children"),
+    Output("tags-page", "data"),
+    Output("tags-page-info", "children"),
+    Output("tags-previous", "disabled"),
+    Output("tags-next", "disabled"),
+]
+TAGS_INPUTS = [
+    Input("filter-tags", "value"),
+    Input("show-rows", "value"),
+    Input("order-by", "value"),
+    Input("order-by-direction", "value"),
+    Input("tags-page-size", "value"),
+    Input("tags-previous", "n_clicks"),
+    Input("tags-next", "n_clicks"),
+]
+TAGS_STATE = [State("tags-page", "data")]
+
+
+@timed
+def filter_main_page(
+    filter_value, show_rows_regex, order_by, order_by_direction, page_size, _, __, page
+):
     tags_used = get_tags_used()
-    rows_to_show = tags_used.copy()
+    lap("load_rules")
+    rows_to_show = tags_used
     if show_rows_regex == "with":
         rows_to_show = rows_to_show[rows_to_show["Regular expression"].notnull()]
     elif show_rows_regex == "without":
         rows_to_show = rows_to_show[rows_to_show["Regular expression"].isnull()]
     if filter_value:
-        rows_to_show = rows_to_show[rows_to_show["tag"].str.contains(filter_value, case=False)]
+        rows_to_show = filter_rows(rows_to_show, "tag", filter_value)
 
-    if order_by not in ["frequency", "f1score", "precision", "recall"]:
+    if order_by not in ["frequency", "f1score", "precision", "recall", "cost"] or (
+        order_by not in rows_to_show.columns
+    ):
         order_by = ["Category", "Subcategory", "tag"]
 
     rows_to_show = rows_to_show.sort_values(
         order_by, ascending=(order_by_direction == "ascending")
     )
+    page_rows, page, page_info, first_page, last_page = get_table_page(
+        rows_to_show, page, page_size
+    )
+    lap("filter")
 
-    return [
-        [
-            html.Tr(
-                children=[
-                    html.Td(
-                        dcc.Link(get_tag_name(row), href="/tag/{}".format(row["tag_slug"])),
-                        className="pv2 ph3",
-                    ),
-                    html.Td(
-                        [html.Code(row["Regular expression"])] + ([
-                            html.Br(),
-                            # html.Strong("Exclude:"), 
-                            html.Code(row["Exclude regular expression"], className="red strike")
-                        ] if not pd.isna(row["Exclude regular expression"]) else []),
-                        className="pv2 ph3 mw6",
-                        style={"word-break": "break-word"}
-                    ),
-                    stat_cell(row, "f1score"),
-                    stat_cell(row, "precision"),
-                    stat_cell(row, "recall"),
-                    html.Td(row["frequency"], className="pv2 ph3 tr"),
-                ],
-                className="striped--near-white",
-            )
-            for index, row in rows_to_show.iterrows()
-        ],
+    output = [
+        [tag_row(*values) for values in row_values(page_rows, TAG_COLUMNS)],
         [
             html.Ul(
                 [
@@ -182,5 +239,36 @@ def filter_main_page(filter_value, show_rows_regex, order_by, order_by_direction
                 ],
                 className="list ma0 pa0"
             )
-        ]
+        ],
+        page,
+        page_info,
+        first_page,
+        last_page,
     ]
+    lap("render")
+    return output
+
+
+@timed
+def tags_table(_):
+    return table_data(
+        get_tags_used(),
+        "tags",
+        get_tag_name,
+        lambda row: "/tag/{}".format(row["tag_slug"]),
+        "tag",
+        ["Category", "Subcategory", "tag"],
+    )
+
+
+if CLIENTSIDE_TABLES:
+    # the browser filters, sorts and pages the table - see assets/tables.js
+    app.callback(Output("tags-table", "data"), [Input("url", "pathname")])(tags_table)
+    app.clientside_callback(
+        ClientsideFunction(namespace="tables", function_name="filter_table"),
+        TAGS_OUTPUTS,
+        TAGS_INPUTS + [Input("tags-table", "data")],
+        TAGS_STATE,
+    )
+else:
+    app.callback(TAGS_OUTPUTS, TAGS_INPUTS, TAGS_STATE)(filter_main_page)
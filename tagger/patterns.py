@@ -0,0 +1,189 @@
+from contextlib import contextmanager
+import functools
+import re
+import signal
+import threading
+
+import pandas as pd
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # python < 3.11
+    import sre_parse
+
+# all matching and highlighting is case insensitive
+REGEX_FLAGS = re.IGNORECASE
+REGEX_CACHE_SIZE = 512
+
+# maps text onto the lower case ASCII letters that an ASCII literal matches
+# when ignoring case - "ſ" matches "s", the Kelvin sign matches "k", etc.
+CASE_FOLD = str.maketrans(
+    {
+        **{chr(c): chr(c).lower() for c in range(ord("A"), ord("Z") + 1)},
+        "\u0130": "i",
+        "\u0131": "i",
+        "\u017f": "s",
+        "\u212a": "k",
+    }
+)
+
+
+@functools.lru_cache(maxsize=REGEX_CACHE_SIZE)
+def _compile(pattern, flags):
+    # errors are cached too, so a bad pattern is only compiled once
+    try:
+        return re.compile(pattern, flags)
+    except re.error as err:
+        return err
+
+
+def compile_regex(pattern, flags=REGEX_FLAGS):
+    compiled = _compile(pattern, flags)
+    if isinstance(compiled, re.error):
+        raise compiled.with_traceback(None)
+    return compiled
+
+
+def has_regex(pattern):
+    return bool(pattern) and not pd.isna(pattern)
+
+
+def compile_rule(keyword_regex, exclude_regex=None, flags=REGEX_FLAGS):
+    # compile both halves of a rule up front so any re.error is raised
+    # before matching starts
+    include = compile_regex(keyword_regex, flags)
+    exclude = compile_regex(exclude_regex, flags) if has_regex(exclude_regex) else None
+    return include, exclude
+
+
+class RegexTimeout(re.error):
+    # matching took longer than allowed, usually because of catastrophic
+    # backtracking. A subclass of re.error so it's reported like a typo.
+    pass
+
+
+_time_limit_active = False
+
+
+@contextmanager
+def regex_time_limit(seconds):
+    # Raise RegexTimeout if the block takes longer than `seconds`. The re
+    # module checks for signals as it matches, so a runaway pattern is
+    # interrupted part way through a search. Signals are only handled in the
+    # main thread, so there is no limit in other threads (eg the threaded
+    # development server) or inside another limit.
+    global _time_limit_active
+    if not seconds or _time_limit_active or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def timeout(signum, frame):
+        raise RegexTimeout(
+            "The regular expression took longer than {:g} seconds to match. "
+            "Look for repeats inside repeats, like (a+)+, that can backtrack "
+            "for a very long time.".format(seconds)
+        )
+
+    previous = signal.signal(signal.SIGALRM, timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    _time_limit_active = True
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+        _time_limit_active = False
+
+
+def regex_cache_info():
+    return _compile.cache_info()
+
+
+_REPEATS = tuple(
+    getattr(sre_parse, name)
+    for name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+    if hasattr(sre_parse, name)
+)
+_ATOMIC_GROUP = getattr(sre_parse, "ATOMIC_GROUP", None)
+
+
+@functools.lru_cache(maxsize=REGEX_CACHE_SIZE)
+def required_literals(pattern, flags=REGEX_FLAGS):
+    # Literals that must appear in any text the pattern matches, as a tuple of
+    # sets: every set is required, and one of the literals in each set must be
+    # present. Literals are lower case ASCII and should be found with a case
+    # insensitive search. Empty if nothing could be extracted.
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except re.error:
+        return ()
+    return tuple(_sequence_literals(parsed))
+
+
+def best_literals(required):
+    # the most selective of the sets returned by required_literals
+    if not required:
+        return None
+    return max(required, key=lambda literals: (min(map(len, literals)), -len(literals)))
+
+
+def _sequence_literals(items):
+    required = []
+    run = []
+
+    def end_run():
+        if run:
+            required.append(frozenset(["".join(run).lower()]))
+            run.clear()
+
+    for op, av in items:
+        if op is sre_parse.LITERAL and av < 128:
+            run.append(chr(av))
+            continue
+        if op is sre_parse.AT:
+            # zero-width, so the characters either side are still adjacent
+            continue
+        end_run()
+        if op is sre_parse.SUBPATTERN:
+            required.extend(_sequence_literals(av[-1]))
+        elif op is _ATOMIC_GROUP:
+            required.extend(_sequence_literals(av))
+        elif op in _REPEATS and av[0] >= 1:
+            required.extend(_sequence_literals(av[2]))
+        elif op is sre_parse.BRANCH:
+            branches = [best_literals(_sequence_literals(b)) for b in av[1]]
+            if all(branches):
+                required.append(frozenset().union(*branches))
+    end_run()
+    return required
+
+
+def literal_trie_regex(literals):
+    # a single regex matching any of the literals, built as a trie so each
+    # position in the text is dispatched on its next character and the
+    # longest literal starting there is preferred
+    trie = {}
+    for literal in literals:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return _trie_node_regex(trie)
+
+
+def _trie_node_regex(node):
+    branches = [
+        re.escape(char) + _trie_node_regex(child)
+        for char, child in sorted(node.items())
+        if char
+    ]
+    if not branches:
+        return ""
+    if len(branches) == 1 and "" not in node:
+        return branches[0]
+    regex = "(?:{})".format("|".join(branches))
+    return regex + "?" if "" in node else regex
+
+
+def fold_case(text):
+    return text.translate(CASE_FOLD)
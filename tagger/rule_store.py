@@ -0,0 +1,237 @@
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+
+from tagger.localdb import LocalDatabase
+
+# SQLite store for the tag and ICNPTSO rule tables and their metrics.
+#
+# Each rule is a row holding its columns as JSON. Every write takes the next
+# number from a single counter and stamps it on the rows it changes, so
+# "what has changed since version X" is a range query and each worker can
+# keep its copy of a table up to date by reading only the changed rows.
+# Removed rules are kept as deleted rows so the removal shows up as a
+# change too. The database is in WAL mode so readers don't block the writer.
+
+NA_MARKER = "$na"
+
+
+class RuleStore:
+    def __init__(self, path):
+        self.db = LocalDatabase(
+            path,
+            """
+            CREATE TABLE IF NOT EXISTS rules (
+                kind TEXT NOT NULL,
+                record_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                version INTEGER NOT NULL,
+                PRIMARY KEY (kind, record_id)
+            );
+            CREATE INDEX IF NOT EXISTS rules_version ON rules (kind, version);
+            CREATE TABLE IF NOT EXISTS rule_columns (
+                kind TEXT PRIMARY KEY,
+                columns TEXT NOT NULL,
+                dtypes TEXT NOT NULL,
+                version INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS store_version (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                version INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO store_version (id, version) VALUES (0, 0);
+            """,
+        )
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
+    def close(self):
+        self.db.close()
+
+    def write(self, func):
+        # run func(conn, version) in a transaction with a new version number
+        with self.db.transaction() as conn:
+            conn.execute("UPDATE store_version SET version = version + 1")
+            version = conn.execute("SELECT version FROM store_version").fetchone()[0]
+            return func(conn, version)
+
+    def replace(self, kind, df):
+        # Store a whole table, eg from `flask data initialise`. Only rows
+        # whose contents or position have changed get a new version.
+        columns = [str(c) for c in df.columns]
+        dtypes = {c: str(dtype) for c, dtype in zip(columns, df.dtypes)}
+        rows = {
+            str(record_id): (position, encode_row(dict(zip(columns, values))))
+            for position, (record_id, values) in enumerate(
+                zip(df.index, df.itertuples(index=False, name=None))
+            )
+        }
+
+        def replace_rows(conn, version):
+            existing = {
+                record_id: (position, data, deleted)
+                for record_id, position, data, deleted in conn.execute(
+                    "SELECT record_id, position, data, deleted FROM rules WHERE kind = ?",
+                    (kind,),
+                )
+            }
+            conn.executemany(
+                """INSERT OR REPLACE INTO rules (kind, record_id, position, data, deleted, version)
+                VALUES (?, ?, ?, ?, 0, ?)""",
+                [
+                    (kind, record_id, position, data, version)
+                    for record_id, (position, data) in rows.items()
+                    if existing.get(record_id) != (position, data, 0)
+                ],
+            )
+            conn.executemany(
+                "UPDATE rules SET deleted = 1, version = ? WHERE kind = ? AND record_id = ?",
+                [
+                    (version, kind, record_id)
+                    for record_id, (_, _, deleted) in existing.items()
+                    if record_id not in rows and not deleted
+                ],
+            )
+            self._set_columns(conn, kind, columns, dtypes, version)
+
+        return self.write(replace_rows)
+
+    def upsert(self, kind, record_id, values):
+        # update some of the columns for one rule, adding it if it's new
+        record_id = str(record_id)
+
+        def upsert_row(conn, version):
+            row = conn.execute(
+                "SELECT position, data, deleted FROM rules WHERE kind = ? AND record_id = ?",
+                (kind, record_id),
+            ).fetchone()
+            if row and not row[2]:
+                position, data = row[0], {**decode_row(row[1]), **values}
+            else:
+                position = conn.execute(
+                    "SELECT COALESCE(MAX(position) + 1, 0) FROM rules WHERE kind = ?", (kind,)
+                ).fetchone()[0]
+                data = values
+            conn.execute(
+                """INSERT OR REPLACE INTO rules (kind, record_id, position, data, deleted, version)
+                VALUES (?, ?, ?, ?, 0, ?)""",
+                (kind, record_id, position, encode_row(data), version),
+            )
+            columns, dtypes = self._get_columns(conn, kind)
+            new_columns = [c for c in values if c not in columns]
+            if new_columns:
+                dtypes.update({c: "object" for c in new_columns})
+                self._set_columns(conn, kind, columns + new_columns, dtypes, version)
+
+        return self.write(upsert_row)
+
+    def version(self, kind):
+        return self.db.connect().execute(
+            """SELECT MAX(version) FROM (
+                SELECT MAX(version) AS version FROM rules WHERE kind = ?
+                UNION ALL SELECT version FROM rule_columns WHERE kind = ?
+            )""",
+            (kind, kind),
+        ).fetchone()[0]
+
+    def changes(self, kind, since=0):
+        # the rules changed after version `since`, as (record_id, position,
+        # values) with values of None for removed rules
+        return [
+            (record_id, position, None if deleted else decode_row(data))
+            for record_id, position, data, deleted in self.db.connect().execute(
+                """SELECT record_id, position, data, deleted FROM rules
+                WHERE kind = ? AND version > ? ORDER BY version""",
+                (kind, since),
+            )
+        ]
+
+    def exists(self, kind):
+        return self.version(kind) is not None
+
+    def frame(self, kind):
+        # The table as a DataFrame, brought up to date from the rows that
+        # have changed since it was last read. The same frame is returned
+        # until the table changes, so it must not be modified.
+        version = self.version(kind)
+        with self._cache_lock:
+            cached = self._cache.get(kind)
+            if cached and cached["version"] == version:
+                return cached["frame"]
+            rows = dict(cached["rows"]) if cached else {}
+            for record_id, position, values in self.changes(
+                kind, cached["version"] if cached else 0
+            ):
+                if values is None:
+                    rows.pop(record_id, None)
+                else:
+                    rows[record_id] = (position, values)
+            columns, dtypes = self._get_columns(self.db.connect(), kind)
+            frame = build_frame(rows, columns, dtypes)
+            frame.attrs["version"] = "{}:{}".format(kind, version)
+            self._cache[kind] = {"version": version, "rows": rows, "frame": frame}
+            return frame
+
+    @staticmethod
+    def _get_columns(conn, kind):
+        row = conn.execute(
+            "SELECT columns, dtypes FROM rule_columns WHERE kind = ?", (kind,)
+        ).fetchone()
+        if not row:
+            return [], {}
+        return json.loads(row[0]), json.loads(row[1])
+
+    @staticmethod
+    def _set_columns(conn, kind, columns, dtypes, version):
+        if (columns, dtypes) == RuleStore._get_columns(conn, kind):
+            return
+        conn.execute(
+            "INSERT OR REPLACE INTO rule_columns (kind, columns, dtypes, version) VALUES (?, ?, ?, ?)",
+            (kind, json.dumps(columns), json.dumps(dtypes), version),
+        )
+
+
+def encode_row(values):
+    return json.dumps(values, sort_keys=True, default=_encode_value)
+
+
+def decode_row(data):
+    return json.loads(data, object_hook=_decode_value)
+
+
+def _encode_value(value):
+    if value is pd.NA:
+        return {NA_MARKER: True}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("Can't store {!r}".format(value))
+
+
+def _decode_value(value):
+    if value.keys() == {NA_MARKER}:
+        return pd.NA
+    return value
+
+
+def build_frame(rows, columns, dtypes):
+    ordered = sorted(rows.items(), key=lambda row: row[1][0])
+    values = np.empty((len(ordered), len(columns)), dtype=object)
+    for i, (_, (_, row)) in enumerate(ordered):
+        for j, column in enumerate(columns):
+            values[i, j] = row.get(column, np.nan)
+    # built with integer column keys, as the names may not be unique
+    frame = pd.DataFrame(
+        {i: values[:, i] for i in range(len(columns))},
+        index=pd.Index([record_id for record_id, _ in ordered], dtype=object),
+    )
+    frame.columns = columns
+    for column in columns:
+        if dtypes.get(column, "object") != "object":
+            frame[column] = frame[column].astype(dtypes[column])
+    return frame
@@ -5,14 +5,35 @@ from dotenv import load_dotenv
 load_dotenv()
 
 DATA_DIR = os.environ.get("DATA_DIR", "data/")
-COMPLETED_DF = os.path.join(DATA_DIR, "completed.pkl")
-TAGS_USED_DF = os.path.join(DATA_DIR, "tags_used.pkl")
-ICNPTSO_USED_DF = os.path.join(DATA_DIR, "icnptso_used.pkl")
-ALL_CHARITIES_DF = os.path.join(DATA_DIR, "charities_active.pkl")
-ALL_CHARITIES_BY_INCOME_DF = os.path.join(DATA_DIR, "charities_by_income.pkl")
+COMPLETED_DF = os.path.join(DATA_DIR, "completed")
+COMPLETED_CORPUS = os.path.join(DATA_DIR, "completed_corpus")
+COMPLETED_INDEX = os.path.join(DATA_DIR, "completed_index")
+COMPLETED_TAGS_MATRIX = os.path.join(DATA_DIR, "completed_tags")
+COMPLETED_ICNPTSO_MATRIX = os.path.join(DATA_DIR, "completed_icnptso")
+TAGS_USED_DF = os.path.join(DATA_DIR, "tags_used")
+ICNPTSO_USED_DF = os.path.join(DATA_DIR, "icnptso_used")
+RULE_STORE = os.path.join(DATA_DIR, "rules.sqlite3")
+ALL_CHARITIES_DF = os.path.join(DATA_DIR, "charities_active")
+ALL_CHARITIES_CORPUS = os.path.join(DATA_DIR, "charities_active_corpus")
+ALL_CHARITIES_INDEX = os.path.join(DATA_DIR, "charities_active_index")
+ALL_CHARITIES_BY_INCOME_DF = os.path.join(DATA_DIR, "charities_by_income")
+ALL_CHARITIES_REGISTER_DF = os.path.join(DATA_DIR, "charities_register")
+ALL_CHARITIES_REGISTER_CORPUS = os.path.join(DATA_DIR, "charities_register_corpus")
+INITIALISE_MANIFEST = os.path.join(DATA_DIR, "initialise_manifest.json")
 ALL_CHARITIES_CSV = os.path.join(DATA_DIR, "charities_active.csv")
+ALL_CHARITIES_CSV_CHUNKSIZE = 50000
 AIRTABLE_API_KEY = os.environ.get("AIRTABLE_API_KEY")
 AIRTABLE_BASE_ID = os.environ.get("AIRTABLE_BASE_ID")
+AIRTABLE_API_URL = os.environ.get("AIRTABLE_API_URL", "https://api.airtable.com/v0")
+AIRTABLE_MAX_CONNECTIONS = 4
+AIRTABLE_REQUESTS_PER_SECOND = float(os.environ.get("AIRTABLE_REQUESTS_PER_SECOND", 5))
+AIRTABLE_RETRIES = 5
+AIRTABLE_BACKOFF = 2
+AIRTABLE_TIMEOUT = 30
+AIRTABLE_WRITE_QUEUE = os.path.join(DATA_DIR, "airtable_writes.sqlite3")
+AIRTABLE_WRITE_INTERVAL = 5
+AIRTABLE_WRITE_LEASE = 120
+AIRTABLE_WRITE_ATTEMPTS = 10
 AIRTABLE_TAGS_TABLE_NAME = "Tags - working"
 AIRTABLE_ICNPTSO_TABLE_NAME = "ICNPTSO"
 AIRTABLE_SAMPLE_TABLE_NAME = "Sample data"
@@ -20,3 +41,21 @@ AIRTABLE_SAVE = False
 TAGS_FIELD_NAME = "Tags (working)"
 ICNPTSO_FIELD_NAME = "ICNPTSO"
 DEFAULT_REGEX = r"\b()\b"
+REGEX_TIME_LIMIT = float(os.environ.get("REGEX_TIME_LIMIT", 10))
+REGEX_REGISTER_TIME_LIMIT = float(os.environ.get("REGEX_REGISTER_TIME_LIMIT", 300))
+PRELOAD_DATA = os.environ.get("PRELOAD_DATA", "true").lower() in ("1", "true", "yes")
+SELECTION_CACHE_BYTES = int(os.environ.get("SELECTION_CACHE_BYTES", 32 * 1024 * 1024))
+TABLE_PAGE_SIZES = [25, 50, 100, 250]
+TABLE_PAGE_SIZE = 50
+ROW_CACHE_SIZE = 4096
+# filter, sort and page the tags and ICNPTSO tables in the browser
+CLIENTSIDE_TABLES = os.environ.get("CLIENTSIDE_TABLES", "true").lower() in ("1", "true", "yes")
+JOB_QUEUE = os.path.join(DATA_DIR, "jobs.sqlite3")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT", 900))
+JOB_POLL_INTERVAL = 0.5
+JOB_PAGE_POLL_INTERVAL = 1000
+JOB_RESULT_TTL = 3600
+METRICS_DB = os.path.join(DATA_DIR, "metrics.sqlite3")
+METRICS_FLUSH_INTERVAL = 10
+METRICS_PROCESS_TTL = 300
@@ -1,6 +1,30 @@
+from html import escape
+import math
 import re
+import resource
 
+import dash
+import dash_core_components as dcc
 import dash_html_components as html
+from dash_dangerously_set_inner_html import DangerouslySetInnerHTML
+import pandas as pd
+
+from tagger.settings import TABLE_PAGE_SIZE, TABLE_PAGE_SIZES
+
+
+# the values in each row of table_data
+TABLE_DATA_COLUMNS = [
+    "name",
+    "href",
+    "filter",
+    "Regular expression",
+    "Exclude regular expression",
+    "f1score",
+    "precision",
+    "recall",
+    "frequency",
+    "cost",
+]
 
 
 def stats_box(stat, title, link=None):
@@ -38,16 +62,142 @@ def stat_colour(stat):
     return "bg-washed-red dark-red"
 
 
-def highlight_regex(text, regex):
-    def span_match(m):
-        return '<span class="bg-light-pink i">' + m.group(0) + "</span>"
+def stat_cell(value):
+    className = "pv2 ph3 tr "
+    if not isinstance(value, float):
+        return html.Td("-", className=className)
+    return html.Td("{:.0%}".format(value), className=className + stat_colour(value))
+
+
+def cost_colour(cost):
+    # seconds taken to match a rule against the labelled sample
+    if pd.isna(cost):
+        return ""
+    if cost > 1:
+        return "bg-washed-red dark-red"
+    elif cost > 0.1:
+        return "bg-washed-yellow orange"
+    return ""
+
+
+def format_cost(cost):
+    if pd.isna(cost):
+        return "-"
+    if cost < 0.01:
+        return "{:.1f}ms".format(cost * 1000)
+    if cost < 1:
+        return "{:,.0f}ms".format(cost * 1000)
+    return "{:,.1f}s".format(cost)
 
-    return re.sub(
-        regex,
-        span_match,
-        text,
-        flags=re.IGNORECASE,
-    )
+
+def highlight_spans(text, spans, start=0, end=None):
+    # text[start:end] as HTML, with the spans where a regex matched it
+    # highlighted
+    end = len(text) if end is None else end
+    parts = []
+    position = start
+    for span_start, span_end in spans:
+        span_start, span_end = max(span_start, position), min(span_end, end)
+        if span_start >= span_end:
+            continue
+        parts.append(escape(text[position:span_start]))
+        parts.append('<span class="bg-light-pink i">' + escape(text[span_start:span_end]) + "</span>")
+        position = span_end
+    parts.append(escape(text[position:end]))
+    return "".join(parts)
+
+
+def highlight_match(match, name, part):
+    # The name or activities part of a record's corpus text (see
+    # build_corpus) as HTML, with the matches highlighted. match is the
+    # record's (text, spans) from get_match_spans.
+    text, spans = match
+    split = len(name) if isinstance(name, str) else 0
+    if part == "name":
+        return highlight_spans(text, spans, 0, split)
+    return highlight_spans(text, spans, split + 1)
+
+
+def all_charities_content(all_charities, all_charities_group, exact, label="tag"):
+    return [
+        html.Div([
+            html.P("{:,.2%} of charities match this {} ({:,.0f} estimated{})".format(
+                all_charities_group.loc["Total", "percentage"],
+                label,
+                all_charities_group.loc["Total", "estimated_total"],
+                ", {:,.0f} exactly".format(all_charities_group.loc["Total", "exact_total"]) if exact else "",
+            ), className="w-100"),
+            html.Table([
+                html.Tr([
+                    html.Th("Income band", className="pv2 ph3"),
+                    html.Th("Proportion matching", className="pv2 ph3"),
+                    html.Th("Estimated total", className="pv2 ph3"),
+                ] + ([
+                    html.Th("Exact proportion", className="pv2 ph3"),
+                    html.Th("Exact total", className="pv2 ph3"),
+                ] if exact else []))
+            ] + [
+                html.Tr([
+                    html.Th(index, className="pv2 ph3"),
+                    html.Td("{:,.2%}".format(row["percentage"]), className="pv2 ph3 tr"),
+                    html.Td("{:,.0f}".format(row["estimated_total"]), className="pv2 ph3 tr"),
+                ] + ([
+                    html.Td("{:,.2%}".format(row["exact_percentage"]), className="pv2 ph3 tr"),
+                    html.Td("{:,.0f}".format(row["exact_total"]), className="pv2 ph3 tr"),
+                ] if exact else []), className="striped--light-gray ") for index, row in all_charities_group.iterrows()
+            ], className="collapse"),
+        ], className="w-100"),
+        html.Ul([
+            html.Li(
+                children=[
+                    html.H4(
+                        DangerouslySetInnerHTML(
+                            highlight_match(row["match"], row["name"], "name"),
+                        ),
+                    ),
+                    html.P(
+                        DangerouslySetInnerHTML(
+                            highlight_match(row["match"], row["name"], "activities"),
+                        ),
+                        className="f6",
+                    ),
+                ],
+                className="mv2 mw6",
+            )
+            for index, row in all_charities.iterrows()
+        ], style={"columns": 4})
+    ]
+
+
+def all_charities_job_content(job, label="tag"):
+    # the result of a job from `submit_all_charities_job`, or its progress
+    if job is None or job["status"] == "cancelled":
+        return []
+    if job["status"] == "done":
+        all_charities, all_charities_group = job["result"]
+        return all_charities_content(
+            all_charities,
+            all_charities_group,
+            job["args"]["exact"],
+            label,
+        )
+    if job["status"] == "error":
+        return [html.Div(job["message"], className="bg-red white pa3 w-100")]
+    return [
+        html.Div(
+            [
+                html.P(job["message"] or "Waiting to start", className="gray"),
+                html.Div(
+                    html.Div(
+                        className="h-100 bg-blue",
+                        style={"width": "{:.0%}".format(job["progress"])},
+                    ),
+                    className="h1 w-100 bg-light-gray",
+                ),
+            ],
+            className="w-100",
+        )
+    ]
 
 
 def get_tag_name(row):
@@ -62,3 +212,117 @@ def get_tag_name(row):
 def get_icnptso_name(row):
     parts = [row["Code"], row["Title"]]
     return " - ".join(parts)
+
+
+def memory_usage():
+    # resident and proportional set size of this process in bytes. PSS
+    # splits shared pages between the processes using them, so the gap
+    # between the two shows how much is shared with other workers.
+    usage = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                if key in ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Dirty"):
+                    usage[key.lower()] = int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        # not linux - peak resident size is all that's available
+        usage["rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return usage
+
+
+def memory_report(label):
+    return "{}: {}".format(
+        label,
+        ", ".join("{} {:,.1f}MB".format(k, v / 1024 / 1024) for k, v in memory_usage().items()),
+    )
+
+
+def pagination_layout(id_prefix):
+    # previous and next buttons and a page size for a table, used with
+    # get_table_page
+    button = "pointer ba b--black-20 bg-white pv1 ph2 br2 f6"
+    return html.Div(
+        [
+            html.Button("Previous", id="{}-previous".format(id_prefix), className=button),
+            html.Span(id="{}-page-info".format(id_prefix), className="mh3"),
+            html.Button("Next", id="{}-next".format(id_prefix), className=button + " mr3"),
+            dcc.Dropdown(
+                id="{}-page-size".format(id_prefix),
+                options=[
+                    {"value": size, "label": "{} per page".format(size)}
+                    for size in TABLE_PAGE_SIZES
+                ] + [{"value": 0, "label": "Show all"}],
+                value=TABLE_PAGE_SIZE,
+                clearable=False,
+                searchable=False,
+                className="w5",
+                persistence=True,
+            ),
+            dcc.Store(id="{}-page".format(id_prefix), data=0),
+        ],
+        className="f6 mv3 flex items-center",
+    )
+
+
+def filter_rows(rows, column, filter_value):
+    # the rows whose column matches filter_value as a case insensitive
+    # regular expression, or contains it if it isn't one - like matcher in
+    # assets/tables.js. Missing values don't match.
+    try:
+        re.compile(filter_value)
+        regex = True
+    except re.error:
+        regex = False
+    return rows[rows[column].str.contains(filter_value, case=False, regex=regex, na=False)]
+
+
+def get_table_page(rows, page, page_size):
+    # The rows on the page, moving to the previous or next page if one of
+    # their buttons was clicked - any other change to the table goes back
+    # to the first page. Returns the rows, the page and the page info, and
+    # whether the previous and next buttons are disabled.
+    triggered = [t["prop_id"] for t in dash.callback_context.triggered]
+    page = page or 0
+    if any(t.endswith("-previous.n_clicks") for t in triggered):
+        page -= 1
+    elif any(t.endswith("-next.n_clicks") for t in triggered):
+        page += 1
+    else:
+        page = 0
+    pages = max(math.ceil(len(rows) / page_size), 1) if page_size else 1
+    page = min(max(page, 0), pages - 1)
+    if page_size:
+        rows = rows.iloc[page * page_size : (page + 1) * page_size]
+    return [
+        rows,
+        page,
+        "Page {:,.0f} of {:,.0f}".format(page + 1, pages),
+        page == 0,
+        page == pages - 1,
+    ]
+
+
+def row_values(rows, columns):
+    # each row's values for the columns, as tuples that can key a cache of
+    # rendered rows. Missing columns and values are None.
+    values = [
+        rows[column].to_numpy(dtype=object) if column in rows.columns else [None] * len(rows)
+        for column in columns
+    ]
+    return [tuple(None if pd.isna(v) else v for v in row) for row in zip(*values)]
+
+
+def table_data(rows, label, name, href, filter_column, order_by):
+    # The table for filter_table in assets/tables.js, sent to the browser
+    # once: a list of values for each row, in the default order
+    rows = rows.sort_values(order_by)
+    values = row_values(rows, [filter_column] + TABLE_DATA_COLUMNS[3:])
+    return {
+        "label": label,
+        "columns": TABLE_DATA_COLUMNS,
+        "rows": [
+            [name(row), href(row)] + list(row_value)
+            for (_, row), row_value in zip(rows.iterrows(), values)
+        ],
+    }